@@ -0,0 +1,164 @@
+"""
+Control de admisión por clase de ruta y descarte rápido bajo carga
+
+Cada endpoint pertenece a una clase con su límite de peticiones simultáneas
+por worker, una cola acotada y un tiempo máximo de espera en ella. Cuando la
+base de datos se frena las peticiones se acumulan dentro del worker; con los
+límites, el polling del dashboard y las exportaciones (clase `baja`, sin
+cola) reciben 503 con Retry-After al momento, mientras que las páginas
+interactivas (login, inicio) conservan su cupo propio y pueden esperar turno.
+
+Los límites son por proceso: con workers `sync` cada worker atiende una
+petición a la vez y la cola es la de gunicorn; con `gevent` protegen al pool
+de conexiones de miles de greenlets.
+"""
+
+import os
+import threading
+import time
+
+from flask import Response, g, jsonify, request
+
+import metricas
+from database import esperando_conexion
+
+
+def _configuracion(clase, por_defecto):
+    """(límite, cola, espera) de CAEC_ADMISION_<CLASE>='límite,cola,espera'"""
+    texto = os.environ.get(f'CAEC_ADMISION_{clase.upper()}', por_defecto)
+    limite, cola, espera = texto.split(',')
+    return int(limite), int(cola), float(espera)
+
+
+CLASES = {
+    'interactiva': _configuracion('interactiva', '32,64,10'),
+    'api': _configuracion('api', '16,32,2'),
+    'baja': _configuracion('baja', '4,0,0'),
+}
+
+# Clase de cada endpoint (los que no aparecen son `api`). Las esperas largas
+# que no usan la base de datos (SSE, long-poll) y /metrics no se limitan.
+RUTAS = {
+    'index': 'interactiva', 'register': 'interactiva', 'login': 'interactiva',
+    'logout': 'interactiva', 'inicio': 'interactiva', 'add_system': 'interactiva',
+    'account': 'interactiva', 'update_account': 'interactiva', 'config': 'interactiva',
+    'change_password': 'interactiva', 'systems': 'interactiva', 'add_new_system': 'interactiva',
+    'activate_system': 'interactiva', 'delete_system': 'interactiva',
+    'validate_system': 'interactiva', 'link_system': 'interactiva',
+    'system_data': 'baja', 'sensor_history': 'baja', 'export_history': 'baja', 'analytics': 'baja',
+    'system_data_stream': None, 'device_commands': None, 'metrics': None, 'static': None,
+}
+
+# Segundos que se pide esperar al rechazar una petición
+RETRY_AFTER = int(os.environ.get('CAEC_ADMISION_RETRY_AFTER', 5))
+
+peticiones_admision = metricas.registro.gauge(
+    'caec_admission_requests', 'Peticiones por clase de admisión (en_curso, esperando, limite)', ('class', 'state'))
+rechazos_admision = metricas.registro.contador(
+    'caec_admission_rejected_total', 'Peticiones rechazadas con 503 por clase y motivo', ('class', 'reason'))
+espera_admision = metricas.registro.histograma(
+    'caec_admission_wait_seconds', 'Tiempo en la cola de admisión', ('class',))
+
+
+class Limitador:
+    """Semáforo con cola acotada y espera máxima para una clase de rutas"""
+
+    def __init__(self, clase, limite, cola, espera):
+        self.clase = clase
+        self.limite = limite
+        self.cola = cola
+        self.espera = espera
+        self._condicion = threading.Condition()
+        self._en_curso = 0
+        self._esperando = 0
+
+    def entrar(self):
+        """Ocupar un cupo; devuelve None si se admite o el motivo del rechazo"""
+        with self._condicion:
+            if self._en_curso < self.limite:
+                self._en_curso += 1
+                return None
+            if self._esperando >= self.cola or self.espera <= 0:
+                return 'limite'
+
+            inicio = time.monotonic()
+            plazo = inicio + self.espera
+            self._esperando += 1
+            try:
+                while self._en_curso >= self.limite:
+                    restante = plazo - time.monotonic()
+                    if restante <= 0:
+                        return 'espera'
+                    self._condicion.wait(restante)
+                self._en_curso += 1
+                return None
+            finally:
+                self._esperando -= 1
+                espera_admision.observe(self.clase, valor=time.monotonic() - inicio)
+
+    def salir(self):
+        with self._condicion:
+            self._en_curso -= 1
+            self._condicion.notify()
+
+    def estadisticas(self):
+        with self._condicion:
+            return {'en_curso': self._en_curso, 'esperando': self._esperando, 'limite': self.limite}
+
+
+limitadores = {clase: Limitador(clase, *config) for clase, config in CLASES.items()}
+
+
+@metricas.registro.recolector
+def _metricas_admision():
+    for clase, limitador in limitadores.items():
+        for estado, valor in limitador.estadisticas().items():
+            peticiones_admision.set(clase, estado, valor=valor)
+
+
+def _rechazo(mensaje):
+    if request.path.startswith('/api/'):
+        respuesta = jsonify({'success': False, 'message': mensaje})
+    else:
+        respuesta = Response(mensaje + '\n', mimetype='text/plain')
+    respuesta.status_code = 503
+    respuesta.headers['Retry-After'] = str(RETRY_AFTER)
+    return respuesta
+
+
+def controlar_admision(app, mensaje):
+    """Registrar el control de admisión en la app (`mensaje` es el texto del 503)"""
+
+    @app.before_request
+    def _admitir():
+        clase = RUTAS.get(request.endpoint, 'api')
+        if clase is None:
+            return None
+        # Si ya hay peticiones esperando una conexión, el polling no se suma a la cola
+        if clase == 'baja' and esperando_conexion() > 0:
+            rechazos_admision.inc(clase, 'pool')
+            return _rechazo(mensaje)
+
+        limitador = limitadores[clase]
+        motivo = limitador.entrar()
+        if motivo is not None:
+            rechazos_admision.inc(clase, motivo)
+            return _rechazo(mensaje)
+        g._admision = limitador
+        return None
+
+    @app.after_request
+    def _ceder_a_respuesta(respuesta):
+        # El cuerpo de una respuesta en streaming (exportaciones) se genera
+        # después del teardown: el cupo se libera al cerrar la respuesta
+        limitador = g.get('_admision')
+        if limitador is not None and respuesta.is_streamed:
+            g._admision = None
+            respuesta.call_on_close(limitador.salir)
+        return respuesta
+
+    @app.teardown_request
+    def _liberar(error):
+        limitador = g.pop('_admision', None)
+        if limitador is not None:
+            limitador.salir()
@@ -0,0 +1,241 @@
+"""
+Alertas de los sensores evaluadas durante la ingesta
+
+Cada sistema tiene una regla por métrica: rango aceptado (mínimo y/o
+máximo), histéresis y espera. Las reglas guardadas en reglas_alerta
+sustituyen a las de REGLAS_POR_DEFECTO (los rangos óptimos del dashboard) y
+se cachean por worker, así que evaluar un lote no consulta las reglas.
+
+Cada (sistema, métrica) sigue una máquina de estados:
+
+- normal -> pendiente: la lectura sale del rango.
+- pendiente -> activa: sigue fuera del rango durante `espera` segundos (se
+  crea la notificación); si vuelve al rango antes, regresa a normal sin avisar.
+- activa -> normal: la lectura vuelve al rango con margen de `histeresis`
+  (se notifica), para no avisar una y otra vez con un valor que oscila en el
+  límite.
+
+Cada lectura cuesta O(1): solo se compara con la regla y con el estado de su
+alerta, que se lee una vez por lote y se escribe solo cuando cambia.
+"""
+
+import os
+
+import metricas
+from cache import FALTA, TTLCache
+from database import evaluar_alertas, guardar_reglas_alerta, obtener_reglas_alerta
+
+# Métricas con alerta: nombre y adjetivos (concordados) para los mensajes
+METRICAS = {
+    'nivel_agua': ('Nivel de agua', 'bajo', 'alto'),
+    'ph': ('pH', 'bajo', 'alto'),
+    'temperatura': ('Temperatura del agua', 'baja', 'alta'),
+    'nivel_nutrientes': ('Nivel de nutrientes', 'bajo', 'alto'),
+}
+
+# Reglas de los sistemas sin reglas propias (rangos óptimos del dashboard);
+# `espera` en segundos
+REGLAS_POR_DEFECTO = {
+    'nivel_agua': {'minimo': 20.0, 'maximo': None, 'histeresis': 5.0, 'espera': 60, 'activa': True},
+    'ph': {'minimo': 6.0, 'maximo': 7.5, 'histeresis': 0.1, 'espera': 300, 'activa': True},
+    'temperatura': {'minimo': 20.0, 'maximo': 24.0, 'histeresis': 0.5, 'espera': 300, 'activa': True},
+    'nivel_nutrientes': {'minimo': 20.0, 'maximo': None, 'histeresis': 5.0, 'espera': 300, 'activa': True},
+}
+
+# Espera máxima aceptada en una regla (segundos)
+ESPERA_MAXIMA = 86400
+
+# Reglas vigentes por sistema_id (los workers que no guardaron el cambio lo
+# ven al vencer la entrada)
+reglas = TTLCache(
+    max_size=int(os.environ.get('CAEC_CACHE_LECTURAS_MAX', 10000)),
+    ttl=float(os.environ.get('CAEC_CACHE_REGLAS_TTL', 30)),
+)
+
+alertas_emitidas = metricas.registro.contador(
+    'caec_alerts_total', 'Notificaciones de alerta creadas por métrica y tipo', ('metric', 'type'))
+
+
+class ReglaInvalida(ValueError):
+    """Regla de alerta no válida"""
+
+
+def _combinar(guardadas):
+    """Reglas vigentes: las por defecto sustituidas por las guardadas"""
+    vigentes = {}
+    for metrica, regla in REGLAS_POR_DEFECTO.items():
+        vigentes[metrica] = dict(guardadas.get(metrica, regla))
+    return vigentes
+
+
+def reglas_de(sistema_ids):
+    """Reglas vigentes de varios sistemas ({sistema_id: {metrica: regla}})
+
+    Los sistemas que no están en caché se leen con una sola consulta.
+    """
+    vigentes = {}
+    pendientes = []
+    for sistema_id in set(sistema_ids):
+        en_cache = reglas.get(sistema_id)
+        if en_cache is FALTA:
+            pendientes.append(sistema_id)
+        else:
+            vigentes[sistema_id] = en_cache
+    if pendientes:
+        for sistema_id, guardadas in obtener_reglas_alerta(pendientes).items():
+            vigentes[sistema_id] = _combinar(guardadas)
+            reglas.set(sistema_id, vigentes[sistema_id])
+    return vigentes
+
+
+def _fuera_de_rango(regla, valor):
+    """'bajo', 'alto' o None si el valor está dentro del rango"""
+    if regla['minimo'] is not None and valor < regla['minimo']:
+        return 'bajo'
+    if regla['maximo'] is not None and valor > regla['maximo']:
+        return 'alto'
+    return None
+
+
+def _recuperado(regla, valor):
+    """True si el valor volvió al rango con el margen de histéresis"""
+    if regla['minimo'] is not None and valor < regla['minimo'] + regla['histeresis']:
+        return False
+    if regla['maximo'] is not None and valor > regla['maximo'] - regla['histeresis']:
+        return False
+    return True
+
+
+def _notificacion(sistema_id, metrica, tipo, regla, valor, momento, lado=None):
+    nombre, bajo, alto = METRICAS[metrica]
+    if tipo == 'alerta':
+        limite = 'mínimo' if lado == 'bajo' else 'máximo'
+        umbral = regla['minimo'] if lado == 'bajo' else regla['maximo']
+        mensaje = f"{nombre} {bajo if lado == 'bajo' else alto}: {valor:g} ({limite} {umbral:g})"
+    else:
+        mensaje = f"{nombre} de nuevo en rango: {valor:g}"
+    return {'sistema_id': sistema_id, 'metrica': metrica, 'tipo': tipo,
+            'mensaje': mensaje, 'valor': valor, 'creada': momento}
+
+
+def transicion(regla, estado, valor, momento):
+    """Aplicar una lectura a la máquina de estados de una alerta
+
+    `estado` es el guardado ({'estado', 'desde', 'valor'}) o None (normal).
+    Devuelve (estado_nuevo, evento): estado_nuevo es None si no cambia y
+    evento es None, ('alerta', lado) o ('normalizada', None).
+    """
+    actual = estado['estado'] if estado else 'normal'
+    lado = _fuera_de_rango(regla, valor)
+
+    if actual == 'activa':
+        if lado is None and _recuperado(regla, valor):
+            return {'estado': 'normal', 'desde': momento, 'valor': valor}, ('normalizada', None)
+        return None, None
+
+    if lado is None:
+        if actual == 'pendiente':
+            return {'estado': 'normal', 'desde': momento, 'valor': valor}, None
+        return None, None
+
+    desde = estado['desde'] if actual == 'pendiente' else momento
+    if (momento - desde).total_seconds() >= regla['espera']:
+        return {'estado': 'activa', 'desde': momento, 'valor': valor}, ('alerta', lado)
+    if actual == 'pendiente':
+        return None, None
+    return {'estado': 'pendiente', 'desde': momento, 'valor': valor}, None
+
+
+def evaluar(lecturas):
+    """Evaluar un lote de lecturas ya guardadas; devuelve las notificaciones creadas"""
+    por_sistema = {}
+    for lectura in lecturas:
+        por_sistema.setdefault(lectura['sistema_id'], []).append(lectura)
+    vigentes = reglas_de(por_sistema)
+
+    def aplicar(estados):
+        cambios = {}
+        notificaciones = []
+        for sistema_id, lecturas_sistema in por_sistema.items():
+            lecturas_sistema.sort(key=lambda lectura: lectura['timestamp'])
+            for metrica, regla in vigentes[sistema_id].items():
+                if not regla['activa']:
+                    continue
+                clave = (sistema_id, metrica)
+                for lectura in lecturas_sistema:
+                    valor = lectura.get(metrica)
+                    estado = estados.get(clave)
+                    # Lecturas atrasadas respecto del último cambio de estado
+                    if valor is None or (estado and lectura['timestamp'] < estado['desde']):
+                        continue
+                    nuevo, evento = transicion(regla, estado, float(valor), lectura['timestamp'])
+                    if nuevo is None:
+                        continue
+                    estados[clave] = cambios[clave] = nuevo
+                    if evento is not None:
+                        tipo, lado = evento
+                        notificaciones.append(_notificacion(
+                            sistema_id, metrica, tipo, regla, float(valor), lectura['timestamp'], lado))
+        return cambios, notificaciones
+
+    creadas = evaluar_alertas(list(por_sistema), aplicar)
+    for notificacion in creadas:
+        alertas_emitidas.inc(notificacion['metrica'], notificacion['tipo'])
+    return creadas
+
+
+def _numero(campo, valor, opcional=True):
+    if valor is None and opcional:
+        return None
+    if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+        raise ReglaInvalida(f"{campo} debe ser numérico")
+    return float(valor)
+
+
+def vigentes(sistema_id):
+    """Reglas vigentes de un sistema leídas de la base (renueva la caché)"""
+    reglas.delete(sistema_id)
+    return reglas_de([sistema_id])[sistema_id]
+
+
+def validar(metrica, valores, actual=None):
+    """Convertir y validar una regla (dict con las claves de REGLAS_POR_DEFECTO)
+
+    `valores` puede ser parcial: las claves que faltan se toman de `actual`
+    (la regla vigente) o, sin ella, de REGLAS_POR_DEFECTO. Una clave presente
+    con None borra el mínimo o el máximo.
+    """
+    if metrica not in METRICAS:
+        raise ReglaInvalida(f"Métrica no válida; opciones: {', '.join(sorted(METRICAS))}")
+    valores = {**(actual or REGLAS_POR_DEFECTO[metrica]), **valores}
+    regla = {
+        'minimo': _numero('minimo', valores['minimo']),
+        'maximo': _numero('maximo', valores['maximo']),
+        'histeresis': _numero('histeresis', valores['histeresis'], opcional=False),
+        'espera': _numero('espera', valores['espera'], opcional=False),
+        'activa': valores['activa'],
+    }
+    if not isinstance(regla['activa'], bool):
+        raise ReglaInvalida("activa debe ser booleano")
+    if regla['minimo'] is None and regla['maximo'] is None:
+        raise ReglaInvalida("Se requiere un mínimo o un máximo")
+    if regla['minimo'] is not None and regla['maximo'] is not None and regla['minimo'] >= regla['maximo']:
+        raise ReglaInvalida("El mínimo debe ser menor que el máximo")
+    if regla['histeresis'] < 0:
+        raise ReglaInvalida("histeresis no puede ser negativa")
+    # Con los dos límites el margen de vuelta (mínimo + h, máximo - h) no
+    # puede quedar vacío: la alerta activa no se normalizaría nunca
+    if (regla['minimo'] is not None and regla['maximo'] is not None
+            and regla['histeresis'] * 2 >= regla['maximo'] - regla['minimo']):
+        raise ReglaInvalida("histeresis debe ser menor que la mitad del rango (máximo - mínimo)")
+    if not 0 <= regla['espera'] <= ESPERA_MAXIMA:
+        raise ReglaInvalida(f"espera debe estar entre 0 y {ESPERA_MAXIMA} segundos")
+    regla['espera'] = int(regla['espera'])
+    return regla
+
+
+def guardar(sistema_id, reglas_nuevas):
+    """Guardar reglas ya validadas ({metrica: regla}) y actualizar la caché"""
+    guardar_reglas_alerta(sistema_id, reglas_nuevas)
+    return vigentes(sistema_id)
+
@@ -0,0 +1,156 @@
+"""
+Analítica del histórico de lecturas con NumPy
+
+La ventana pedida se carga una sola vez en arrays por columna (NaN donde la
+lectura no trae el valor) y todas las estadísticas se calculan con
+operaciones vectorizadas sobre esos arrays.
+"""
+
+import os
+
+import numpy as np
+
+from database import COLUMNAS_LECTURA, iterar_lecturas
+
+# Rangos aceptables (los mismos que muestra el dashboard en systemData)
+RANGOS = {
+    'ph': (5.5, 8.5),
+    'temperatura': (18.0, 26.0),
+}
+
+COLUMNAS_NUMERICAS = ('nivel_agua', 'ph', 'temperatura', 'nivel_nutrientes')
+COLUMNAS_BOOLEANAS = ('irrigacion_activa', 'luz_activa')
+
+# Días como máximo de una ventana de analítica (limita la memoria por petición)
+MAX_DIAS = float(os.environ.get('CAEC_ANALITICA_MAX_DIAS', 31))
+
+
+def cargar_ventana(sistema_id, desde, hasta):
+    """Lecturas crudas de [desde, hasta) como arrays columnares
+
+    Devuelve (t, columnas): t son segundos epoch (float64, ordenados) y
+    columnas un diccionario columna -> float64 con NaN en los valores nulos.
+    """
+    tiempos = []
+    valores = []
+    # Los timestamps (datetime en PostgreSQL, texto en SQLite) se convierten por lote
+    for lote in iterar_lecturas(sistema_id, desde, hasta, tamano_lote=5000, convertir_timestamp=False):
+        tiempos.append(np.array([fila[0] for fila in lote], dtype='datetime64[s]'))
+        # None -> NaN y booleanos -> 0/1 al convertir a float
+        valores.append(np.array([fila[1:] for fila in lote], dtype=np.float64))
+
+    if not tiempos:
+        vacio = np.empty(0, dtype=np.float64)
+        return vacio, {columna: vacio for columna in COLUMNAS_LECTURA}
+
+    t = np.concatenate(tiempos).astype(np.int64).astype(np.float64)
+    matriz = np.concatenate(valores)
+    return t, {columna: matriz[:, indice] for indice, columna in enumerate(COLUMNAS_LECTURA)}
+
+
+def _duraciones(t, intervalo):
+    """Tiempo que representa cada lectura: hasta la siguiente, sin contar los huecos
+
+    Un hueco mayor que 3 intervalos (controlador desconectado) cuenta como un
+    intervalo, igual que la última lectura de la ventana.
+    """
+    if t.size == 0:
+        return t
+    duracion = np.empty_like(t)
+    duracion[:-1] = np.diff(t)
+    duracion[-1] = intervalo
+    duracion[duracion > 3 * intervalo] = intervalo
+    return duracion
+
+
+def _medias_moviles(t, valores, instantes, ventana):
+    """Media de los valores en (T - ventana, T] para cada instante T"""
+    validos = ~np.isnan(valores)
+    t, valores = t[validos], valores[validos]
+    if t.size == 0:
+        return np.full(instantes.size, np.nan)
+
+    acumulado = np.concatenate(([0.0], np.cumsum(valores)))
+    derecha = np.searchsorted(t, instantes, side='right')
+    izquierda = np.searchsorted(t, instantes - ventana, side='right')
+    cuenta = derecha - izquierda
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (acumulado[derecha] - acumulado[izquierda]) / cuenta
+
+
+def _tasa_cambio(t, valores):
+    """Pendiente de la recta de ajuste y mayor cambio entre lecturas, por hora"""
+    validos = ~np.isnan(valores)
+    t, valores = t[validos], valores[validos]
+    if t.size < 2 or t[-1] == t[0]:
+        return {'tendencia_por_hora': None, 'max_por_hora': None}
+
+    horas = (t - t[0]) / 3600.0
+    pendiente = np.polyfit(horas, valores, 1)[0]
+    dt = np.diff(horas)
+    cambios = np.abs(np.diff(valores)[dt > 0] / dt[dt > 0])
+    return {
+        'tendencia_por_hora': float(pendiente),
+        'max_por_hora': float(cambios.max()) if cambios.size else None,
+    }
+
+
+def _numero(valor):
+    return None if valor is None or np.isnan(valor) else float(valor)
+
+
+def calcular_analitica(t, columnas, desde, hasta, intervalo, ventana=3600, puntos=100):
+    """Estadísticas de la ventana a partir de los arrays de cargar_ventana()"""
+    # desde/hasta son datetime UTC sin zona, como los timestamps de sensor_data
+    inicio = float(np.datetime64(desde, 's').astype(np.int64))
+    fin = float(np.datetime64(hasta, 's').astype(np.int64))
+    duracion = _duraciones(t, intervalo)
+
+    resultado = {'lecturas': int(t.size), 'metricas': {}}
+    instantes = np.linspace(inicio, fin, puntos)
+    for columna in COLUMNAS_NUMERICAS:
+        valores = columnas[columna]
+        validos = ~np.isnan(valores)
+        cuenta = int(validos.sum())
+        metrica = {'count': cuenta}
+        if cuenta:
+            datos = valores[validos]
+            metrica.update({
+                'mean': float(datos.mean()),
+                'min': float(datos.min()),
+                'max': float(datos.max()),
+                'std': float(datos.std()),
+            })
+        else:
+            metrica.update({'mean': None, 'min': None, 'max': None, 'std': None})
+
+        medias = _medias_moviles(t, valores, instantes, ventana)
+        metrica['media_movil'] = [_numero(valor) for valor in medias]
+        metrica['tasa_cambio'] = _tasa_cambio(t, valores)
+
+        if columna in RANGOS:
+            minimo, maximo = RANGOS[columna]
+            tiempo_total = duracion[validos].sum()
+            fuera = validos & ((valores < minimo) | (valores > maximo))
+            metrica['rango'] = {'min': minimo, 'max': maximo}
+            metrica['fraccion_fuera_rango'] = (
+                float(duracion[fuera].sum() / tiempo_total) if tiempo_total > 0 else None
+            )
+        resultado['metricas'][columna] = metrica
+
+    for columna in COLUMNAS_BOOLEANAS:
+        valores = columnas[columna]
+        validos = ~np.isnan(valores)
+        tiempo_total = duracion[validos].sum()
+        resultado['metricas'][columna] = {
+            'count': int(validos.sum()),
+            'fraccion_activa': (
+                float(duracion[validos & (valores > 0)].sum() / tiempo_total) if tiempo_total > 0 else None
+            ),
+        }
+
+    resultado['media_movil'] = {
+        'ventana_segundos': ventana,
+        'instantes': [f'{instante}Z' for instante in instantes.astype('datetime64[s]').astype(str)],
+    }
+    return resultado
@@ -1,15 +1,64 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify
+import calendar
+import json
 import os
+import secrets
+import time
+from datetime import timedelta
 from database import (
-    init_db, crear_usuario, verificar_usuario, obtener_sistema_usuario,
+    crear_usuario, verificar_usuario, obtener_sistema_usuario,
     validar_codigo_sistema, vincular_sistema_usuario, actualizar_ultimo_sync
 )
+from admision import controlar_admision
+import cooperativo
+import metricas
+from migraciones import comprobar_esquema
+from respuestas import optimizar_respuestas
+from retencion import iniciar_mantenimiento
+from seguridad import ServidorOcupado
+from ingesta import (
+    ASINCRONA, INTERVALO_LECTURAS, RETRY_AFTER, IngestaSaturada, LecturaInvalida, encolar_lote,
+    hub_lecturas, iniciar_sondeo, normalizar_lote, obtener_lectura_actual, parsear_timestamp,
+    procesar_lote
+)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'caec_secret_key_2024')  # Usa variable de entorno en producción
 
-# Inicializar base de datos al iniciar la aplicación
-init_db()
+# Mensaje cuando el pool de hashing de contraseñas está saturado
+MENSAJE_OCUPADO = 'El servidor está ocupado, intenta de nuevo en unos segundos'
+
+# Parámetros del stream de datos en vivo (Server-Sent Events)
+SSE_HEARTBEAT = float(os.environ.get('CAEC_SSE_HEARTBEAT', 15))
+SSE_DURACION = float(os.environ.get('CAEC_SSE_DURACION', 300))
+SSE_RETRY_MS = 3000
+
+# Conexiones largas (stream SSE y long-poll de los controladores): solo con
+# workers cooperativos (gevent). Con workers sync cada una ocupa un worker
+# entero y gunicorn la corta al vencer su timeout, así que el dashboard
+# sondea cada SONDEO_MS y el long-poll responde al momento.
+# CAEC_CONEXIONES_LARGAS=1 las fuerza y 0 las desactiva
+_conexiones_largas = os.environ.get('CAEC_CONEXIONES_LARGAS', 'auto')
+CONEXIONES_LARGAS = cooperativo.activo() if _conexiones_largas == 'auto' else _conexiones_largas == '1'
+SONDEO_MS = 5000
+
+# Comprobar (y si hace falta migrar) el esquema al iniciar la aplicación
+comprobar_esquema()
+
+# El hilo de mantenimiento del histórico se arranca en la primera petición de
+# cada worker (un hilo creado al importar no sobreviviría al fork de gunicorn)
+@app.before_request
+def arrancar_mantenimiento():
+    iniciar_mantenimiento()
+
+# Latencia por endpoint y peticiones en curso (expuestas en /metrics)
+metricas.instrumentar(app)
+
+# ETag/304 para las respuestas JSON y compresión gzip/deflate (ver respuestas.py)
+optimizar_respuestas(app)
+
+# Límites de concurrencia por clase de ruta y 503 inmediato para el polling (ver admision.py)
+controlar_admision(app, MENSAJE_OCUPADO)
 
 # Ruta para la página de inicio - redirige directamente al login
 @app.route('/')
@@ -37,7 +86,10 @@ def register():
             return render_template('register.html', error='La contraseña debe tener al menos 4 caracteres')
 
         # Crear usuario
-        user_id = crear_usuario(nombre, apellido, email, password)
+        try:
+            user_id = crear_usuario(nombre, apellido, email, password)
+        except ServidorOcupado:
+            return render_template('register.html', error=MENSAJE_OCUPADO), 503, {'Retry-After': '5'}
 
         if user_id:
             # Guardar en sesión
@@ -65,7 +117,10 @@ def login():
             return render_template('login.html', error='Por favor ingresa email y contraseña')
 
         # Verificar credenciales
-        usuario = verificar_usuario(email, password)
+        try:
+            usuario = verificar_usuario(email, password)
+        except ServidorOcupado:
+            return render_template('login.html', error=MENSAJE_OCUPADO), 503, {'Retry-After': '5'}
 
         if usuario:
             # Guardar información del usuario en sesión
@@ -122,7 +177,12 @@ def inicio():
         else:
             return redirect(url_for('add_system'))
 
-    return render_template('inicio.html', user_name=session.get('user_name', 'Usuario'))
+    return render_template(
+        'inicio.html',
+        user_name=session.get('user_name', 'Usuario'),
+        live_stream=CONEXIONES_LARGAS,
+        poll_ms=SONDEO_MS
+    )
 
 # Ruta para cerrar sesión
 @app.route('/logout')
@@ -130,45 +190,646 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 
-# API para obtener datos del sistema (para futuro uso con sensores reales)
+# Formato ISO 8601 (UTC) para los timestamps de la API
+def iso_utc(momento):
+    return momento.strftime('%Y-%m-%dT%H:%M:%SZ') if momento else None
+
+# Convertir una lectura de sensor_data al formato JSON del dashboard
+def datos_lectura(lectura):
+    def booleano(valor):
+        return None if valor is None else bool(valor)
+
+    lectura = lectura or {}
+    return {
+        'waterLevel': lectura.get('nivel_agua'),
+        'phLevel': lectura.get('ph'),
+        'waterTemp': lectura.get('temperatura'),
+        'nutrientLevel': lectura.get('nivel_nutrientes'),
+        'irrigationActive': booleano(lectura.get('irrigacion_activa')),
+        'lightActive': booleano(lectura.get('luz_activa')),
+        'timestamp': iso_utc(lectura.get('timestamp'))
+    }
+
+# API para obtener la última lectura del sistema activo (servida desde caché)
 @app.route('/api/system-data')
 def system_data():
-    # Aquí se integrarían los datos reales de los sensores
-    data = {
-        'waterLevel': 75,
-        'phLevel': 6.5,
-        'waterTemp': 22,
-        'nutrientLevel': 85,
-        'irrigationActive': True,
-        'lightActive': True,
-        'timestamp': 'now'
-    }
-    return jsonify(data)
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    return jsonify(datos_lectura(obtener_lectura_actual(session['sistema_id'])))
+
+# Stream SSE con las lecturas del sistema activo (solo envía lo que cambia)
+@app.route('/api/system-data/stream')
+def system_data_stream():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
 
-# API para actualizar configuración del sistema
+    sistema_id = session['sistema_id']
+    try:
+        ultimo_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        ultimo_id = None
+
+    def evento(id_evento, datos):
+        return f"id: {id_evento}\ndata: {json.dumps(datos)}\n\n"
+
+    def generar():
+        # Suscribirse antes de leer la instantánea para no perder lecturas
+        suscripcion = hub_lecturas.suscribir(sistema_id)
+        iniciar_sondeo()
+        try:
+            yield f"retry: {SSE_RETRY_MS if CONEXIONES_LARGAS else SONDEO_MS}\n\n"
+
+            ultimo = ultimo_id
+            enviado = {}
+
+            # Al conectar (o reconectar) se envía la instantánea completa si
+            # es más nueva que el último evento que recibió el cliente
+            lectura = obtener_lectura_actual(sistema_id)
+            if lectura:
+                id_evento = calendar.timegm(lectura['timestamp'].timetuple())
+                if ultimo is None or id_evento > ultimo:
+                    enviado = datos_lectura(lectura)
+                    ultimo = id_evento
+                    yield evento(id_evento, enviado)
+
+            # Sin workers cooperativos se cierra tras la instantánea: el
+            # navegador reconecta cada SONDEO_MS, como el polling
+            fin = time.monotonic() + (SSE_DURACION if CONEXIONES_LARGAS else 0)
+            while time.monotonic() < fin:
+                lectura = suscripcion.esperar(timeout=SSE_HEARTBEAT)
+                if lectura is None:
+                    # Heartbeat: mantiene viva la conexión a través de proxies
+                    yield ": heartbeat\n\n"
+                    continue
+
+                id_evento = calendar.timegm(lectura['timestamp'].timetuple())
+                if ultimo is not None and id_evento < ultimo:
+                    continue
+
+                datos = datos_lectura(lectura)
+                cambios = {
+                    clave: valor for clave, valor in datos.items()
+                    if clave != 'timestamp' and enviado.get(clave) != valor
+                }
+                enviado = datos
+                ultimo = id_evento
+                if cambios:
+                    cambios['timestamp'] = datos['timestamp']
+                    yield evento(id_evento, cambios)
+        finally:
+            hub_lecturas.cancelar(suscripcion)
+
+    # El stream se cierra tras SSE_DURACION segundos; el navegador reconecta
+    # solo y envía Last-Event-ID
+    return Response(
+        generar(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Verificar el token de los controladores (sin CAEC_DEVICE_TOKEN no se acepta ninguno)
+def dispositivo_autorizado():
+    token = os.environ.get('CAEC_DEVICE_TOKEN')
+    if not token:
+        return False
+    return secrets.compare_digest(request.headers.get('X-Device-Token', ''), token)
+
+# API de ingesta de lecturas enviadas por los controladores
+@app.route('/api/sensor-data', methods=['POST'])
+def sensor_data():
+    if not dispositivo_autorizado():
+        return jsonify({'success': False, 'message': 'Dispositivo no autorizado'}), 401
+
+    try:
+        lecturas = normalizar_lote(request.get_json(silent=True))
+    except LecturaInvalida as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    # Con la escritura diferida se responde 202 al encolar; si la cola está
+    # llena, 429 para que el controlador reintente más tarde
+    if ASINCRONA:
+        try:
+            aceptadas, desconocidos = encolar_lote(lecturas)
+        except IngestaSaturada:
+            return jsonify({
+                'success': False,
+                'message': 'Cola de ingesta llena, reintenta más tarde'
+            }), 429, {'Retry-After': str(RETRY_AFTER)}
+    else:
+        aceptadas, desconocidos = procesar_lote(lecturas)
+
+    if desconocidos:
+        return jsonify({
+            'success': False,
+            'message': 'Sistemas no registrados',
+            'sistemas': desconocidos
+        }), 404
+
+    if ASINCRONA:
+        return jsonify({'success': True, 'aceptadas': aceptadas}), 202
+    return jsonify({'success': True, 'insertadas': aceptadas})
+
+# Rango [desde, hasta) de los parámetros desde/hasta (ISO 8601 o epoch) o de
+# los últimos `dias` (parámetro dias o el valor por defecto) hasta ahora
+def rango_de_peticion(dias):
+    try:
+        hasta = parsear_timestamp(request.args.get('hasta'))
+        if request.args.get('desde'):
+            desde = parsear_timestamp(request.args.get('desde'))
+        else:
+            desde = hasta - timedelta(days=request.args.get('dias', dias, type=float))
+    except OverflowError as e:
+        raise LecturaInvalida(str(e))
+    return desde, hasta
+
+# API de histórico de sensores con resolución adaptada al rango pedido
+@app.route('/api/sensor-history')
+def sensor_history():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from database import COLUMNAS_LECTURA, elegir_resolucion, obtener_historial
+
+    try:
+        desde, hasta = rango_de_peticion(dias=1)
+    except LecturaInvalida as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    max_puntos = min(max(request.args.get('puntos', 500, type=int), 10), 5000)
+    metricas = request.args.get('metricas')
+    columnas = tuple(metricas.split(',')) if metricas else COLUMNAS_LECTURA
+    if not columnas or any(columna not in COLUMNAS_LECTURA for columna in columnas):
+        return jsonify({'success': False, 'message': 'Métricas no válidas'}), 400
+    if desde >= hasta:
+        return jsonify({'success': False, 'message': 'Rango de tiempo no válido'}), 400
+
+    resolucion = elegir_resolucion(desde, hasta, max_puntos, INTERVALO_LECTURAS)
+    puntos = obtener_historial(session['sistema_id'], desde, hasta, resolucion, max_puntos, columnas)
+
+    for punto in puntos:
+        punto['timestamp'] = iso_utc(punto['timestamp'])
+
+    return jsonify({
+        'success': True,
+        'resolucion': resolucion,
+        'desde': iso_utc(desde),
+        'hasta': iso_utc(hasta),
+        'puntos': puntos
+    })
+
+# Exportación del histórico crudo (CSV o JSON Lines) generada por trozos
+@app.route('/api/export')
+def export_history():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from database import obtener_todos_sistemas_usuario
+    from exportacion import FORMATOS, generar_exportacion
+
+    sistema_id = request.args.get('sistema_id', session['sistema_id'], type=int)
+    if sistema_id != session['sistema_id'] and not any(
+            sistema['id'] == sistema_id for sistema in obtener_todos_sistemas_usuario(session['user_id'])):
+        return jsonify({'success': False, 'message': 'Sistema no encontrado'}), 404
+
+    formato = request.args.get('formato', 'csv')
+    if formato not in FORMATOS:
+        return jsonify({'success': False, 'message': 'Formato no válido (csv o jsonl)'}), 400
+
+    try:
+        desde, hasta = rango_de_peticion(dias=30)
+    except LecturaInvalida as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if desde >= hasta:
+        return jsonify({'success': False, 'message': 'Rango de tiempo no válido'}), 400
+
+    tipo, extension = FORMATOS[formato]
+    nombre = f"caec_{sistema_id}_{desde:%Y%m%d}_{hasta:%Y%m%d}.{extension}"
+    headers = {'Cache-Control': 'no-store'}
+
+    # gzip=1 descarga un .gz; si no, se comprime en tránsito cuando el cliente lo acepta
+    if request.args.get('gzip') == '1':
+        comprimir = True
+        tipo = 'application/gzip'
+        nombre += '.gz'
+    else:
+        comprimir = request.accept_encodings['gzip'] > 0
+        if comprimir:
+            headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    headers['Content-Disposition'] = f'attachment; filename="{nombre}"'
+
+    return Response(
+        generar_exportacion(sistema_id, desde, hasta, formato, comprimir),
+        content_type=tipo,
+        headers=headers
+    )
+
+# Estadísticas del histórico de una ventana (calculadas con NumPy)
+@app.route('/api/analytics')
+def analytics():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from analitica import MAX_DIAS, calcular_analitica, cargar_ventana
+
+    try:
+        desde, hasta = rango_de_peticion(dias=1)
+    except LecturaInvalida as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if desde >= hasta:
+        return jsonify({'success': False, 'message': 'Rango de tiempo no válido'}), 400
+    if hasta - desde > timedelta(days=MAX_DIAS):
+        return jsonify({'success': False, 'message': f'El rango máximo es de {MAX_DIAS:g} días'}), 400
+
+    ventana = min(max(request.args.get('ventana', 3600, type=float), INTERVALO_LECTURAS), 7 * 86400)
+    puntos = min(max(request.args.get('puntos', 100, type=int), 2), 1000)
+
+    t, columnas = cargar_ventana(session['sistema_id'], desde, hasta)
+    resultado = calcular_analitica(t, columnas, desde, hasta, INTERVALO_LECTURAS, ventana, puntos)
+
+    return jsonify({
+        'success': True,
+        'desde': iso_utc(desde),
+        'hasta': iso_utc(hasta),
+        **resultado
+    })
+
+# Órdenes del dashboard que se encolan como comandos para el controlador
+COMANDOS_DASHBOARD = {
+    'irrigation': 'irrigacion',
+    'light': 'luz',
+}
+
+# API para actualizar configuración del sistema: encola los comandos que el
+# controlador recoge con /api/device/commands
 @app.route('/api/update-system', methods=['POST'])
 def update_system():
-    data = request.get_json()
-    # Aquí se enviarían los comandos al sistema físico
-    return jsonify({'status': 'success', 'message': 'Configuración actualizada'})
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from comandos import encolar
+
+    data = request.get_json(silent=True) or {}
+    ordenes = [
+        (tipo, data[clave]) for clave, tipo in COMANDOS_DASHBOARD.items()
+        if isinstance(data.get(clave), dict) and isinstance(data[clave].get('status'), bool)
+    ]
+    if not ordenes:
+        return jsonify({'status': 'error', 'success': False, 'message': 'Ningún comando válido'}), 400
+
+    comandos = [
+        encolar(session['sistema_id'], tipo, {'activa': orden['status']})
+        for tipo, orden in ordenes
+    ]
+    return jsonify({
+        'status': 'success',
+        'success': True,
+        'message': 'Configuración actualizada',
+        'comandos': comandos
+    })
+
+# Long-poll de comandos para los controladores: responde en cuanto hay
+# comandos sin confirmar posteriores a `despues` o al vencer la espera
+@app.route('/api/device/commands')
+def device_commands():
+    if not dispositivo_autorizado():
+        return jsonify({'success': False, 'message': 'Dispositivo no autorizado'}), 401
+
+    from comandos import ESPERA_MAXIMA, esperar_comandos
+
+    sistema_id = request.args.get('sistema_id', type=int)
+    if not sistema_id:
+        return jsonify({'success': False, 'message': 'sistema_id no válido'}), 400
+    despues = max(request.args.get('despues', 0, type=int), 0)
+    # Sin workers cooperativos no se retiene el worker: se responde al momento
+    limite = ESPERA_MAXIMA if CONEXIONES_LARGAS else 0
+    espera = min(max(request.args.get('espera', limite, type=float), 0), limite)
+
+    comandos = esperar_comandos(sistema_id, despues, espera)
+    return jsonify({
+        'success': True,
+        'comandos': [
+            {
+                'id': comando['id'],
+                'tipo': comando['tipo'],
+                'payload': comando['payload'],
+                'creado': iso_utc(comando['creado'])
+            }
+            for comando in comandos
+        ]
+    })
+
+# Confirmación acumulativa: todos los comandos con id <= hasta
+@app.route('/api/device/commands/ack', methods=['POST'])
+def device_commands_ack():
+    if not dispositivo_autorizado():
+        return jsonify({'success': False, 'message': 'Dispositivo no autorizado'}), 401
+
+    from comandos import confirmar
+
+    data = request.get_json(silent=True) or {}
+    sistema_id, hasta = data.get('sistema_id'), data.get('hasta')
+    if (isinstance(sistema_id, bool) or not isinstance(sistema_id, int)
+            or isinstance(hasta, bool) or not isinstance(hasta, int)):
+        return jsonify({'success': False, 'message': 'sistema_id y hasta deben ser enteros'}), 400
+
+    return jsonify({'success': True, 'confirmados': confirmar(sistema_id, hasta)})
+
+# Nombres de la configuración de irrigación en el dashboard
+CAMPOS_CONFIG_IRRIGACION = {
+    'savingPower': 'potencia_ahorro',
+    'savingDuration': 'duracion_ahorro',
+    'abundantDuration': 'duracion_abundante',
+}
+
+def datos_config_irrigacion(config):
+    datos = {campo: config[columna] for campo, columna in CAMPOS_CONFIG_IRRIGACION.items()}
+    datos['version'] = config['version']
+    return datos
+
+# API para leer la configuración de irrigación del sistema activo
+@app.route('/api/irrigation-config')
+def irrigation_config():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from configuracion import config_actual
+
+    config = config_actual(session['sistema_id'])
+    if config is None:
+        return jsonify({'success': False, 'message': 'Sistema no encontrado'}), 404
+    return jsonify({'success': True, 'config': datos_config_irrigacion(config)})
 
 # API para actualizar configuración de irrigación
 @app.route('/api/update-irrigation-config', methods=['POST'])
 def update_irrigation_config():
-    data = request.get_json()
-    config = data.get('config', {})
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
 
-    # Aquí se guardaría la configuración en una base de datos
-    # y se enviarían los parámetros al controlador del sistema físico
-    print(f"Nueva configuración de irrigación:")
-    print(f"  - Potencia en modo ahorro: {config.get('savingPower')}%")
-    print(f"  - Duración modo ahorro: {config.get('savingDuration')} minutos")
-    print(f"  - Duración irrigación abundante: {config.get('abundantDuration')} minutos")
+    from configuracion import ConfigInvalida, guardar, validar
+
+    data = request.get_json(silent=True) or {}
+    config = data.get('config') or {}
+    try:
+        valores = validar({columna: config.get(campo) for campo, columna in CAMPOS_CONFIG_IRRIGACION.items()})
+    except ConfigInvalida as e:
+        return jsonify({'status': 'error', 'success': False, 'message': str(e)}), 400
+
+    # Los controladores la recogen en /api/device/irrigation-config
+    guardada = guardar(session['sistema_id'], valores)
 
     return jsonify({
         'status': 'success',
+        'success': True,
         'message': 'Configuración de irrigación guardada',
-        'config': config
+        'config': datos_config_irrigacion(guardada)
+    })
+
+# Configuración de irrigación para los controladores, con petición condicional:
+# si If-None-Match coincide con la versión en caché se responde 304 sin cuerpo
+@app.route('/api/device/irrigation-config')
+def device_irrigation_config():
+    if not dispositivo_autorizado():
+        return jsonify({'success': False, 'message': 'Dispositivo no autorizado'}), 401
+
+    from configuracion import config_actual, etag
+    from respuestas import etag_solicitado
+
+    sistema_id = request.args.get('sistema_id', type=int)
+    if not sistema_id:
+        return jsonify({'success': False, 'message': 'sistema_id no válido'}), 400
+
+    config = config_actual(sistema_id)
+    if config is None:
+        return jsonify({'success': False, 'message': 'Sistema no registrado'}), 404
+
+    version = etag(config)
+    solicitado = etag_solicitado(version)
+    if solicitado:
+        respuesta = Response(status=304)
+        respuesta.set_etag(solicitado)
+    else:
+        respuesta = jsonify({
+            'success': True,
+            'sistema_id': sistema_id,
+            'version': config['version'],
+            'config': {columna: config[columna] for columna in CAMPOS_CONFIG_IRRIGACION.values()}
+        })
+        respuesta.set_etag(version)
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    return respuesta
+
+# Progreso de la cosecha al formato JSON del dashboard
+def datos_cosecha(progreso):
+    return {
+        'cropType': progreso['cultivo'],
+        'cropName': progreso['nombre'],
+        'plantDate': iso_utc(progreso['fecha_siembra']),
+        'estimatedHarvestDate': iso_utc(progreso['fecha_estimada']),
+        'progress': progreso['progreso'],
+        'daysRemaining': None if progreso['dias_restantes'] is None else round(progreso['dias_restantes'], 1),
+        'degreeDays': round(progreso['grados_dia'], 1),
+        'degreeDaysTarget': progreso['grados_dia_objetivo'],
+        'lightHours': round(progreso['horas_luz'], 1),
+        'lightHoursTarget': progreso['horas_luz_objetivo'],
+        'updated': iso_utc(progreso['actualizado'])
+    }
+
+# API con el progreso de la cosecha del sistema activo (acumulado por la ingesta)
+@app.route('/api/harvest')
+def harvest():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from cosecha import progreso_actual
+
+    return jsonify({'success': True, 'harvest': datos_cosecha(progreso_actual(session['sistema_id']))})
+
+# API para empezar un cultivo nuevo en el sistema activo
+@app.route('/api/start-harvest', methods=['POST'])
+def start_harvest():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from cosecha import CultivoInvalido, iniciar
+
+    data = request.get_json(silent=True) or {}
+    try:
+        fecha_siembra = parsear_timestamp(data['plantDate']) if data.get('plantDate') else None
+        progreso = iniciar(session['sistema_id'], data.get('cropType'), fecha_siembra)
+    except (CultivoInvalido, LecturaInvalida) as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    return jsonify({
+        'success': True,
+        'message': 'Cultivo iniciado',
+        'harvest': datos_cosecha(progreso)
+    })
+
+# Métricas con reglas de alerta: campo del dashboard -> columna de sensor_data
+METRICAS_ALERTA = {
+    'water': 'nivel_agua',
+    'ph': 'ph',
+    'temperature': 'temperatura',
+    'nutrient': 'nivel_nutrientes',
+}
+
+# Campos de una regla en la API -> claves de alertas.validar()
+CAMPOS_REGLA_ALERTA = {
+    'min': 'minimo',
+    'max': 'maximo',
+    'hysteresis': 'histeresis',
+    'delay': 'espera',
+    'enabled': 'activa',
+}
+
+# Notificaciones por página en /api/notifications (el parámetro `limite` admite hasta 100)
+NOTIFICACIONES_POR_PAGINA = 20
+
+def datos_reglas_alerta(reglas):
+    campo_de = {columna: campo for campo, columna in METRICAS_ALERTA.items()}
+    return {
+        campo_de[metrica]: {campo: regla[clave] for campo, clave in CAMPOS_REGLA_ALERTA.items()}
+        for metrica, regla in reglas.items()
+    }
+
+def datos_notificacion(notificacion):
+    campo_de = {columna: campo for campo, columna in METRICAS_ALERTA.items()}
+    return {
+        'id': notificacion['id'],
+        'metric': campo_de.get(notificacion['metrica']),
+        'type': notificacion['tipo'],
+        'message': notificacion['mensaje'],
+        'value': notificacion['valor'],
+        'time': iso_utc(notificacion['creada']),
+        'read': notificacion['leida']
+    }
+
+# API con las notificaciones de alertas del sistema activo (de la más nueva a la más antigua)
+@app.route('/api/notifications')
+def notifications():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from database import obtener_notificaciones
+
+    limite = min(max(request.args.get('limite', NOTIFICACIONES_POR_PAGINA, type=int), 1), 100)
+    antes = request.args.get('antes', type=int)
+    lista, sin_leer = obtener_notificaciones(session['sistema_id'], limite, antes)
+
+    return jsonify({
+        'success': True,
+        'notifications': [datos_notificacion(notificacion) for notificacion in lista],
+        'unread': sin_leer,
+        # Se pasa como ?antes=<id> para la página siguiente
+        'next': lista[-1]['id'] if len(lista) == limite else None
+    })
+
+# API para marcar como leídas las notificaciones del sistema activo hasta un id
+@app.route('/api/read-notifications', methods=['POST'])
+def read_notifications():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from database import marcar_notificaciones_leidas
+
+    data = request.get_json(silent=True) or {}
+    hasta = data.get('upTo')
+    if isinstance(hasta, bool) or not isinstance(hasta, int):
+        return jsonify({'success': False, 'message': 'upTo debe ser el id de una notificación'}), 400
+
+    marcadas = marcar_notificaciones_leidas(session['sistema_id'], hasta)
+    return jsonify({'success': True, 'marked': marcadas})
+
+# API con las reglas de alerta vigentes del sistema activo
+@app.route('/api/alert-rules')
+def alert_rules():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from alertas import reglas_de
+
+    reglas = reglas_de([session['sistema_id']])[session['sistema_id']]
+    return jsonify({'success': True, 'rules': datos_reglas_alerta(reglas)})
+
+# API para guardar reglas de alerta propias del sistema activo (solo las métricas enviadas)
+@app.route('/api/update-alert-rules', methods=['POST'])
+def update_alert_rules():
+    if 'user_id' not in session or 'sistema_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    from alertas import ReglaInvalida, guardar, validar, vigentes
+
+    data = request.get_json(silent=True) or {}
+    reglas = data.get('rules')
+    if not isinstance(reglas, dict) or not reglas:
+        return jsonify({'success': False, 'message': "Se requiere un objeto 'rules'"}), 400
+
+    # Los campos que no se envían conservan su valor actual
+    actuales = vigentes(session['sistema_id'])
+    validadas = {}
+    try:
+        for campo, regla in reglas.items():
+            if campo not in METRICAS_ALERTA:
+                raise ReglaInvalida(f"Métrica no válida: {campo}")
+            if not isinstance(regla, dict):
+                raise ReglaInvalida(f"{campo}: la regla debe ser un objeto")
+            valores = {clave: regla[nombre] for nombre, clave in CAMPOS_REGLA_ALERTA.items() if nombre in regla}
+            try:
+                metrica = METRICAS_ALERTA[campo]
+                validadas[metrica] = validar(metrica, valores, actuales[metrica])
+            except ReglaInvalida as e:
+                raise ReglaInvalida(f"{campo}: {e}")
+    except ReglaInvalida as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    return jsonify({
+        'success': True,
+        'message': 'Reglas de alerta guardadas',
+        'rules': datos_reglas_alerta(guardar(session['sistema_id'], validadas))
     })
 
 # API para validar código de sistema
@@ -321,19 +982,73 @@ def change_password():
 
     # Verificar contraseña actual
     from database import verificar_usuario, cambiar_password
-    usuario = verificar_usuario(session['user_email'], current_password)
+    try:
+        usuario = verificar_usuario(session['user_email'], current_password)
 
-    if not usuario:
-        return render_template('config.html', error='La contraseña actual es incorrecta')
+        if not usuario:
+            return render_template('config.html', error='La contraseña actual es incorrecta')
 
-    # Cambiar contraseña
-    success = cambiar_password(session['user_id'], new_password)
+        # Cambiar contraseña
+        success = cambiar_password(session['user_id'], new_password)
+    except ServidorOcupado:
+        return render_template('config.html', error=MENSAJE_OCUPADO), 503, {'Retry-After': '5'}
 
     if success:
         return render_template('config.html', success='Contraseña cambiada correctamente')
     else:
         return render_template('config.html', error='Error al cambiar la contraseña')
 
+# Sistemas por página de la vista de flota (el parámetro limite admite hasta FLOTA_MAXIMO)
+FLOTA_POR_PAGINA = int(os.environ.get('CAEC_FLOTA_POR_PAGINA', 50))
+FLOTA_MAXIMO = 200
+
+# Página de la flota del usuario según los parámetros despues/estado/modelo/limite
+# (lanza ValueError si el cursor no es válido)
+def pagina_flota():
+    from database import obtener_flota
+
+    limite = min(max(request.args.get('limite', FLOTA_POR_PAGINA, type=int), 1), FLOTA_MAXIMO)
+    return obtener_flota(
+        session['user_id'], limite,
+        despues=request.args.get('despues') or None,
+        estado=request.args.get('estado') or None,
+        modelo=request.args.get('modelo') or None,
+    )
+
+# Convertir un sistema de la flota al formato JSON de la API
+def datos_sistema_flota(sistema):
+    return {
+        'id': sistema['id'],
+        'codigo': sistema['codigo_sistema'],
+        'nombre': sistema['nombre_sistema'],
+        'estado': sistema['estado'],
+        'modelo': sistema['modelo'],
+        'firmware': sistema['version_firmware'],
+        'vinculado': iso_utc(sistema['fecha_vinculacion']),
+        'ultimoSync': iso_utc(sistema['ultimo_sync']),
+        'ultimaLectura': datos_lectura(sistema['ultima_lectura']) if sistema['ultima_lectura'] else None,
+    }
+
+# API de la flota: sistemas del usuario paginados por cursor, con su última lectura
+@app.route('/api/fleet')
+def fleet():
+    if 'user_id' not in session:
+        return jsonify({
+            'success': False,
+            'message': 'Usuario no autenticado'
+        })
+
+    try:
+        sistemas, siguiente = pagina_flota()
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Cursor de página no válido'}), 400
+
+    return jsonify({
+        'success': True,
+        'sistemas': [datos_sistema_flota(sistema) for sistema in sistemas],
+        'siguiente': siguiente
+    })
+
 # Ruta para Sistemas CAEC
 @app.route('/systems')
 def systems():
@@ -341,13 +1056,13 @@ def systems():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    # Obtener todos los sistemas del usuario
-    from database import obtener_todos_sistemas_usuario, obtener_sistema_activo
-
-    active_system = obtener_sistema_activo(session['user_id'])
-    other_systems = obtener_todos_sistemas_usuario(session['user_id'], exclude_active=True)
+    try:
+        sistemas, siguiente = pagina_flota()
+    except ValueError:
+        return redirect(url_for('systems'))
 
-    return render_template('systems.html', active_system=active_system, other_systems=other_systems)
+    return render_template('systems.html', systems=sistemas, next_cursor=siguiente,
+                           filters=request.args)
 
 # Ruta para agregar nuevo sistema
 @app.route('/add_system', methods=['POST'])
@@ -371,12 +1086,11 @@ def add_new_system():
     if system_id:
         return redirect(url_for('systems'))
     else:
-        from database import obtener_todos_sistemas_usuario, obtener_sistema_activo
-        active_system = obtener_sistema_activo(session['user_id'])
-        other_systems = obtener_todos_sistemas_usuario(session['user_id'], exclude_active=True)
+        sistemas, siguiente = pagina_flota()
         return render_template('systems.html',
-                             active_system=active_system,
-                             other_systems=other_systems,
+                             systems=sistemas,
+                             next_cursor=siguiente,
+                             filters={},
                              error='Error al crear el sistema')
 
 # Ruta para activar sistema
@@ -407,6 +1121,18 @@ def delete_system(system_id):
 
     return redirect(url_for('systems'))
 
+# Métricas en formato Prometheus, combinadas entre todos los workers
+@app.route('/metrics')
+def metrics():
+    token = os.environ.get('CAEC_METRICAS_TOKEN')
+    if token and not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('No autorizado\n', status=401, mimetype='text/plain')
+
+    return Response(
+        metricas.registro.exponer(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
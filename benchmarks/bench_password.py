@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark de login con contraseñas scrypt
+
+Ejecuta logins concurrentes a través de database.verificar_usuario contra
+una base SQLite temporal y muestra throughput, p50 y p99 para cada coste N.
+
+Uso:
+    python benchmarks/bench_password.py --n 16384 32768 --clientes 8 --logins 200
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def medir(n, clientes, logins):
+    """Lanzar un proceso hijo por coste para que seguridad lea CAEC_SCRYPT_N al importar"""
+    import subprocess
+    import json
+
+    entorno = dict(os.environ, CAEC_SCRYPT_N=str(n), PYTHONPATH=RAIZ)
+    salida = subprocess.run(
+        [sys.executable, __file__, '--interno', '--clientes', str(clientes), '--logins', str(logins)],
+        env=entorno, capture_output=True, text=True, check=True,
+    )
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def ejecutar_interno(clientes, logins):
+    import json
+
+    directorio = tempfile.mkdtemp(prefix='caec-bench-')
+    os.environ['CAEC_SQLITE_PATH'] = os.path.join(directorio, 'bench.db')
+
+    import database
+    import seguridad
+
+    database.init_db()
+    database.crear_usuario('Bench', 'Usuario', 'bench@caec.test', 'clave-bench')
+
+    latencias = []
+    errores = [0]
+    lock = threading.Lock()
+    por_cliente = max(1, logins // clientes)
+
+    def cliente():
+        for _ in range(por_cliente):
+            inicio = time.perf_counter()
+            try:
+                ok = database.verificar_usuario('bench@caec.test', 'clave-bench') is not None
+            except seguridad.ServidorOcupado:
+                ok = False
+            duracion = time.perf_counter() - inicio
+            with lock:
+                latencias.append(duracion)
+                if not ok:
+                    errores[0] += 1
+
+    hilos = [threading.Thread(target=cliente) for _ in range(clientes)]
+    inicio = time.perf_counter()
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    total = time.perf_counter() - inicio
+
+    print(json.dumps({
+        'n': seguridad.SCRYPT_N,
+        'hilos_hash': seguridad.HASH_HILOS,
+        'logins': len(latencias),
+        'errores': errores[0],
+        'logins_por_segundo': len(latencias) / total,
+        'p50_ms': statistics.median(latencias) * 1000,
+        'p99_ms': percentil(latencias, 99) * 1000,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de login con scrypt')
+    parser.add_argument('--n', type=int, nargs='+', default=[2 ** 14],
+                        help='Costes N de scrypt a comparar (potencias de 2)')
+    parser.add_argument('--clientes', type=int, default=8, help='Logins concurrentes')
+    parser.add_argument('--logins', type=int, default=200, help='Logins totales por coste')
+    parser.add_argument('--interno', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.interno:
+        ejecutar_interno(args.clientes, args.logins)
+        return
+
+    print(f"{'N':>8} {'hilos':>6} {'logins':>7} {'errores':>8} {'login/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for n in args.n:
+        r = medir(n, args.clientes, args.logins)
+        print(f"{r['n']:>8} {r['hilos_hash']:>6} {r['logins']:>7} {r['errores']:>8} "
+              f"{r['logins_por_segundo']:>9.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
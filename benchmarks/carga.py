@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Prueba de carga HTTP con los recorridos reales de los usuarios
+
+Cada usuario virtual es un hilo con su propia conexión keep-alive y su
+cookie de sesión, y repite recorridos elegidos según la mezcla:
+
+- registro: /register -> /api/validate-system -> /api/link-system -> /inicio
+- login:    /login -> /systems -> /activate_system/<id>
+- sondeo:   /api/system-data (polling del dashboard)
+
+Con --inactivas N se mantienen además N long-polls de controladores
+(/api/device/commands) abiertos durante toda la prueba, desde un único hilo,
+para medir cuánto afectan las conexiones en espera al resto del tráfico.
+
+Muestra throughput, p50/p95/p99 y tasa de errores por ruta, y con --json
+guarda los resultados para comparar commits con --comparar.
+
+Uso:
+    # Lanza gunicorn con una base SQLite temporal
+    python benchmarks/carga.py --lanzar --workers 2 --usuarios 16 --duracion 30 --json base.json
+
+    # 2000 controladores en espera: workers sync frente a gevent
+    python benchmarks/carga.py --lanzar --inactivas 2000 --json sync.json
+    python benchmarks/carga.py --lanzar --worker-class gevent --inactivas 2000 --json gevent.json
+
+    # Contra un servidor ya arrancado (la base debe ser accesible para sembrar sistemas)
+    CAEC_SQLITE_PATH=caec.db python benchmarks/carga.py --url http://127.0.0.1:8000
+
+    # PostgreSQL local: exporta DATABASE_URL antes de lanzar
+    DATABASE_URL=postgresql://localhost/caec_bench python benchmarks/carga.py --lanzar
+
+    # Comparar dos ejecuciones (sale con código 1 si hay regresiones)
+    python benchmarks/carga.py --comparar base.json nuevo.json --umbral 10
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = 'carga-1234'
+PREFIJO_CODIGO = 'CAEC-CARGA-'
+# Token de los controladores del servidor lanzado (si CAEC_DEVICE_TOKEN no está definido)
+TOKEN_DISPOSITIVO = 'carga-dispositivo'
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+class Cliente:
+    """Conexión HTTP keep-alive con la cookie de sesión de un usuario"""
+
+    def __init__(self, url, resultados):
+        partes = urlsplit(url)
+        self.host = partes.hostname
+        self.port = partes.port or 80
+        self.resultados = resultados
+        self.cookies = {}
+        self.conn = None
+
+    def _conectar(self):
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+    def peticion(self, metodo, ruta, etiqueta=None, form=None, json_body=None, esperado=(200, 302),
+                 exito_json=False):
+        """Hacer una petición y registrar su latencia bajo `etiqueta` (por defecto la ruta)
+
+        Las redirecciones no se siguen: un 302 cuenta como respuesta correcta.
+        Con exito_json, una respuesta {"success": false} cuenta como error.
+        Devuelve (status, cuerpo) o (None, None) si falla la conexión.
+        """
+        cabeceras = {}
+        cuerpo = None
+        if form is not None:
+            cuerpo = urlencode(form)
+            cabeceras['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json_body is not None:
+            cuerpo = json.dumps(json_body)
+            cabeceras['Content-Type'] = 'application/json'
+        if self.cookies:
+            cabeceras['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+
+        inicio = time.perf_counter()
+        status, datos = None, None
+        for intento in range(2):
+            try:
+                if self.conn is None:
+                    self._conectar()
+                self.conn.request(metodo, ruta, body=cuerpo, headers=cabeceras)
+                respuesta = self.conn.getresponse()
+                datos = respuesta.read()
+                status = respuesta.status
+                for nombre, valor in respuesta.getheaders():
+                    if nombre.lower() == 'set-cookie':
+                        clave, _, resto = valor.partition('=')
+                        self.cookies[clave.strip()] = resto.split(';', 1)[0]
+                if respuesta.getheader('Connection', '').lower() == 'close':
+                    self.conn.close()
+                    self.conn = None
+                break
+            except (http.client.HTTPException, OSError):
+                # El servidor cerró la conexión keep-alive: se reintenta una vez
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+                if intento:
+                    status = None
+        duracion = time.perf_counter() - inicio
+
+        ok = status in esperado
+        if ok and exito_json:
+            try:
+                ok = json.loads(datos).get('success') is True
+            except ValueError:
+                ok = False
+            if not ok:
+                status = None
+        self.resultados.registrar(etiqueta or ruta, duracion, ok)
+        return status, datos
+
+
+class Resultados:
+    """Latencias y errores por ruta, compartidos por todos los hilos"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rutas = {}
+
+    def registrar(self, ruta, duracion, ok):
+        with self._lock:
+            datos = self.rutas.setdefault(ruta, {'latencias': [], 'errores': 0})
+            datos['latencias'].append(duracion)
+            if not ok:
+                datos['errores'] += 1
+
+    def resumen(self, segundos):
+        rutas = {}
+        for ruta, datos in sorted(self.rutas.items()):
+            latencias = datos['latencias']
+            rutas[ruta] = {
+                'peticiones': len(latencias),
+                'errores': datos['errores'],
+                'tasa_errores': datos['errores'] / len(latencias),
+                'rps': len(latencias) / segundos,
+                'p50_ms': statistics.median(latencias) * 1000,
+                'p95_ms': percentil(latencias, 95) * 1000,
+                'p99_ms': percentil(latencias, 99) * 1000,
+            }
+        total = sum(r['peticiones'] for r in rutas.values())
+        errores = sum(r['errores'] for r in rutas.values())
+        return {
+            'rutas': rutas,
+            'total': {
+                'peticiones': total,
+                'errores': errores,
+                'tasa_errores': errores / total if total else 0.0,
+                'rps': total / segundos,
+            },
+        }
+
+
+class Codigos:
+    """Reparto de los códigos de sistema sembrados entre los hilos"""
+
+    def __init__(self, codigos):
+        self._lock = threading.Lock()
+        self._codigos = list(codigos)
+
+    def tomar(self):
+        with self._lock:
+            return self._codigos.pop() if self._codigos else None
+
+
+# ---------------------------------------------------------------------------
+# Recorridos
+# ---------------------------------------------------------------------------
+
+def recorrido_registro(cliente, usuario, codigos, ids):
+    """Registro de un usuario nuevo y vinculación de un sistema"""
+    codigo = codigos.tomar()
+    if codigo is None:
+        return False
+    email = f"carga-{usuario['hilo']}-{usuario['registros']}-{random.randrange(10 ** 9)}@caec.test"
+    usuario['registros'] += 1
+    cliente.cookies.clear()
+
+    status, _ = cliente.peticion('POST', '/register', form={
+        'nombre': 'Carga', 'apellido': str(usuario['hilo']), 'email': email,
+        'password': PASSWORD, 'confirm_password': PASSWORD,
+    }, esperado=(302,))
+    if status != 302:
+        return False
+    cliente.peticion('POST', '/api/validate-system', json_body={'codigo_sistema': codigo}, exito_json=True)
+    status, _ = cliente.peticion('POST', '/api/link-system', json_body={'codigo_sistema': codigo},
+                                 exito_json=True)
+    if status != 200:
+        return False
+    cliente.peticion('GET', '/inicio')
+
+    usuario['cuentas'].append((email, ids[codigo]))
+    return True
+
+
+def recorrido_login(cliente, usuario):
+    """Login de un usuario ya registrado, listado y activación de su sistema"""
+    if not usuario['cuentas']:
+        return False
+    email, sistema_id = random.choice(usuario['cuentas'])
+    cliente.cookies.clear()
+
+    status, _ = cliente.peticion('POST', '/login', form={'email': email, 'password': PASSWORD},
+                                 esperado=(302,))
+    if status != 302:
+        return False
+    cliente.peticion('GET', '/systems')
+    cliente.peticion('POST', f'/activate_system/{sistema_id}', etiqueta='/activate_system/<id>',
+                     esperado=(302,))
+    return True
+
+
+def recorrido_sondeo(cliente, usuario, sondeos):
+    """Polling del dashboard con la sesión del último usuario que entró"""
+    if not usuario['cuentas']:
+        return False
+    for _ in range(sondeos):
+        cliente.peticion('GET', '/api/system-data')
+    return True
+
+
+def usuario_virtual(indice, url, args, mezcla, codigos, ids, resultados, fin):
+    cliente = Cliente(url, resultados)
+    usuario = {'hilo': indice, 'registros': 0, 'cuentas': []}
+    recorridos, pesos = zip(*mezcla.items())
+
+    # Cada usuario empieza registrándose para tener una cuenta con sistema
+    if not recorrido_registro(cliente, usuario, codigos, ids):
+        return
+    while time.monotonic() < fin:
+        recorrido = random.choices(recorridos, pesos)[0]
+        if recorrido == 'registro':
+            recorrido_registro(cliente, usuario, codigos, ids)
+        elif recorrido == 'login':
+            recorrido_login(cliente, usuario)
+        else:
+            recorrido_sondeo(cliente, usuario, args.sondeos)
+        if args.pausa:
+            time.sleep(args.pausa)
+
+
+def conexiones_inactivas(url, cantidad, sistema_ids, resultados, fin, espera):
+    """Mantener `cantidad` long-polls de controladores abiertos hasta `fin`
+
+    Un solo hilo con selectors: cada conexión pide comandos con un `despues`
+    que nunca se alcanza, así el servidor la retiene `espera` segundos; al
+    responder se abre otra. La latencia de cada long-poll se registra como
+    '/api/device/commands'.
+    """
+    partes = urlsplit(url)
+    destino = (partes.hostname, partes.port or 80)
+    token = os.environ.get('CAEC_DEVICE_TOKEN', TOKEN_DISPOSITIVO)
+    selector = selectors.DefaultSelector()
+    etiqueta = '/api/device/commands'
+
+    def abrir(indice):
+        sistema_id = sistema_ids[indice % len(sistema_ids)]
+        peticion = (
+            f'GET /api/device/commands?sistema_id={sistema_id}&despues={10 ** 12}&espera={espera} HTTP/1.1\r\n'
+            f'Host: {destino[0]}\r\nConnection: close\r\n'
+            f'X-Device-Token: {token}\r\n\r\n'
+        ).encode('ascii')
+        conexion = socket.socket()
+        conexion.setblocking(False)
+        conexion.connect_ex(destino)
+        estado = {'indice': indice, 'inicio': time.perf_counter(), 'pendiente': peticion, 'respuesta': b''}
+        selector.register(conexion, selectors.EVENT_WRITE, estado)
+
+    def cerrar(conexion, estado, ok):
+        selector.unregister(conexion)
+        conexion.close()
+        resultados.registrar(etiqueta, time.perf_counter() - estado['inicio'], ok)
+        if time.monotonic() < fin:
+            abrir(estado['indice'])
+
+    for indice in range(cantidad):
+        abrir(indice)
+
+    while time.monotonic() < fin:
+        for clave, eventos in selector.select(timeout=0.5):
+            conexion, estado = clave.fileobj, clave.data
+            try:
+                if eventos & selectors.EVENT_WRITE:
+                    enviado = conexion.send(estado['pendiente'])
+                    estado['pendiente'] = estado['pendiente'][enviado:]
+                    if not estado['pendiente']:
+                        selector.modify(conexion, selectors.EVENT_READ, estado)
+                    continue
+                datos = conexion.recv(65536)
+            except OSError:
+                cerrar(conexion, estado, False)
+                continue
+            if datos:
+                estado['respuesta'] += datos
+            else:
+                # Connection: close: la respuesta termina al cerrar el servidor
+                cerrar(conexion, estado, estado['respuesta'].startswith(b'HTTP/1.1 200'))
+
+    # Al terminar la prueba las conexiones aún abiertas se cierran sin contarlas
+    for clave in list(selector.get_map().values()):
+        clave.fileobj.close()
+    selector.close()
+
+
+def subir_limite_descriptores(necesarios):
+    """Subir el límite de sockets abiertos del proceso (hasta el máximo permitido)"""
+    try:
+        import resource
+    except ImportError:
+        return
+    suave, duro = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if suave != resource.RLIM_INFINITY and suave < necesarios:
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (necesarios if duro == resource.RLIM_INFINITY else min(necesarios, duro), duro))
+
+
+# ---------------------------------------------------------------------------
+# Preparación: base de datos, sistemas sembrados y servidor
+# ---------------------------------------------------------------------------
+
+def sembrar_sistemas(cantidad):
+    """Crear sistemas disponibles para vincular; devuelve {codigo: id}
+
+    Usa la base indicada por DATABASE_URL o CAEC_SQLITE_PATH (la misma que el
+    servidor) y aplica antes las migraciones pendientes.
+    """
+    sys.path.insert(0, RAIZ)
+    import migraciones
+    from database import SQL, get_db_connection
+
+    migraciones.migrar()
+    lote = f'{PREFIJO_CODIGO}{int(time.time()):X}-'
+    codigos = [f'{lote}{numero:05d}' for numero in range(cantidad)]
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        marca = '%s' if SQL.postgres else '?'
+        cursor.executemany(
+            f"INSERT INTO sistema_caec (codigo_sistema, nombre_sistema, estado, modelo, version_firmware) "
+            f"VALUES ({marca}, 'Sistema de carga', 'disponible', 'CAEC-V1', '1.0.0')",
+            [(codigo,) for codigo in codigos],
+        )
+        cursor.execute(f"SELECT codigo_sistema, id FROM sistema_caec WHERE codigo_sistema LIKE {marca}",
+                       (lote + '%',))
+        ids = {codigo: sistema_id for codigo, sistema_id in cursor.fetchall()}
+        conn.commit()
+    finally:
+        conn.close()
+    return ids
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def lanzar_servidor(args):
+    """Arrancar gunicorn app:app en un puerto libre y esperar a que responda"""
+    puerto = puerto_libre()
+    comando = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--bind', f'127.0.0.1:{puerto}',
+        '--workers', str(args.workers),
+        '--chdir', RAIZ,
+        '--log-level', 'warning',
+    ]
+    if args.worker_class:
+        comando += ['--worker-class', args.worker_class]
+    # Long-polls activos también con workers sync, para comparar ambos modos
+    entorno = dict(os.environ)
+    entorno.setdefault('CAEC_CONEXIONES_LARGAS', '1')
+    entorno.setdefault('CAEC_DEVICE_TOKEN', TOKEN_DISPOSITIVO)
+    proceso = subprocess.Popen(comando, env=entorno)
+
+    url = f'http://127.0.0.1:{puerto}'
+    limite = time.monotonic() + 60
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise SystemExit('gunicorn terminó al arrancar')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', puerto, timeout=2)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            conn.close()
+            return proceso, url
+        except OSError:
+            time.sleep(0.2)
+    proceso.terminate()
+    raise SystemExit('gunicorn no respondió en 60 segundos')
+
+
+def commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parsear_mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(','):
+        nombre, _, peso = parte.partition('=')
+        nombre = nombre.strip()
+        if nombre not in ('registro', 'login', 'sondeo'):
+            raise SystemExit(f'Recorrido desconocido en --mezcla: {nombre}')
+        mezcla[nombre] = float(peso or 1)
+    return mezcla
+
+
+# ---------------------------------------------------------------------------
+# Informe y comparación
+# ---------------------------------------------------------------------------
+
+def imprimir(resultado):
+    print(f"{'ruta':<28} {'peticiones':>10} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errores':>8}")
+    for ruta, r in resultado['rutas'].items():
+        print(f"{ruta:<28} {r['peticiones']:>10} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['tasa_errores']:>7.1%}")
+    total = resultado['total']
+    print(f"{'TOTAL':<28} {total['peticiones']:>10} {total['rps']:>8.1f} "
+          f"{'':>8} {'':>8} {'':>8} {total['tasa_errores']:>7.1%}")
+
+
+def comparar(base, nuevo, umbral):
+    """Comparar dos resultados; devuelve el número de regresiones"""
+    regresiones = 0
+    print(f"{'ruta':<28} {'req/s':>16} {'p95 ms':>18} {'p99 ms':>18} {'errores':>16}")
+    for ruta in sorted(set(base['rutas']) | set(nuevo['rutas'])):
+        a, b = base['rutas'].get(ruta), nuevo['rutas'].get(ruta)
+        if a is None or b is None:
+            print(f"{ruta:<28} {'(solo en ' + ('nuevo' if a is None else 'base') + ')':>16}")
+            continue
+
+        marcas = []
+        if b['rps'] < a['rps'] * (1 - umbral / 100):
+            marcas.append('req/s')
+        for campo in ('p95_ms', 'p99_ms'):
+            if b[campo] > a[campo] * (1 + umbral / 100):
+                marcas.append(campo)
+        if b['tasa_errores'] > a['tasa_errores'] + 0.01:
+            marcas.append('errores')
+        regresiones += bool(marcas)
+
+        print(f"{ruta:<28} {a['rps']:>7.1f} → {b['rps']:>6.1f} {a['p95_ms']:>8.1f} → {b['p95_ms']:>7.1f} "
+              f"{a['p99_ms']:>8.1f} → {b['p99_ms']:>7.1f} {a['tasa_errores']:>6.1%} → {b['tasa_errores']:>6.1%}"
+              f"{'  REGRESIÓN: ' + ', '.join(marcas) if marcas else ''}")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga HTTP de CAEC')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='Servidor a probar')
+    parser.add_argument('--lanzar', action='store_true',
+                        help='Arrancar gunicorn app:app (SQLite temporal salvo que haya DATABASE_URL)')
+    parser.add_argument('--workers', type=int, default=2, help='Workers de gunicorn con --lanzar')
+    parser.add_argument('--worker-class', help='Clase de worker de gunicorn con --lanzar (p. ej. gevent)')
+    parser.add_argument('--usuarios', type=int, default=8, help='Usuarios virtuales concurrentes')
+    parser.add_argument('--duracion', type=float, default=30, help='Segundos de carga')
+    parser.add_argument('--mezcla', default='registro=1,login=3,sondeo=16',
+                        help='Peso de cada recorrido (registro, login, sondeo)')
+    parser.add_argument('--sondeos', type=int, default=5, help='Peticiones de /api/system-data por recorrido de sondeo')
+    parser.add_argument('--pausa', type=float, default=0, help='Segundos de espera entre recorridos')
+    parser.add_argument('--codigos', type=int, default=2000, help='Sistemas disponibles a sembrar para los registros')
+    parser.add_argument('--inactivas', type=int, default=0,
+                        help='Long-polls de controladores mantenidos abiertos durante la prueba')
+    parser.add_argument('--espera', type=float, default=20, help='Segundos de cada long-poll de --inactivas')
+    parser.add_argument('--json', help='Guardar los resultados en este archivo')
+    parser.add_argument('--comparar', nargs=2, metavar=('BASE', 'NUEVO'), help='Comparar dos resultados JSON')
+    parser.add_argument('--umbral', type=float, default=10, help='Porcentaje de empeoramiento que cuenta como regresión')
+    args = parser.parse_args()
+
+    if args.comparar:
+        with open(args.comparar[0]) as f:
+            base = json.load(f)
+        with open(args.comparar[1]) as f:
+            nuevo = json.load(f)
+        sys.exit(1 if comparar(base, nuevo, args.umbral) else 0)
+
+    mezcla = parsear_mezcla(args.mezcla)
+    if args.lanzar and not os.environ.get('DATABASE_URL'):
+        directorio = tempfile.mkdtemp(prefix='caec-carga-')
+        os.environ['CAEC_SQLITE_PATH'] = os.path.join(directorio, 'carga.db')
+
+    ids = sembrar_sistemas(args.codigos)
+    # Los long-polls usan sistemas sembrados que ningún usuario virtual vincula
+    reservados = list(ids.values())[:min(len(ids) // 2, args.inactivas)]
+    excluidos = set(reservados)
+    codigos = Codigos(codigo for codigo, sistema_id in ids.items() if sistema_id not in excluidos)
+    subir_limite_descriptores(args.inactivas + args.usuarios + 1024)
+
+    servidor = None
+    url = args.url
+    if args.lanzar:
+        servidor, url = lanzar_servidor(args)
+
+    resultados = Resultados()
+    try:
+        inicio = time.monotonic()
+        fin = inicio + args.duracion
+        hilos = [
+            threading.Thread(target=usuario_virtual,
+                             args=(i, url, args, mezcla, codigos, ids, resultados, fin), daemon=True)
+            for i in range(args.usuarios)
+        ]
+        if args.inactivas:
+            hilos.append(threading.Thread(
+                target=conexiones_inactivas,
+                args=(url, args.inactivas, reservados, resultados, fin, args.espera), daemon=True))
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        segundos = time.monotonic() - inicio
+    finally:
+        if servidor is not None:
+            servidor.terminate()
+            servidor.wait(timeout=30)
+
+    resultado = resultados.resumen(segundos)
+    resultado['parametros'] = {
+        'commit': commit_actual(),
+        'fecha': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'backend': 'postgres' if os.environ.get('DATABASE_URL') else 'sqlite',
+        'workers': args.workers if args.lanzar else None,
+        'worker_class': args.worker_class if args.lanzar else None,
+        'usuarios': args.usuarios,
+        'inactivas': args.inactivas,
+        'duracion': segundos,
+        'mezcla': mezcla,
+    }
+
+    imprimir(resultado)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(resultado, f, indent=2)
+        print(f"Resultados guardados en {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Caché en memoria del proceso con expiración (TTL) y desalojo LRU
+"""
+
+import copy
+import functools
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, has_request_context, session
+
+# Valor por defecto de get() para distinguir "no está" de un None guardado
+FALTA = object()
+
+
+class TTLCache:
+    """Diccionario acotado: las entradas caducan tras `ttl` segundos y, al
+    superar `max_size`, se desaloja la usada hace más tiempo"""
+
+    def __init__(self, max_size=1024, ttl=60.0):
+        if max_size < 1:
+            raise ValueError("max_size debe ser mayor que cero")
+        self.max_size = max_size
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def get(self, clave, default=FALTA):
+        """Obtener un valor vigente (y marcarlo como usado recientemente)"""
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.fallos += 1
+                return default
+            expira, valor = entrada
+            if expira <= time.monotonic():
+                del self._datos[clave]
+                self.fallos += 1
+                return default
+            self._datos.move_to_end(clave)
+            self.aciertos += 1
+            return valor
+
+    def set(self, clave, valor, ttl=None):
+        """Guardar un valor (reinicia su TTL)"""
+        expira = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._datos[clave] = (expira, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_size:
+                self._datos.popitem(last=False)
+
+    def delete(self, clave):
+        """Invalidar una entrada"""
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._datos)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'entradas': len(self._datos),
+                'max_size': self.max_size,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+            }
+
+
+# Clave de sesión con la versión de los datos cacheados del usuario. Se
+# renueva en cada escritura, así el resto de workers (que no reciben la
+# invalidación) descartan su copia en la siguiente petición de ese usuario.
+CLAVE_VERSION_SESION = '_datos_version'
+
+# Versiones que se conservan por usuario: cada sesión (otro navegador, otro
+# dispositivo) tiene la suya y lee su propia copia sin invalidar la de las
+# demás
+VERSIONES_POR_USUARIO = 4
+
+_lock_versiones = threading.Lock()
+
+
+def _memo_peticion():
+    """Memoización ligada a la petición actual (None fuera de una petición)"""
+    if not has_request_context():
+        return None
+    if '_memo_usuario' not in g:
+        g._memo_usuario = {}
+    return g._memo_usuario
+
+
+def _version_sesion(usuario_id):
+    if has_request_context() and session.get('user_id') == usuario_id:
+        return session.get(CLAVE_VERSION_SESION)
+    return None
+
+
+def memoizar_por_usuario(cache):
+    """Decorador para lecturas cuyo primer argumento es usuario_id
+
+    Primero busca en la memoización de la petición y después en `cache`
+    (compartida entre peticiones del proceso, con TTL), bajo la versión de
+    la sesión. Devuelve copias para que quien llama no modifique los valores
+    cacheados.
+    """
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(usuario_id, *args, **kwargs):
+            clave = (funcion.__name__, args, tuple(sorted(kwargs.items())))
+
+            memo = _memo_peticion()
+            if memo is not None and clave in memo.get(usuario_id, {}):
+                return copy.deepcopy(memo[usuario_id][clave])
+
+            version = _version_sesion(usuario_id)
+            with _lock_versiones:
+                versiones = cache.get(usuario_id, None)
+                if versiones is None:
+                    versiones = {}
+                    cache.set(usuario_id, versiones)
+                valores = versiones.get(version)
+                if valores is None:
+                    valores = versiones[version] = {}
+                    while len(versiones) > VERSIONES_POR_USUARIO:
+                        del versiones[next(iter(versiones))]
+
+            if clave in valores:
+                valor = valores[clave]
+            else:
+                valor = funcion(usuario_id, *args, **kwargs)
+                valores[clave] = valor
+
+            if memo is not None:
+                memo.setdefault(usuario_id, {})[clave] = valor
+            return copy.deepcopy(valor)
+        return envoltura
+    return decorador
+
+
+def invalidar_usuario(cache, usuario_id):
+    """Descartar todo lo cacheado de un usuario tras una escritura"""
+    cache.delete(usuario_id)
+    memo = _memo_peticion()
+    if memo is not None:
+        memo.pop(usuario_id, None)
+    if has_request_context() and session.get('user_id') == usuario_id:
+        session[CLAVE_VERSION_SESION] = secrets.token_hex(4)
@@ -0,0 +1,152 @@
+"""
+Cola de escritura acotada con un hilo escritor en segundo plano
+
+Las peticiones encolan filas y responden sin esperar a la base de datos; el
+hilo escritor las vuelca en lotes cuando se juntan `lote` filas o cuando la
+más antigua lleva `intervalo` segundos esperando. Si la cola está llena,
+encolar() lo rechaza y el llamador debe pedir al cliente que reintente.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+
+class ColaEscritura:
+    """Buffer de filas pendientes de escribir, por proceso"""
+
+    def __init__(self, escribir, capacidad=50000, lote=500, intervalo=0.2,
+                 reintentos=3, nombre='cola-escritura'):
+        if capacidad < 1 or lote < 1:
+            raise ValueError("Tamaños de cola inválidos")
+        self._escribir = escribir
+        self.capacidad = capacidad
+        self.lote = lote
+        self.intervalo = intervalo
+        self.reintentos = reintentos
+        self.nombre = nombre
+
+        self._lock = threading.Condition()
+        self._pendientes = deque()
+        # Instante (monotonic) en que entró la fila más antigua pendiente
+        self._desde = None
+        # Filas sacadas de la cola que el escritor está guardando
+        self._en_escritura = 0
+        self._pid = None
+        self._cerrada = False
+        self.escritas = 0
+        self.rechazadas = 0
+        self.descartadas = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pendientes) + self._en_escritura
+
+    def encolar(self, filas):
+        """Añadir filas (todas o ninguna); devuelve False si no caben"""
+        self._arrancar()
+        with self._lock:
+            if self._cerrada or len(self._pendientes) + self._en_escritura + len(filas) > self.capacidad:
+                self.rechazadas += len(filas)
+                return False
+            if not self._pendientes:
+                self._desde = time.monotonic()
+            self._pendientes.extend(filas)
+            if len(self._pendientes) >= self.lote:
+                self._lock.notify_all()
+            return True
+
+    def _arrancar(self):
+        """Arrancar el hilo escritor (una vez por proceso: no sobrevive al fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Proceso hijo: lo heredado pertenece al padre, que lo escribirá
+                self._pendientes.clear()
+                self._en_escritura = 0
+                self._desde = None
+            self._pid = os.getpid()
+            threading.Thread(target=self._bucle, name=self.nombre, daemon=True).start()
+
+    def _tomar_lote(self):
+        """Esperar a que toque escribir y sacar hasta `lote` filas (None al cerrar vacía)"""
+        with self._lock:
+            while True:
+                if self._pendientes:
+                    espera = self._desde + self.intervalo - time.monotonic()
+                    if self._cerrada or len(self._pendientes) >= self.lote or espera <= 0:
+                        break
+                elif self._cerrada:
+                    return None
+                else:
+                    espera = None
+                self._lock.wait(espera)
+
+            cantidad = min(self.lote, len(self._pendientes))
+            filas = [self._pendientes.popleft() for _ in range(cantidad)]
+            self._en_escritura = cantidad
+            # Lo que queda ya superó el intervalo o llena otro lote
+            self._desde = time.monotonic() - self.intervalo if self._pendientes else None
+            return filas
+
+    def _bucle(self):
+        while True:
+            filas = self._tomar_lote()
+            if filas is None:
+                return
+            self._guardar(filas)
+
+    def _guardar(self, filas):
+        """Escribir un lote, reintentando con espera creciente si falla"""
+        for intento in range(1, self.reintentos + 1):
+            try:
+                self._escribir(filas)
+                with self._lock:
+                    self.escritas += len(filas)
+                break
+            except Exception as e:
+                print(f"Error al escribir lote de {self.nombre} (intento {intento}): {e}")
+                if intento < self.reintentos:
+                    time.sleep(min(0.5 * 2 ** (intento - 1), 5))
+        else:
+            with self._lock:
+                self.descartadas += len(filas)
+            print(f"Se descartan {len(filas)} filas de {self.nombre} tras {self.reintentos} intentos")
+
+        with self._lock:
+            self._en_escritura = 0
+            self._lock.notify_all()
+
+    def drenar(self, timeout=30.0):
+        """Dejar de aceptar filas y esperar a que se escriba lo pendiente
+
+        Se llama al apagar el worker. Devuelve True si la cola quedó vacía.
+        """
+        limite = time.monotonic() + timeout
+        with self._lock:
+            self._cerrada = True
+            self._lock.notify_all()
+            if self._pid != os.getpid():
+                # Sin hilo escritor en este proceso: no hay nada propio que escribir
+                return True
+            while self._pendientes or self._en_escritura:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    print(f"{self.nombre}: quedan {len(self._pendientes) + self._en_escritura} filas sin escribir")
+                    return False
+                self._lock.wait(restante)
+            return True
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'pendientes': len(self._pendientes) + self._en_escritura,
+                'capacidad': self.capacidad,
+                'escritas': self.escritas,
+                'rechazadas': self.rechazadas,
+                'descartadas': self.descartadas,
+            }
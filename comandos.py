@@ -0,0 +1,127 @@
+"""
+Cola de comandos para los controladores con entrega por long-poll
+
+Los comandos se guardan en comandos_sistema y se entregan en orden de id
+hasta que el controlador los confirma (entrega al menos una vez). Un
+controlador sin comandos espera en un Hub en memoria, sin consultar la base
+de datos: cada worker sabe cuál es el último comando pendiente de cada
+sistema y un único hilo por worker busca, con una sola consulta por
+intervalo, los comandos creados en otros workers.
+"""
+
+import os
+import threading
+import time
+
+from cache import FALTA, TTLCache
+from database import (
+    comandos_nuevos, confirmar_comandos, encolar_comando, entregar_comandos,
+    ultimo_comando, ultimo_comando_pendiente
+)
+from eventos import Hub
+
+# Segundos máximos que un long-poll espera un comando
+ESPERA_MAXIMA = float(os.environ.get('CAEC_COMANDOS_ESPERA', 25))
+
+# Cada cuántos segundos cada worker busca comandos creados por otros workers
+INTERVALO_SONDEO = float(os.environ.get('CAEC_COMANDOS_SONDEO', 1))
+
+# Id del último comando pendiente por sistema_id (0 = ninguno). Caduca para
+# recuperar cualquier aviso perdido (p. ej. ids confirmados fuera de orden)
+ultimos_comandos = TTLCache(
+    max_size=int(os.environ.get('CAEC_CACHE_LECTURAS_MAX', 10000)),
+    ttl=60,
+)
+
+# Aviso de comando nuevo a los long-polls del proceso (clave: sistema_id)
+hub_comandos = Hub(max_cola=10)
+
+
+def _notificar(sistema_id, comando_id):
+    actual = ultimos_comandos.get(sistema_id, None)
+    if actual is None or comando_id > actual:
+        ultimos_comandos.set(sistema_id, comando_id)
+    hub_comandos.publicar(sistema_id, comando_id)
+
+
+def encolar(sistema_id, tipo, payload):
+    """Guardar un comando y despertar a los long-polls de este proceso"""
+    comando_id = encolar_comando(sistema_id, tipo, payload)
+    _notificar(sistema_id, comando_id)
+    return comando_id
+
+
+def _ultimo_pendiente(sistema_id):
+    ultimo = ultimos_comandos.get(sistema_id)
+    if ultimo is FALTA:
+        ultimo = ultimo_comando_pendiente(sistema_id)
+        ultimos_comandos.set(sistema_id, ultimo)
+    return ultimo
+
+
+def esperar_comandos(sistema_id, despues_de, espera):
+    """Comandos sin confirmar con id > despues_de, esperando hasta `espera` segundos
+
+    Devuelve una lista vacía si vence la espera sin comandos nuevos.
+    """
+    # Suscribirse antes de comprobar para no perder un aviso intermedio
+    suscripcion = hub_comandos.suscribir(sistema_id)
+    iniciar_sondeo()
+    try:
+        limite = time.monotonic() + espera
+        while True:
+            if _ultimo_pendiente(sistema_id) > despues_de:
+                comandos = entregar_comandos(sistema_id, despues_de)
+                if comandos:
+                    return comandos
+                # Ya estaban confirmados: no hay nada pendiente después de despues_de
+                ultimos_comandos.set(sistema_id, despues_de)
+
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return []
+            suscripcion.esperar(timeout=restante)
+    finally:
+        hub_comandos.cancelar(suscripcion)
+
+
+def confirmar(sistema_id, hasta):
+    """Confirmar los comandos con id <= hasta; devuelve cuántos se confirmaron"""
+    confirmados = confirmar_comandos(sistema_id, hasta)
+    ultimo = ultimos_comandos.get(sistema_id, None)
+    if ultimo is not None and ultimo <= hasta:
+        ultimos_comandos.set(sistema_id, 0)
+    return confirmados
+
+
+_sondeo_pid = None
+_sondeo_lock = threading.Lock()
+
+
+def iniciar_sondeo():
+    """Arrancar (una vez por proceso) el hilo que trae comandos de otros workers"""
+    global _sondeo_pid
+    with _sondeo_lock:
+        if _sondeo_pid == os.getpid():
+            return
+        _sondeo_pid = os.getpid()
+        threading.Thread(target=_bucle_sondeo, name='sondeo-comandos', daemon=True).start()
+
+
+def _bucle_sondeo():
+    visto = None
+    while True:
+        try:
+            if visto is None:
+                visto = ultimo_comando()
+            time.sleep(INTERVALO_SONDEO)
+            # Sin long-polls abiertos no hace falta consultar; `visto` no avanza
+            # y lo creado mientras tanto se encuentra en la siguiente consulta
+            if not hub_comandos.claves():
+                continue
+            for comando_id, sistema_id in comandos_nuevos(visto):
+                _notificar(sistema_id, comando_id)
+                visto = max(visto, comando_id)
+        except Exception as e:
+            print(f"Error en el sondeo de comandos: {e}")
+            time.sleep(INTERVALO_SONDEO)
@@ -0,0 +1,83 @@
+"""
+Configuración de irrigación de cada sistema, versionada y cacheada
+
+Cada guardado incrementa la versión del sistema. Los controladores la
+consultan con If-None-Match: mientras la versión en caché coincida con su
+ETag se responde 304 sin tocar la base de datos. El worker que guarda
+actualiza su caché al momento; los demás ven el cambio cuando vence la
+entrada (CAEC_CACHE_CONFIG_TTL).
+"""
+
+import os
+
+from cache import FALTA, TTLCache
+from database import guardar_config_irrigacion, obtener_config_irrigacion
+
+# Valores que usa el controlador mientras el sistema no tenga configuración
+CONFIG_POR_DEFECTO = {
+    'potencia_ahorro': 40,
+    'duracion_ahorro': 15,
+    'duracion_abundante': 5,
+}
+
+# Límites aceptados para cada parámetro (porcentaje y minutos)
+LIMITES = {
+    'potencia_ahorro': (0, 100),
+    'duracion_ahorro': (1, 240),
+    'duracion_abundante': (1, 240),
+}
+
+# Configuración por sistema_id (también se guardan los sistemas sin configuración)
+configs = TTLCache(
+    max_size=int(os.environ.get('CAEC_CACHE_LECTURAS_MAX', 10000)),
+    ttl=float(os.environ.get('CAEC_CACHE_CONFIG_TTL', 30)),
+)
+
+
+class ConfigInvalida(ValueError):
+    """Parámetros de irrigación fuera de rango"""
+
+
+def config_actual(sistema_id):
+    """Configuración vigente de un sistema (None si el sistema no existe)
+
+    Un sistema sin configuración guardada tiene versión 0 y los valores por defecto.
+    """
+    config = configs.get(sistema_id)
+    if config is FALTA:
+        config = obtener_config_irrigacion(sistema_id)
+        if config is not None and config['version'] == 0:
+            config.update(CONFIG_POR_DEFECTO)
+        configs.set(sistema_id, config)
+    return config
+
+
+def etag(config):
+    """ETag (sin comillas) de una versión de la configuración"""
+    return f'irr-{config["sistema_id"]}-{config["version"]}'
+
+
+def validar(valores):
+    """Convertir y validar los parámetros recibidos (dict con las claves de LIMITES)"""
+    normalizados = {}
+    for nombre, (minimo, maximo) in LIMITES.items():
+        valor = valores.get(nombre)
+        if isinstance(valor, bool):
+            raise ConfigInvalida(f"{nombre} debe ser un número entero")
+        try:
+            valor = int(valor)
+        except (TypeError, ValueError):
+            raise ConfigInvalida(f"{nombre} debe ser un número entero")
+        if not minimo <= valor <= maximo:
+            raise ConfigInvalida(f"{nombre} debe estar entre {minimo} y {maximo}")
+        normalizados[nombre] = valor
+    return normalizados
+
+
+def guardar(sistema_id, valores):
+    """Guardar una configuración ya validada y actualizar la caché"""
+    config = guardar_config_irrigacion(
+        sistema_id, valores['potencia_ahorro'], valores['duracion_ahorro'], valores['duracion_abundante']
+    )
+    configs.set(sistema_id, config)
+    return config
@@ -0,0 +1,43 @@
+"""
+Soporte de los workers cooperativos (gevent) de gunicorn
+
+Con `CAEC_WORKER_CLASS=gevent` gunicorn aplica el monkey patching de gevent
+antes de importar la aplicación: threading, time.sleep y los sockets pasan
+a ser cooperativos, así que los long-polls y los streams SSE esperan en
+greenlets sin ocupar el worker. Lo que no se parchea solo se resuelve aquí:
+
+- psycopg2 es una extensión en C; psycogreen le instala un callback de
+  espera para que las consultas cedan el control mientras esperan al servidor.
+- Los cálculos largos en C que liberan el GIL (scrypt) deben ir a hilos
+  reales; en un greenlet bloquearían todas las conexiones del worker.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def activo():
+    """True si el proceso corre con el monkey patching de gevent"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def parchear_psycopg():
+    """Hacer cooperativas las consultas de psycopg2 (una vez por proceso)"""
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def ejecutor_hilos(max_workers, thread_name_prefix=''):
+    """Pool de hilos del sistema operativo también con gevent activo
+
+    concurrent.futures crea threading.Thread, que con gevent son greenlets;
+    el pool de gevent usa hilos reales y su resultado se espera sin bloquear
+    el hub.
+    """
+    if activo():
+        from gevent.threadpool import ThreadPoolExecutor as ThreadPoolExecutorGevent
+        return ThreadPoolExecutorGevent(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
@@ -0,0 +1,108 @@
+"""
+Progreso de la cosecha calculado en el servidor
+
+La ingesta suma en progreso_cosecha los grados-día (temperatura por encima
+de la base del cultivo, integrada en el tiempo) y las horas de luz de cada
+sistema con cada lote de lecturas (ver database._actualizar_cosecha). Este
+módulo solo convierte esos acumuladores en el progreso y la fecha estimada
+que muestra el dashboard: una lectura por clave primaria, sin recorrer el
+histórico.
+"""
+
+from datetime import timedelta
+
+from database import iniciar_cosecha, obtener_progreso_cosecha
+from ingesta import ahora_utc
+
+# Valores de referencia por cultivo hidropónico: temperatura base (°C),
+# grados-día y horas de luz hasta la cosecha, y duración típica en días
+# (se usa para estimar la fecha mientras no hay datos suficientes)
+CULTIVOS = {
+    'lechuga': {'nombre': 'Lechuga', 'temp_base': 4.0, 'grados_dia': 700, 'horas_luz': 600, 'dias': 45},
+    'espinaca': {'nombre': 'Espinaca', 'temp_base': 2.0, 'grados_dia': 650, 'horas_luz': 500, 'dias': 40},
+    'albahaca': {'nombre': 'Albahaca', 'temp_base': 10.0, 'grados_dia': 650, 'horas_luz': 900, 'dias': 56},
+    'fresa': {'nombre': 'Fresa', 'temp_base': 5.0, 'grados_dia': 1000, 'horas_luz': 1000, 'dias': 70},
+    'tomate': {'nombre': 'Tomate', 'temp_base': 10.0, 'grados_dia': 1100, 'horas_luz': 1400, 'dias': 90},
+}
+
+# Cultivo de las filas que crea la ingesta (su temp_base es la de la columna)
+CULTIVO_POR_DEFECTO = 'lechuga'
+
+# Peso de los grados-día en el progreso (el resto, las horas de luz)
+PESO_GRADOS_DIA = 0.5
+
+# Días de cultivo a partir de los que la fecha estimada sale del ritmo medido
+DIAS_MINIMOS_RITMO = 1
+
+
+class CultivoInvalido(ValueError):
+    """Cultivo o fecha de siembra no válidos"""
+
+
+def calcular(fila, ahora=None):
+    """Progreso de la cosecha a partir de la fila de acumuladores
+
+    `fila` es la de obtener_progreso_cosecha() (None si el sistema aún no
+    tiene lecturas). La fecha estimada sigue el ritmo medio de grados-día y
+    horas de luz desde la siembra; manda el acumulador que vaya más atrasado.
+    """
+    ahora = ahora or ahora_utc()
+    clave = (fila or {}).get('cultivo') or CULTIVO_POR_DEFECTO
+    cultivo = CULTIVOS.get(clave, CULTIVOS[CULTIVO_POR_DEFECTO])
+    if fila is None:
+        return {
+            'cultivo': clave, 'nombre': cultivo['nombre'], 'fecha_siembra': None,
+            'fecha_estimada': None, 'progreso': 0.0, 'dias_restantes': None,
+            'grados_dia': 0.0, 'grados_dia_objetivo': cultivo['grados_dia'],
+            'horas_luz': 0.0, 'horas_luz_objetivo': cultivo['horas_luz'],
+            'actualizado': None,
+        }
+
+    fraccion_grados = min(fila['grados_dia'] / cultivo['grados_dia'], 1.0)
+    fraccion_luz = min(fila['horas_luz'] / cultivo['horas_luz'], 1.0)
+    progreso = PESO_GRADOS_DIA * fraccion_grados + (1 - PESO_GRADOS_DIA) * fraccion_luz
+
+    # El ritmo se mide hasta la última lectura: un controlador desconectado
+    # no diluye la media
+    siembra = fila['fecha_siembra']
+    hasta = fila['ultima_lectura'] or ahora
+    dias = (hasta - siembra).total_seconds() / 86400
+    if progreso >= 1.0:
+        fecha_estimada = hasta
+    elif dias >= DIAS_MINIMOS_RITMO and fila['grados_dia'] > 0 and fila['horas_luz'] > 0:
+        restantes = max(
+            (cultivo['grados_dia'] - fila['grados_dia']) / (fila['grados_dia'] / dias),
+            (cultivo['horas_luz'] - fila['horas_luz']) / (fila['horas_luz'] / dias),
+        )
+        fecha_estimada = hasta + timedelta(days=max(restantes, 0))
+    else:
+        fecha_estimada = siembra + timedelta(days=cultivo['dias'])
+
+    return {
+        'cultivo': clave, 'nombre': cultivo['nombre'], 'fecha_siembra': siembra,
+        'fecha_estimada': fecha_estimada, 'progreso': round(progreso * 100, 1),
+        'dias_restantes': max((fecha_estimada - ahora).total_seconds() / 86400, 0.0),
+        'grados_dia': fila['grados_dia'], 'grados_dia_objetivo': cultivo['grados_dia'],
+        'horas_luz': fila['horas_luz'], 'horas_luz_objetivo': cultivo['horas_luz'],
+        'actualizado': fila['actualizado'],
+    }
+
+
+def progreso_actual(sistema_id):
+    """Progreso de la cosecha de un sistema"""
+    return calcular(obtener_progreso_cosecha(sistema_id))
+
+
+def iniciar(sistema_id, cultivo, fecha_siembra=None):
+    """Empezar un cultivo en un sistema (por defecto, sembrado ahora)
+
+    Lanza CultivoInvalido si el cultivo no existe o la siembra es futura.
+    """
+    if cultivo not in CULTIVOS:
+        raise CultivoInvalido(f"Cultivo no válido; opciones: {', '.join(sorted(CULTIVOS))}")
+    ahora = ahora_utc()
+    fecha_siembra = fecha_siembra or ahora
+    if fecha_siembra > ahora:
+        raise CultivoInvalido("La fecha de siembra no puede ser futura")
+    iniciar_cosecha(sistema_id, cultivo, fecha_siembra, CULTIVOS[cultivo]['temp_base'])
+    return progreso_actual(sistema_id)
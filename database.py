@@ -1,35 +1,145 @@
 import sqlite3
 import psycopg2
 import psycopg2.extras
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import json
 import secrets
 import os
+import threading
+
+from cache import TTLCache, invalidar_usuario, memoizar_por_usuario
+import cooperativo
+import metricas
+import perfil_sqlite
+from metricas import contar_error_db, medir_db
+from pool import ConnectionPool
+from seguridad import hashear_password, verificar_password
+from sql import Sentencias
+
+# Ruta del archivo SQLite en desarrollo local
+SQLITE_PATH = os.environ.get('CAEC_SQLITE_PATH', 'caec.db')
+
+# El backend se resuelve una sola vez al importar el módulo
+DATABASE_URL = os.environ.get('DATABASE_URL')
+DIALECTO = 'postgres' if DATABASE_URL else 'sqlite'
+
+# Con workers gevent las consultas a PostgreSQL ceden el control mientras esperan
+if DATABASE_URL and cooperativo.activo():
+    cooperativo.parchear_psycopg()
+
+# Sentencias SQL pre-renderizadas para el dialecto activo. En PostgreSQL las
+# consultas frecuentes se preparan en el servidor; con un pooler en modo
+# transacción (pgbouncer) hay que desactivarlo con DB_PREPARED_STATEMENTS=0.
+SQL = Sentencias(DIALECTO, preparar=os.environ.get('DB_PREPARED_STATEMENTS', '1') != '0')
+
+# Lecturas de usuario/sistemas cacheadas entre peticiones (clave: usuario_id).
+# Las escrituras de este módulo la invalidan explícitamente.
+cache_usuarios = TTLCache(
+    max_size=int(os.environ.get('CAEC_CACHE_USUARIOS_MAX', 5000)),
+    ttl=float(os.environ.get('CAEC_CACHE_USUARIOS_TTL', 30)),
+)
+
+# Segundos para establecer una conexión y milisegundos máximos por sentencia
+# en PostgreSQL (0 = sin límite). Migraciones y mantenimiento no los aplican.
+CONNECT_TIMEOUT = int(os.environ.get('CAEC_DB_CONNECT_TIMEOUT', 5))
+STATEMENT_TIMEOUT_MS = int(os.environ.get('CAEC_DB_STATEMENT_TIMEOUT_MS', 15000))
 
 def get_db_connection():
-    """Obtener conexión a la base de datos (PostgreSQL en producción, SQLite en desarrollo)"""
-    database_url = os.environ.get('DATABASE_URL')
-
-    if database_url:
-        # PostgreSQL en producción (Render)
-        conn = psycopg2.connect(database_url)
+    """Abrir una conexión física nueva (PostgreSQL en producción, SQLite en desarrollo)
+
+    Las funciones de acceso a datos no la usan directamente: piden prestada
+    una conexión del pool mediante db_connection().
+    """
+    if DATABASE_URL:
+        # PostgreSQL en producción (Render). Sin timeouts, una base lenta deja
+        # a las peticiones bloqueadas en connect o execute indefinidamente
+        conn = psycopg2.connect(
+            DATABASE_URL,
+            connect_timeout=CONNECT_TIMEOUT,
+            options=f'-c statement_timeout={STATEMENT_TIMEOUT_MS}',
+        )
         # Usar RealDictCursor para obtener resultados como diccionarios
         return conn
     else:
-        # SQLite en desarrollo local
-        conn = sqlite3.connect('caec.db')
+        # SQLite (desarrollo o un solo nodo): WAL, pragmas y bloqueo de
+        # escritura entre workers; el pool puede prestarla a otro hilo
+        conn = perfil_sqlite.conectar(SQLITE_PATH)
         conn.row_factory = sqlite3.Row
         return conn
 
+def _conexion_valida(conn):
+    """Health check ejecutado al prestar una conexión inactiva"""
+    if is_postgres() and conn.closed:
+        return False
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1')
+    cursor.fetchone()
+    cursor.close()
+    conn.rollback()
+    return True
+
+def _reiniciar_conexion(conn):
+    """Dejar la conexión sin transacción abierta antes de devolverla al pool"""
+    if is_postgres() and conn.closed:
+        raise psycopg2.InterfaceError("Conexión cerrada")
+    conn.rollback()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Obtener el pool de conexiones del proceso (se crea en el primer uso)"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    get_db_connection,
+                    min_size=int(os.environ.get('DB_POOL_MIN', 1)),
+                    max_size=int(os.environ.get('DB_POOL_MAX', 10)),
+                    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+                    check_interval=float(os.environ.get('DB_POOL_CHECK_INTERVAL', 30)),
+                    health_check=_conexion_valida,
+                    reset=_reiniciar_conexion,
+                )
+                _pool.llenar()
+    return _pool
+
+@metricas.registro.recolector
+def _metricas_pool():
+    """Estado del pool del proceso (solo si ya se creó)"""
+    if _pool is None:
+        return
+    for estado, valor in _pool.estadisticas().items():
+        metricas.conexiones_pool.set(estado, valor=valor)
+
+def esperando_conexion():
+    """Peticiones del proceso esperando una conexión libre (0 si el pool aún no existe)"""
+    if _pool is None:
+        return 0
+    return _pool.estadisticas()['esperando']
+
+def db_connection():
+    """Context manager que presta una conexión del pool
+
+    Uso:
+        with db_connection() as conn:
+            cursor = get_cursor(conn)
+            ...
+            conn.commit()
+    """
+    return get_pool().conexion()
+
 def get_cursor(conn):
     """Obtener cursor apropiado según el tipo de base de datos"""
-    if is_postgres():
+    if SQL.postgres:
         return conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
     else:
         return conn.cursor()
 
 def is_postgres():
     """Verificar si estamos usando PostgreSQL"""
-    return os.environ.get('DATABASE_URL') is not None
+    return SQL.postgres
 
 def dict_from_row(row):
     """Convertir una fila de base de datos a diccionario"""
@@ -43,507 +153,1389 @@ def dict_from_row(row):
         return dict(row)
 
 def init_db():
-    """Inicializar la base de datos con las tablas necesarias"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-
-    # Detectar si es PostgreSQL o SQLite
-    use_postgres = is_postgres()
-
-    # Tabla de usuarios
-    if use_postgres:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuario (
-                id SERIAL PRIMARY KEY,
-                nombre VARCHAR(100) NOT NULL,
-                apellido VARCHAR(100) NOT NULL,
-                email VARCHAR(150) UNIQUE NOT NULL,
-                password VARCHAR(255) NOT NULL,
-                fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                ultimo_acceso TIMESTAMP,
-                activo BOOLEAN DEFAULT TRUE
-            )
-        ''')
-    else:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuario (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nombre VARCHAR(100) NOT NULL,
-                apellido VARCHAR(100) NOT NULL,
-                email VARCHAR(150) UNIQUE NOT NULL,
-                password VARCHAR(255) NOT NULL,
-                fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP,
-                ultimo_acceso DATETIME,
-                activo BOOLEAN DEFAULT 1
-            )
-        ''')
-
-    # Tabla de contacto
-    if use_postgres:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS contacto (
-                id SERIAL PRIMARY KEY,
-                usuario_id INTEGER NOT NULL,
-                telefono VARCHAR(20),
-                celular VARCHAR(20),
-                direccion TEXT,
-                ciudad VARCHAR(100),
-                pais VARCHAR(100),
-                codigo_postal VARCHAR(20),
-                FOREIGN KEY (usuario_id) REFERENCES usuario(id) ON DELETE CASCADE
-            )
-        ''')
-    else:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS contacto (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_id INTEGER NOT NULL,
-                telefono VARCHAR(20),
-                celular VARCHAR(20),
-                direccion TEXT,
-                ciudad VARCHAR(100),
-                pais VARCHAR(100),
-                codigo_postal VARCHAR(20),
-                FOREIGN KEY (usuario_id) REFERENCES usuario(id) ON DELETE CASCADE
-            )
-        ''')
-
-    # Tabla de sistemas CAEC
-    if use_postgres:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sistema_caec (
-                id SERIAL PRIMARY KEY,
-                codigo_sistema VARCHAR(50) UNIQUE NOT NULL,
-                usuario_id INTEGER,
-                nombre_sistema VARCHAR(100),
-                fecha_vinculacion TIMESTAMP,
-                ultimo_sync TIMESTAMP,
-                estado VARCHAR(20) DEFAULT 'activo',
-                modelo VARCHAR(50),
-                version_firmware VARCHAR(20),
-                FOREIGN KEY (usuario_id) REFERENCES usuario(id) ON DELETE SET NULL
-            )
-        ''')
-    else:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sistema_caec (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                codigo_sistema VARCHAR(50) UNIQUE NOT NULL,
-                usuario_id INTEGER,
-                nombre_sistema VARCHAR(100),
-                fecha_vinculacion DATETIME,
-                ultimo_sync DATETIME,
-                estado VARCHAR(20) DEFAULT 'activo',
-                modelo VARCHAR(50),
-                version_firmware VARCHAR(20),
-                FOREIGN KEY (usuario_id) REFERENCES usuario(id) ON DELETE SET NULL
-            )
-        ''')
-
-    # Tabla de datos de sensores (histórico)
-    if use_postgres:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id SERIAL PRIMARY KEY,
-                sistema_id INTEGER NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                nivel_agua REAL,
-                ph REAL,
-                temperatura REAL,
-                nivel_nutrientes REAL,
-                irrigacion_activa BOOLEAN,
-                luz_activa BOOLEAN,
-                FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
-            )
-        ''')
-    else:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sistema_id INTEGER NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                nivel_agua REAL,
-                ph REAL,
-                temperatura REAL,
-                nivel_nutrientes REAL,
-                irrigacion_activa BOOLEAN,
-                luz_activa BOOLEAN,
-                FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
-            )
-        ''')
+    """Crear o actualizar el esquema aplicando las migraciones pendientes (ver migraciones.py)"""
+    from migraciones import migrar
+    migrar()
+    print("Base de datos inicializada correctamente")
 
-    # Insertar sistemas CAEC de ejemplo para pruebas
-    if use_postgres:
-        # PostgreSQL usa ON CONFLICT en lugar de INSERT OR IGNORE
-        cursor.execute('''
-            INSERT INTO sistema_caec
-            (codigo_sistema, nombre_sistema, estado, modelo, version_firmware)
-            VALUES
-            ('CAEC-2024-0001', 'Sistema Demo 1', 'disponible', 'CAEC-V1', '1.0.0'),
-            ('CAEC-2024-0002', 'Sistema Demo 2', 'disponible', 'CAEC-V1', '1.0.0'),
-            ('CAEC-2024-0003', 'Sistema Demo 3', 'disponible', 'CAEC-V2', '1.2.0'),
-            ('CAEC-2024-TEST', 'Sistema Test', 'disponible', 'CAEC-V1', '1.0.0')
-            ON CONFLICT (codigo_sistema) DO NOTHING
-        ''')
-    else:
-        cursor.execute('''
-            INSERT OR IGNORE INTO sistema_caec
-            (codigo_sistema, nombre_sistema, estado, modelo, version_firmware)
-            VALUES
-            ('CAEC-2024-0001', 'Sistema Demo 1', 'disponible', 'CAEC-V1', '1.0.0'),
-            ('CAEC-2024-0002', 'Sistema Demo 2', 'disponible', 'CAEC-V1', '1.0.0'),
-            ('CAEC-2024-0003', 'Sistema Demo 3', 'disponible', 'CAEC-V2', '1.2.0'),
-            ('CAEC-2024-TEST', 'Sistema Test', 'disponible', 'CAEC-V1', '1.0.0')
-        ''')
+def _lista_ids(ids):
+    """Parámetro con una lista de ids: array en PostgreSQL (= ANY(?)) y
+    texto JSON en SQLite (IN (SELECT value FROM json_each(?)))"""
+    ids = list(ids)
+    return ids if SQL.postgres else json.dumps(ids)
 
-    conn.commit()
-    conn.close()
-    print("Base de datos inicializada correctamente")
+SQL.registrar('crear_usuario', '''
+    INSERT INTO usuario (nombre, apellido, email, password)
+    VALUES (?, ?, ?, ?)
+    RETURNING id
+''')
+SQL.registrar('crear_contacto', 'INSERT INTO contacto (usuario_id) VALUES (?)')
 
+@medir_db
 def crear_usuario(nombre, apellido, email, password):
     """Crear un nuevo usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-
-    # Usar placeholders según el tipo de BD
-    placeholder = '%s' if is_postgres() else '?'
-
-    try:
-        if is_postgres():
-            cursor.execute(f'''
-                INSERT INTO usuario (nombre, apellido, email, password)
-                VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder})
-                RETURNING id
-            ''', (nombre, apellido, email, password))
-            usuario_id = cursor.fetchone()['id']
+    # El hash se calcula antes de pedir una conexión para no retenerla
+    password = hashear_password(password)
 
-            cursor.execute(f'''
-                INSERT INTO contacto (usuario_id)
-                VALUES ({placeholder})
-            ''', (usuario_id,))
-        else:
-            cursor.execute(f'''
-                INSERT INTO usuario (nombre, apellido, email, password)
-                VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder})
-            ''', (nombre, apellido, email, password))
-            usuario_id = cursor.lastrowid
-
-            cursor.execute(f'''
-                INSERT INTO contacto (usuario_id)
-                VALUES ({placeholder})
-            ''', (usuario_id,))
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
 
-        conn.commit()
-        return usuario_id
-    except (sqlite3.IntegrityError, psycopg2.IntegrityError):
+        try:
+            SQL.ejecutar(cursor, 'crear_usuario', (nombre, apellido, email, password))
+            usuario_id = cursor.fetchone()['id']
+            SQL.ejecutar(cursor, 'crear_contacto', (usuario_id,))
+
+            conn.commit()
+            return usuario_id
+        except (sqlite3.IntegrityError, psycopg2.IntegrityError):
+            return None
+
+SQL.registrar('usuario_por_email', '''
+    SELECT * FROM usuario
+    WHERE email = ? AND activo = TRUE
+''', preparar=True)
+SQL.registrar('registrar_acceso', '''
+    UPDATE usuario
+    SET ultimo_acceso = CURRENT_TIMESTAMP
+    WHERE id = ?
+''', preparar=True)
+SQL.registrar('registrar_acceso_rehash', '''
+    UPDATE usuario
+    SET ultimo_acceso = CURRENT_TIMESTAMP, password = ?
+    WHERE id = ?
+''')
+
+@medir_db
+def verificar_usuario(email, password):
+    """Verificar credenciales de usuario
+
+    La contraseña se comprueba contra el hash fuera de la conexión. Si el
+    valor guardado está en texto plano o con un coste de scrypt antiguo, se
+    reemplaza por un hash nuevo en el mismo UPDATE del último acceso.
+    """
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'usuario_por_email', (email,))
+        usuario = cursor.fetchone()
+
+    usuario = dict(usuario) if usuario else None
+    valida, necesita_rehash = verificar_password(password, usuario['password'] if usuario else None)
+    if not valida:
         return None
-    finally:
-        conn.close()
 
-def verificar_usuario(email, password):
-    """Verificar credenciales de usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    # Para PostgreSQL, activo es booleano; para SQLite es 1
-    activo_value = True if is_postgres() else 1
-
-    cursor.execute(f'''
-        SELECT * FROM usuario
-        WHERE email = {placeholder} AND password = {placeholder} AND activo = {placeholder}
-    ''', (email, password, activo_value))
-
-    usuario = cursor.fetchone()
-
-    if usuario:
-        # Actualizar último acceso
-        cursor.execute(f'''
-            UPDATE usuario
-            SET ultimo_acceso = CURRENT_TIMESTAMP
-            WHERE id = {placeholder}
-        ''', (usuario['id'],))
+    nuevo_hash = hashear_password(password) if necesita_rehash else None
+
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        if nuevo_hash:
+            # Actualizar último acceso y migrar la contraseña al hash actual
+            SQL.ejecutar(cursor, 'registrar_acceso_rehash', (nuevo_hash, usuario['id']))
+            usuario['password'] = nuevo_hash
+        else:
+            # Actualizar último acceso
+            SQL.ejecutar(cursor, 'registrar_acceso', (usuario['id'],))
         conn.commit()
 
-    conn.close()
-    return dict(usuario) if usuario else None
+    return usuario
 
-def obtener_sistema_usuario(usuario_id):
-    """Obtener el sistema CAEC asociado a un usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
+SQL.registrar('sistemas_de_usuario', '''
+    SELECT * FROM sistema_caec
+    WHERE usuario_id = ?
+    ORDER BY fecha_vinculacion DESC
+''', preparar=True)
 
-    cursor.execute(f'''
-        SELECT * FROM sistema_caec
-        WHERE usuario_id = {placeholder} AND estado = 'activo'
-    ''', (usuario_id,))
+@memoizar_por_usuario(cache_usuarios)
+@medir_db
+def _sistemas_de_usuario(usuario_id):
+    """Todos los sistemas del usuario (más recientes primero), con una sola consulta"""
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'sistemas_de_usuario', (usuario_id,))
+        return [dict(sistema) for sistema in cursor.fetchall()]
 
-    sistema = cursor.fetchone()
-    conn.close()
+def obtener_sistema_usuario(usuario_id):
+    """Obtener el sistema CAEC asociado a un usuario"""
+    return obtener_sistema_activo(usuario_id)
 
-    return dict(sistema) if sistema else None
+SQL.registrar('validar_codigo', '''
+    SELECT * FROM sistema_caec
+    WHERE codigo_sistema = ? AND (usuario_id IS NULL OR estado = 'disponible')
+''', preparar=True)
 
+@medir_db
 def validar_codigo_sistema(codigo_sistema):
     """Validar si un código de sistema existe y está disponible"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    cursor.execute(f'''
-        SELECT * FROM sistema_caec
-        WHERE codigo_sistema = {placeholder} AND (usuario_id IS NULL OR estado = 'disponible')
-    ''', (codigo_sistema,))
-
-    sistema = cursor.fetchone()
-    conn.close()
-
-    return dict(sistema) if sistema else None
-
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'validar_codigo', (codigo_sistema,))
+        sistema = cursor.fetchone()
+
+        return dict(sistema) if sistema else None
+
+SQL.registrar('vincular_sistema', '''
+    UPDATE sistema_caec
+    SET usuario_id = ?,
+        nombre_sistema = ?,
+        fecha_vinculacion = CURRENT_TIMESTAMP,
+        ultimo_sync = CURRENT_TIMESTAMP,
+        estado = 'activo'
+    WHERE codigo_sistema = ?
+''')
+
+@medir_db
 def vincular_sistema_usuario(codigo_sistema, usuario_id, nombre_sistema=None):
     """Vincular un sistema CAEC a un usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    try:
-        if nombre_sistema is None:
-            nombre_sistema = f"Mi Sistema CAEC"
-
-        cursor.execute(f'''
-            UPDATE sistema_caec
-            SET usuario_id = {placeholder},
-                nombre_sistema = {placeholder},
-                fecha_vinculacion = CURRENT_TIMESTAMP,
-                ultimo_sync = CURRENT_TIMESTAMP,
-                estado = 'activo'
-            WHERE codigo_sistema = {placeholder}
-        ''', (usuario_id, nombre_sistema, codigo_sistema))
-
-        conn.commit()
-        success = cursor.rowcount > 0
-        conn.close()
-        return success
-    except Exception as e:
-        print(f"Error al vincular sistema: {e}")
-        conn.close()
-        return False
-
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+
+        try:
+            if nombre_sistema is None:
+                nombre_sistema = f"Mi Sistema CAEC"
+
+            SQL.ejecutar(cursor, 'vincular_sistema', (usuario_id, nombre_sistema, codigo_sistema))
+
+            conn.commit()
+            invalidar_usuario(cache_usuarios, usuario_id)
+            return cursor.rowcount > 0
+        except Exception as e:
+            print(f"Error al vincular sistema: {e}")
+            contar_error_db('vincular_sistema_usuario')
+            return False
+
+SQL.registrar('actualizar_sync', '''
+    UPDATE sistema_caec
+    SET ultimo_sync = CURRENT_TIMESTAMP
+    WHERE id = ?
+''')
+
+@medir_db
 def actualizar_ultimo_sync(sistema_id):
     """Actualizar la última sincronización del sistema"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    cursor.execute(f'''
-        UPDATE sistema_caec
-        SET ultimo_sync = CURRENT_TIMESTAMP
-        WHERE id = {placeholder}
-    ''', (sistema_id,))
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'actualizar_sync', (sistema_id,))
+        conn.commit()
 
-    conn.commit()
-    conn.close()
+SQL.registrar('usuario_por_id', '''
+    SELECT u.*, c.telefono, c.celular, c.direccion, c.ciudad, c.pais, c.codigo_postal
+    FROM usuario u
+    LEFT JOIN contacto c ON u.id = c.usuario_id
+    WHERE u.id = ?
+''', preparar=True)
 
+@memoizar_por_usuario(cache_usuarios)
+@medir_db
 def obtener_usuario_por_id(usuario_id):
     """Obtener datos completos del usuario incluyendo información de contacto"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    cursor.execute(f'''
-        SELECT u.*, c.telefono, c.celular, c.direccion, c.ciudad, c.pais, c.codigo_postal
-        FROM usuario u
-        LEFT JOIN contacto c ON u.id = c.usuario_id
-        WHERE u.id = {placeholder}
-    ''', (usuario_id,))
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'usuario_por_id', (usuario_id,))
+        usuario = cursor.fetchone()
+
+        return dict(usuario) if usuario else None
+
+SQL.registrar('actualizar_nombre_usuario', '''
+    UPDATE usuario
+    SET nombre = ?, apellido = ?
+    WHERE id = ?
+''')
+SQL.registrar('actualizar_contacto', '''
+    UPDATE contacto
+    SET telefono = ?, celular = ?, direccion = ?,
+        ciudad = ?, codigo_postal = ?, pais = ?
+    WHERE usuario_id = ?
+''')
+
+@medir_db
+def actualizar_usuario(usuario_id, nombre, apellido, telefono, celular, direccion, ciudad, codigo_postal, pais):
+    """Actualizar información del usuario y contacto"""
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
 
-    usuario = cursor.fetchone()
-    conn.close()
+        try:
+            # Actualizar datos del usuario
+            SQL.ejecutar(cursor, 'actualizar_nombre_usuario', (nombre, apellido, usuario_id))
 
-    return dict(usuario) if usuario else None
+            # Actualizar datos de contacto
+            SQL.ejecutar(cursor, 'actualizar_contacto',
+                         (telefono, celular, direccion, ciudad, codigo_postal, pais, usuario_id))
 
-def actualizar_usuario(usuario_id, nombre, apellido, telefono, celular, direccion, ciudad, codigo_postal, pais):
-    """Actualizar información del usuario y contacto"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    try:
-        # Actualizar datos del usuario
-        cursor.execute(f'''
-            UPDATE usuario
-            SET nombre = {placeholder}, apellido = {placeholder}
-            WHERE id = {placeholder}
-        ''', (nombre, apellido, usuario_id))
-
-        # Actualizar datos de contacto
-        cursor.execute(f'''
-            UPDATE contacto
-            SET telefono = {placeholder}, celular = {placeholder}, direccion = {placeholder},
-                ciudad = {placeholder}, codigo_postal = {placeholder}, pais = {placeholder}
-            WHERE usuario_id = {placeholder}
-        ''', (telefono, celular, direccion, ciudad, codigo_postal, pais, usuario_id))
+            conn.commit()
+            invalidar_usuario(cache_usuarios, usuario_id)
+            success = True
+        except Exception as e:
+            print(f"Error al actualizar usuario: {e}")
+            contar_error_db('actualizar_usuario')
+            success = False
 
-        conn.commit()
-        success = True
-    except Exception as e:
-        print(f"Error al actualizar usuario: {e}")
-        success = False
-    finally:
-        conn.close()
+        return success
 
-    return success
+SQL.registrar('cambiar_password', '''
+    UPDATE usuario
+    SET password = ?
+    WHERE id = ?
+''')
 
+@medir_db
 def cambiar_password(usuario_id, nueva_password):
     """Cambiar la contraseña del usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
+    nueva_password = hashear_password(nueva_password)
 
-    try:
-        cursor.execute(f'''
-            UPDATE usuario
-            SET password = {placeholder}
-            WHERE id = {placeholder}
-        ''', (nueva_password, usuario_id))
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
 
-        conn.commit()
-        success = cursor.rowcount > 0
-    except Exception as e:
-        print(f"Error al cambiar contraseña: {e}")
-        success = False
-    finally:
-        conn.close()
+        try:
+            SQL.ejecutar(cursor, 'cambiar_password', (nueva_password, usuario_id))
 
-    return success
+            conn.commit()
+            invalidar_usuario(cache_usuarios, usuario_id)
+            success = cursor.rowcount > 0
+        except Exception as e:
+            print(f"Error al cambiar contraseña: {e}")
+            contar_error_db('cambiar_password')
+            success = False
+
+        return success
 
 def obtener_sistema_activo(usuario_id):
     """Obtener el sistema activo del usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    cursor.execute(f'''
-        SELECT * FROM sistema_caec
-        WHERE usuario_id = {placeholder} AND estado = 'activo'
-        LIMIT 1
-    ''', (usuario_id,))
-
-    sistema = cursor.fetchone()
-    conn.close()
-
-    return dict(sistema) if sistema else None
+    for sistema in _sistemas_de_usuario(usuario_id):
+        if sistema['estado'] == 'activo':
+            return sistema
+    return None
 
 def obtener_todos_sistemas_usuario(usuario_id, exclude_active=False):
     """Obtener todos los sistemas del usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
+    sistemas = _sistemas_de_usuario(usuario_id)
     if exclude_active:
-        cursor.execute(f'''
-            SELECT * FROM sistema_caec
-            WHERE usuario_id = {placeholder} AND estado != 'activo'
-            ORDER BY fecha_vinculacion DESC
-        ''', (usuario_id,))
-    else:
-        cursor.execute(f'''
-            SELECT * FROM sistema_caec
-            WHERE usuario_id = {placeholder}
-            ORDER BY fecha_vinculacion DESC
-        ''', (usuario_id,))
+        sistemas = [sistema for sistema in sistemas if sistema['estado'] != 'activo']
+    return sistemas
 
-    sistemas = cursor.fetchall()
-    conn.close()
-
-    return [dict(sistema) for sistema in sistemas]
+SQL.registrar('crear_sistema', '''
+    INSERT INTO sistema_caec
+    (codigo_sistema, usuario_id, nombre_sistema, fecha_vinculacion, ultimo_sync, estado, modelo, version_firmware)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 'activo', ?, '1.0.0')
+    RETURNING id
+''')
 
+@medir_db
 def crear_sistema_caec(usuario_id, nombre, ubicacion, tipo_sistema, descripcion=None):
     """Crear un nuevo sistema CAEC para el usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    try:
-        # Generar código único para el sistema
-        codigo_sistema = f"CAEC-{secrets.token_hex(4).upper()}"
-
-        if is_postgres():
-            cursor.execute(f'''
-                INSERT INTO sistema_caec
-                (codigo_sistema, usuario_id, nombre_sistema, fecha_vinculacion, ultimo_sync, estado, modelo, version_firmware)
-                VALUES ({placeholder}, {placeholder}, {placeholder}, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 'activo', {placeholder}, '1.0.0')
-                RETURNING id
-            ''', (codigo_sistema, usuario_id, f"{nombre} ({ubicacion})", tipo_sistema))
-            system_id = cursor.fetchone()['id']
-        else:
-            cursor.execute(f'''
-                INSERT INTO sistema_caec
-                (codigo_sistema, usuario_id, nombre_sistema, fecha_vinculacion, ultimo_sync, estado, modelo, version_firmware)
-                VALUES ({placeholder}, {placeholder}, {placeholder}, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 'activo', {placeholder}, '1.0.0')
-            ''', (codigo_sistema, usuario_id, f"{nombre} ({ubicacion})", tipo_sistema))
-            system_id = cursor.lastrowid
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
 
-        conn.commit()
-        return system_id
-    except Exception as e:
-        print(f"Error al crear sistema: {e}")
-        return None
-    finally:
-        conn.close()
+        try:
+            # Generar código único para el sistema
+            codigo_sistema = f"CAEC-{secrets.token_hex(4).upper()}"
+
+            SQL.ejecutar(cursor, 'crear_sistema',
+                         (codigo_sistema, usuario_id, f"{nombre} ({ubicacion})", tipo_sistema))
+            system_id = cursor.fetchone()['id']
 
+            conn.commit()
+            invalidar_usuario(cache_usuarios, usuario_id)
+            return system_id
+        except Exception as e:
+            print(f"Error al crear sistema: {e}")
+            contar_error_db('crear_sistema_caec')
+            return None
+
+SQL.registrar('desactivar_sistemas', '''
+    UPDATE sistema_caec
+    SET estado = 'inactivo'
+    WHERE usuario_id = ?
+''')
+SQL.registrar('activar_sistema', '''
+    UPDATE sistema_caec
+    SET estado = 'activo'
+    WHERE id = ? AND usuario_id = ?
+''')
+
+@medir_db
 def activar_sistema(usuario_id, system_id):
     """Activar un sistema específico y desactivar los demás"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
-
-    try:
-        # Desactivar todos los sistemas del usuario
-        cursor.execute(f'''
-            UPDATE sistema_caec
-            SET estado = 'inactivo'
-            WHERE usuario_id = {placeholder}
-        ''', (usuario_id,))
-
-        # Activar el sistema seleccionado
-        cursor.execute(f'''
-            UPDATE sistema_caec
-            SET estado = 'activo'
-            WHERE id = {placeholder} AND usuario_id = {placeholder}
-        ''', (system_id, usuario_id))
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
 
-        conn.commit()
-        success = cursor.rowcount > 0
-    except Exception as e:
-        print(f"Error al activar sistema: {e}")
-        success = False
-    finally:
-        conn.close()
+        try:
+            # Desactivar todos los sistemas del usuario
+            SQL.ejecutar(cursor, 'desactivar_sistemas', (usuario_id,))
+
+            # Activar el sistema seleccionado
+            SQL.ejecutar(cursor, 'activar_sistema', (system_id, usuario_id))
+
+            conn.commit()
+            invalidar_usuario(cache_usuarios, usuario_id)
+            success = cursor.rowcount > 0
+        except Exception as e:
+            print(f"Error al activar sistema: {e}")
+            contar_error_db('activar_sistema')
+            success = False
+
+        return success
 
-    return success
+SQL.registrar('eliminar_sistema', '''
+    DELETE FROM sistema_caec
+    WHERE id = ? AND usuario_id = ?
+''')
 
+@medir_db
 def eliminar_sistema(usuario_id, system_id):
     """Eliminar un sistema del usuario"""
-    conn = get_db_connection()
-    cursor = get_cursor(conn)
-    placeholder = '%s' if is_postgres() else '?'
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
 
-    try:
-        cursor.execute(f'''
-            DELETE FROM sistema_caec
-            WHERE id = {placeholder} AND usuario_id = {placeholder}
-        ''', (system_id, usuario_id))
+        try:
+            SQL.ejecutar(cursor, 'eliminar_sistema', (system_id, usuario_id))
 
+            conn.commit()
+            invalidar_usuario(cache_usuarios, usuario_id)
+            success = cursor.rowcount > 0
+        except Exception as e:
+            print(f"Error al eliminar sistema: {e}")
+            contar_error_db('eliminar_sistema')
+            success = False
+
+        return success
+
+# Parámetros de irrigación guardados por sistema (además de la versión)
+COLUMNAS_CONFIG_IRRIGACION = ('potencia_ahorro', 'duracion_ahorro', 'duracion_abundante')
+
+SQL.registrar('config_irrigacion', f'''
+    SELECT s.id AS sistema_id, {', '.join(f'c.{columna}' for columna in COLUMNAS_CONFIG_IRRIGACION)},
+           COALESCE(c.version, 0) AS version, c.actualizado
+    FROM sistema_caec s
+    LEFT JOIN config_irrigacion c ON c.sistema_id = s.id
+    WHERE s.id = ?
+''', preparar=True)
+
+@medir_db
+def obtener_config_irrigacion(sistema_id):
+    """Configuración de irrigación de un sistema
+
+    Devuelve None si el sistema no existe; si nunca se guardó, los parámetros
+    vienen a None con versión 0.
+    """
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'config_irrigacion', (sistema_id,))
+        config = cursor.fetchone()
+        return dict(config) if config else None
+
+SQL.registrar('guardar_config_irrigacion', f'''
+    INSERT INTO config_irrigacion
+    (sistema_id, {', '.join(COLUMNAS_CONFIG_IRRIGACION)}, version, actualizado)
+    VALUES (?, ?, ?, ?, 1, CURRENT_TIMESTAMP)
+    ON CONFLICT (sistema_id) DO UPDATE SET
+        {', '.join(f'{columna} = excluded.{columna}' for columna in COLUMNAS_CONFIG_IRRIGACION)},
+        version = config_irrigacion.version + 1,
+        actualizado = CURRENT_TIMESTAMP
+    RETURNING sistema_id, {', '.join(COLUMNAS_CONFIG_IRRIGACION)}, version, actualizado
+''')
+
+@medir_db
+def guardar_config_irrigacion(sistema_id, potencia_ahorro, duracion_ahorro, duracion_abundante):
+    """Guardar la configuración de irrigación incrementando su versión
+
+    Devuelve la configuración guardada (con la versión nueva).
+    """
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'guardar_config_irrigacion',
+                     (sistema_id, potencia_ahorro, duracion_ahorro, duracion_abundante))
+        config = dict(cursor.fetchone())
+        conn.commit()
+        return config
+
+SQL.registrar('encolar_comando', '''
+    INSERT INTO comandos_sistema (sistema_id, tipo, payload)
+    VALUES (?, ?, ?)
+    RETURNING id
+''')
+
+@medir_db
+def encolar_comando(sistema_id, tipo, payload):
+    """Guardar un comando para el controlador de un sistema; devuelve su id"""
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'encolar_comando', (sistema_id, tipo, json.dumps(payload)))
+        comando_id = cursor.fetchone()['id']
         conn.commit()
-        success = cursor.rowcount > 0
-    except Exception as e:
-        print(f"Error al eliminar sistema: {e}")
-        success = False
-    finally:
-        conn.close()
-
-    return success
+        return comando_id
+
+SQL.registrar('entregar_comandos', '''
+    UPDATE comandos_sistema
+    SET estado = 'entregado', entregado = CURRENT_TIMESTAMP
+    WHERE sistema_id = ? AND id > ? AND estado <> 'confirmado'
+    RETURNING id, tipo, payload, creado
+''', preparar=True)
+
+@medir_db
+def entregar_comandos(sistema_id, despues_de):
+    """Comandos sin confirmar con id > despues_de, en orden, marcados como entregados
+
+    Un comando entregado se vuelve a entregar mientras no se confirme.
+    """
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'entregar_comandos', (sistema_id, despues_de))
+        comandos = [dict(comando) for comando in cursor.fetchall()]
+        conn.commit()
+    for comando in comandos:
+        comando['payload'] = json.loads(comando['payload'])
+        comando['creado'] = _a_datetime(comando['creado'])
+    return sorted(comandos, key=lambda comando: comando['id'])
+
+SQL.registrar('confirmar_comandos', '''
+    UPDATE comandos_sistema
+    SET estado = 'confirmado', confirmado = CURRENT_TIMESTAMP
+    WHERE sistema_id = ? AND id <= ? AND estado <> 'confirmado'
+''')
+
+@medir_db
+def confirmar_comandos(sistema_id, hasta):
+    """Confirmar (acumulativamente) los comandos de un sistema con id <= hasta"""
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'confirmar_comandos', (sistema_id, hasta))
+        conn.commit()
+        return cursor.rowcount
+
+SQL.registrar('comandos_nuevos', '''
+    SELECT id, sistema_id FROM comandos_sistema
+    WHERE id > ? AND estado <> 'confirmado'
+    ORDER BY id
+''', preparar=True)
+
+@medir_db
+def comandos_nuevos(despues_de):
+    """(id, sistema_id) de los comandos creados después de despues_de, de todos los sistemas"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        SQL.ejecutar(cursor, 'comandos_nuevos', (despues_de,))
+        return [(fila[0], fila[1]) for fila in cursor.fetchall()]
+
+SQL.registrar('ultimo_comando', 'SELECT MAX(id) FROM comandos_sistema')
+
+@medir_db
+def ultimo_comando():
+    """Id del último comando creado (0 si no hay ninguno)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        SQL.ejecutar(cursor, 'ultimo_comando')
+        return cursor.fetchone()[0] or 0
+
+SQL.registrar('ultimo_comando_sistema', '''
+    SELECT MAX(id) FROM comandos_sistema
+    WHERE sistema_id = ? AND estado <> 'confirmado'
+''', preparar=True)
+
+@medir_db
+def ultimo_comando_pendiente(sistema_id):
+    """Id del último comando sin confirmar de un sistema (0 si no hay ninguno)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        SQL.ejecutar(cursor, 'ultimo_comando_sistema', (sistema_id,))
+        return cursor.fetchone()[0] or 0
+
+# Columnas de sensor_data que envían los controladores (además de sistema_id y timestamp)
+COLUMNAS_LECTURA = ('nivel_agua', 'ph', 'temperatura', 'nivel_nutrientes', 'irrigacion_activa', 'luz_activa')
+
+# Agregados de sensor_data: resolución -> tabla
+TABLAS_ROLLUP = {
+    'minuto': 'sensor_rollup_minuto',
+    'hora': 'sensor_rollup_hora',
+    'dia': 'sensor_rollup_dia',
+}
+
+# Segundos que cubre cada cubeta de agregados
+SEGUNDOS_ROLLUP = {
+    'minuto': 60,
+    'hora': 3600,
+    'dia': 86400,
+}
+
+# Estadísticas que se guardan por columna en las tablas de agregados
+ESTADISTICAS_ROLLUP = ('min', 'max', 'suma', 'cuenta')
+
+# Columnas de las tablas de agregados (después de sistema_id y bucket)
+COLUMNAS_ROLLUP = tuple(
+    f'{columna}_{estadistica}'
+    for columna in COLUMNAS_LECTURA
+    for estadistica in ESTADISTICAS_ROLLUP
+)
+
+def _valor_timestamp(momento):
+    """Adaptar un datetime (UTC, sin zona) al formato de la base de datos"""
+    if SQL.postgres:
+        return momento
+    # Mismo formato que CURRENT_TIMESTAMP en SQLite
+    return momento.strftime('%Y-%m-%d %H:%M:%S')
+
+def _a_datetime(valor):
+    """Convertir un timestamp leído de la base de datos a datetime"""
+    if valor is None or isinstance(valor, datetime):
+        return valor
+    return datetime.fromisoformat(valor)
+
+def _sql_upsert_rollup(tabla):
+    """Upsert de un lote de cubetas sobre una tabla de agregados"""
+    asignaciones = []
+    for columna in COLUMNAS_LECTURA:
+        minimo, maximo, suma, cuenta = (f'{columna}_{e}' for e in ESTADISTICAS_ROLLUP)
+        asignaciones += [
+            f'''{minimo} = CASE WHEN {tabla}.{minimo} IS NULL OR excluded.{minimo} < {tabla}.{minimo}
+                THEN excluded.{minimo} ELSE {tabla}.{minimo} END''',
+            f'''{maximo} = CASE WHEN {tabla}.{maximo} IS NULL OR excluded.{maximo} > {tabla}.{maximo}
+                THEN excluded.{maximo} ELSE {tabla}.{maximo} END''',
+            f'{suma} = COALESCE({tabla}.{suma}, 0) + excluded.{suma}',
+            f'{cuenta} = {tabla}.{cuenta} + excluded.{cuenta}',
+        ]
+    columnas = ('sistema_id', 'bucket') + COLUMNAS_ROLLUP
+    conflicto = f"ON CONFLICT (sistema_id, bucket) DO UPDATE SET {', '.join(asignaciones)}"
+    marcas = ', '.join('?' for _ in columnas)
+    return {
+        'sqlite': f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ({marcas}) {conflicto}",
+        'postgres': f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES ? {conflicto}",
+    }
+
+for _resolucion, _tabla in TABLAS_ROLLUP.items():
+    SQL.registrar(f'rollup_{_resolucion}', **_sql_upsert_rollup(_tabla))
+    SQL.registrar(f'historial_{_resolucion}', f'''
+        SELECT bucket, {', '.join(COLUMNAS_ROLLUP)} FROM {_tabla}
+        WHERE sistema_id = ? AND bucket >= ? AND bucket < ?
+        ORDER BY bucket
+    ''')
+
+def _inicio_bucket(momento, resolucion):
+    """Truncar un instante al inicio de su cubeta"""
+    if resolucion == 'minuto':
+        return momento.replace(second=0, microsecond=0)
+    if resolucion == 'hora':
+        return momento.replace(minute=0, second=0, microsecond=0)
+    return momento.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _agregar_lecturas(lecturas, resolucion):
+    """Agrupar un lote de lecturas por (sistema_id, cubeta)
+
+    Devuelve las filas a combinar con la tabla de agregados, ordenadas por
+    clave para que transacciones concurrentes bloqueen en el mismo orden.
+    """
+    grupos = {}
+    for lectura in lecturas:
+        clave = (lectura['sistema_id'], _inicio_bucket(lectura['timestamp'], resolucion))
+        estado = grupos.get(clave)
+        if estado is None:
+            estado = grupos[clave] = {columna: [None, None, 0.0, 0] for columna in COLUMNAS_LECTURA}
+        for columna in COLUMNAS_LECTURA:
+            valor = lectura.get(columna)
+            if valor is None:
+                continue
+            valor = float(valor)
+            stats = estado[columna]
+            if stats[0] is None or valor < stats[0]:
+                stats[0] = valor
+            if stats[1] is None or valor > stats[1]:
+                stats[1] = valor
+            stats[2] += valor
+            stats[3] += 1
+
+    filas = []
+    for (sistema_id, bucket), estado in sorted(grupos.items()):
+        fila = [sistema_id, _valor_timestamp(bucket)]
+        for columna in COLUMNAS_LECTURA:
+            fila.extend(estado[columna])
+        filas.append(tuple(fila))
+    return filas
+
+def _actualizar_rollups(cursor, lecturas):
+    """Combinar un lote de lecturas con las tablas de agregados (upsert incremental)"""
+    for resolucion in TABLAS_ROLLUP:
+        SQL.ejecutar_lote(cursor, f'rollup_{resolucion}', _agregar_lecturas(lecturas, resolucion))
+
+def elegir_resolucion(desde, hasta, max_puntos, intervalo_lecturas):
+    """Elegir la resolución del histórico para un rango y un presupuesto de puntos
+
+    Se usan lecturas crudas solo si caben en el presupuesto; si no, la
+    resolución de agregados más fina cuyo número de cubetas no supera
+    max_puntos (o la diaria si ninguna cabe). Así un rango de 30 días nunca
+    lee sensor_data.
+    """
+    segundos = max((hasta - desde).total_seconds(), 0)
+    if segundos / max(intervalo_lecturas, 1) <= max_puntos:
+        return 'raw'
+    for resolucion in ('minuto', 'hora'):
+        if segundos / SEGUNDOS_ROLLUP[resolucion] <= max_puntos:
+            return resolucion
+    return 'dia'
+
+SQL.registrar('ultima_lectura', f'''
+    SELECT sistema_id, timestamp, {', '.join(COLUMNAS_LECTURA)} FROM sensor_data
+    WHERE sistema_id = ?
+    ORDER BY timestamp DESC
+    LIMIT 1
+''', preparar=True)
+
+@medir_db
+def obtener_ultima_lectura(sistema_id):
+    """Obtener la lectura más reciente de un sistema (o None si no hay datos)"""
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'ultima_lectura', (sistema_id,))
+        lectura = cursor.fetchone()
+
+    if not lectura:
+        return None
+    lectura = dict(lectura)
+    lectura['timestamp'] = _a_datetime(lectura['timestamp'])
+    return lectura
+
+# Una búsqueda "última por timestamp" por sistema: usa el índice
+# (sistema_id, timestamp) de cada partición en vez de recorrer el histórico
+if SQL.postgres:
+    SQL.registrar('ultimas_lecturas', f'''
+        SELECT d.sistema_id, d.timestamp, {', '.join('d.' + c for c in COLUMNAS_LECTURA)}
+        FROM unnest(?::integer[]) AS s(id)
+        CROSS JOIN LATERAL (
+            SELECT * FROM sensor_data m
+            WHERE m.sistema_id = s.id
+            ORDER BY m.timestamp DESC
+            LIMIT 1
+        ) d
+    ''', preparar=True)
+
+@medir_db
+def obtener_ultimas_lecturas(sistema_ids):
+    """Obtener la lectura más reciente de varios sistemas (una sola consulta en PostgreSQL)
+
+    Devuelve un diccionario sistema_id -> lectura (solo sistemas con datos).
+    """
+    if not sistema_ids:
+        return {}
+
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        if SQL.postgres:
+            SQL.ejecutar(cursor, 'ultimas_lecturas', (list(sistema_ids),))
+            filas = cursor.fetchall()
+        else:
+            # SQLite no lleva el LIMIT 1 por sistema dentro de la vista UNION ALL
+            # en una consulta combinada: una búsqueda indexada por sistema
+            filas = []
+            for sistema_id in sistema_ids:
+                SQL.ejecutar(cursor, 'ultima_lectura', (sistema_id,))
+                fila = cursor.fetchone()
+                if fila:
+                    filas.append(fila)
+
+    lecturas = {}
+    for fila in filas:
+        lectura = dict(fila)
+        lectura['timestamp'] = _a_datetime(lectura['timestamp'])
+        lecturas[lectura['sistema_id']] = lectura
+    return lecturas
+
+# Columnas de sistema_caec que muestra la vista de flota
+COLUMNAS_FLOTA = (
+    'id', 'codigo_sistema', 'nombre_sistema', 'estado', 'modelo',
+    'version_firmware', 'fecha_vinculacion', 'ultimo_sync',
+)
+
+def _sentencia_flota(con_cursor, por_estado, por_modelo):
+    """Nombre de la sentencia de una página de la flota (una variante por filtro)"""
+    nombre = f'flota_{int(con_cursor)}{int(por_estado)}{int(por_modelo)}'
+    if nombre in SQL:
+        return nombre
+
+    condiciones = ['s.usuario_id = ?']
+    if con_cursor:
+        # Keyset: continúa justo después de la última fila de la página anterior
+        condiciones.append('(s.fecha_vinculacion, s.id) < (?, ?)')
+    if por_estado:
+        condiciones.append('s.estado = ?')
+    if por_modelo:
+        condiciones.append('s.modelo = ?')
+    columnas = ', '.join('s.' + c for c in COLUMNAS_FLOTA)
+    filtro = ' AND '.join(condiciones)
+
+    SQL.registrar(
+        nombre,
+        # SQLite no lleva el LIMIT 1 por sistema dentro de la vista UNION ALL:
+        # la última lectura se busca aparte, sistema por sistema
+        sqlite=f'''
+            SELECT {columnas} FROM sistema_caec s
+            WHERE {filtro}
+            ORDER BY s.fecha_vinculacion DESC, s.id DESC
+            LIMIT ?
+        ''',
+        postgres=f'''
+            SELECT {columnas}, d.timestamp AS lectura_timestamp,
+                   {', '.join('d.' + c for c in COLUMNAS_LECTURA)}
+            FROM sistema_caec s
+            LEFT JOIN LATERAL (
+                SELECT * FROM sensor_data m
+                WHERE m.sistema_id = s.id
+                ORDER BY m.timestamp DESC
+                LIMIT 1
+            ) d ON TRUE
+            WHERE {filtro}
+            ORDER BY s.fecha_vinculacion DESC, s.id DESC
+            LIMIT ?
+        ''',
+        preparar=True,
+    )
+    return nombre
+
+def cursor_flota(sistema):
+    """Cursor opaco que apunta justo después de `sistema` en la flota"""
+    return f"{sistema['fecha_vinculacion'].isoformat()}_{sistema['id']}"
+
+def _leer_cursor_flota(valor):
+    fecha, _, sistema_id = valor.rpartition('_')
+    return _valor_timestamp(datetime.fromisoformat(fecha)), int(sistema_id)
+
+@medir_db
+def obtener_flota(usuario_id, limite=50, despues=None, estado=None, modelo=None):
+    """Página de la flota del usuario, de la vinculación más reciente a la más antigua
+
+    Cada sistema lleva su última lectura en 'ultima_lectura' (None si no tiene
+    datos). `despues` es el cursor devuelto por la página anterior; lanza
+    ValueError si no es válido. Devuelve (sistemas, cursor de la siguiente
+    página o None si es la última).
+    """
+    parametros = [usuario_id]
+    if despues:
+        parametros.extend(_leer_cursor_flota(despues))
+    if estado:
+        parametros.append(estado)
+    if modelo:
+        parametros.append(modelo)
+    # Una fila de más indica si hay otra página
+    parametros.append(limite + 1)
+
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, _sentencia_flota(bool(despues), bool(estado), bool(modelo)), tuple(parametros))
+        filas = [dict(fila) for fila in cursor.fetchall()]
+        siguiente = len(filas) > limite
+        filas = filas[:limite]
+
+        if not SQL.postgres:
+            for fila in filas:
+                SQL.ejecutar(cursor, 'ultima_lectura', (fila['id'],))
+                lectura = cursor.fetchone()
+                fila['lectura_timestamp'] = lectura['timestamp'] if lectura else None
+                for columna in COLUMNAS_LECTURA:
+                    fila[columna] = lectura[columna] if lectura else None
+
+    sistemas = []
+    for fila in filas:
+        sistema = {columna: fila[columna] for columna in COLUMNAS_FLOTA}
+        sistema['fecha_vinculacion'] = _a_datetime(sistema['fecha_vinculacion'])
+        sistema['ultimo_sync'] = _a_datetime(sistema['ultimo_sync'])
+        if fila['lectura_timestamp'] is None:
+            sistema['ultima_lectura'] = None
+        else:
+            sistema['ultima_lectura'] = {columna: fila[columna] for columna in COLUMNAS_LECTURA}
+            sistema['ultima_lectura']['timestamp'] = _a_datetime(fila['lectura_timestamp'])
+        sistemas.append(sistema)
+
+    return sistemas, cursor_flota(sistemas[-1]) if siguiente else None
+
+SQL.registrar('historial_raw', f'''
+    SELECT timestamp, {', '.join(COLUMNAS_LECTURA)} FROM sensor_data
+    WHERE sistema_id = ? AND timestamp >= ? AND timestamp < ?
+    ORDER BY timestamp DESC
+    LIMIT ?
+''')
+
+@medir_db
+def obtener_historial(sistema_id, desde, hasta, resolucion, max_puntos, columnas=COLUMNAS_LECTURA):
+    """Obtener el histórico de un sistema en [desde, hasta) con la resolución indicada
+
+    Devuelve una lista de diccionarios {'timestamp': datetime, columna: {'min', 'max', 'avg', 'count'}}.
+    Con resolución 'raw' se devuelven como mucho las max_puntos lecturas más recientes.
+    """
+    parametros = (sistema_id, _valor_timestamp(desde), _valor_timestamp(hasta))
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        if resolucion == 'raw':
+            SQL.ejecutar(cursor, 'historial_raw', parametros + (int(max_puntos),))
+            filas = cursor.fetchall()[::-1]
+        else:
+            SQL.ejecutar(cursor, f'historial_{resolucion}', parametros)
+            filas = cursor.fetchall()
+
+    # Las sentencias leen todas las columnas; aquí se proyectan las pedidas
+    indices = [(columna, COLUMNAS_LECTURA.index(columna)) for columna in columnas]
+
+    puntos = []
+    for fila in filas:
+        punto = {'timestamp': _a_datetime(fila[0])}
+        if resolucion == 'raw':
+            for columna, indice in indices:
+                valor = fila[1 + indice]
+                if valor is not None:
+                    valor = float(valor)
+                    punto[columna] = {'min': valor, 'max': valor, 'avg': valor, 'count': 1}
+                else:
+                    punto[columna] = None
+        else:
+            for columna, indice in indices:
+                minimo, maximo, suma, cuenta = fila[1 + indice * 4:5 + indice * 4]
+                if cuenta:
+                    punto[columna] = {'min': minimo, 'max': maximo, 'avg': suma / cuenta, 'count': cuenta}
+                else:
+                    punto[columna] = None
+        puntos.append(punto)
+    return puntos
+
+# Exportación: en PostgreSQL una sola consulta leída con un cursor del
+# servidor. En SQLite se recorre cada tabla diaria en páginas por
+# (timestamp, id), para no mantener abierta una transacción de lectura (que
+# bloquearía a los escritores) mientras el cliente descarga.
+if SQL.postgres:
+    SQL.registrar('exportar_lecturas', f'''
+        SELECT timestamp, {', '.join(COLUMNAS_LECTURA)} FROM sensor_data
+        WHERE sistema_id = ? AND timestamp >= ? AND timestamp < ?
+        ORDER BY timestamp, id
+    ''')
+
+def _sentencia_exportacion_sqlite(tabla):
+    """Nombre de la sentencia que lee una página de una tabla diaria de SQLite"""
+    nombre = f'exportar_{tabla}'
+    if nombre not in SQL:
+        SQL.registrar(nombre, f'''
+            SELECT id, timestamp, {', '.join(COLUMNAS_LECTURA)} FROM {tabla}
+            WHERE sistema_id = ? AND timestamp < ?
+              AND (timestamp > ? OR (timestamp = ? AND id > ?))
+            ORDER BY timestamp, id
+            LIMIT ?
+        ''')
+    return nombre
+
+def iterar_lecturas(sistema_id, desde, hasta, tamano_lote=2000, convertir_timestamp=True):
+    """Recorrer las lecturas crudas de un sistema en [desde, hasta), en orden
+
+    Generador de listas de hasta `tamano_lote` tuplas (timestamp, columnas de
+    COLUMNAS_LECTURA...). La memoria usada no depende del tamaño del rango.
+    Con convertir_timestamp=False SQLite entrega el timestamp como texto
+    ('AAAA-MM-DD HH:MM:SS'), para quien lo convierta en bloque.
+    """
+    if SQL.postgres:
+        with db_connection() as conn:
+            # Cursor con nombre: las filas se quedan en el servidor y se
+            # traen de tamano_lote en tamano_lote
+            cursor = conn.cursor(name=f'exportar_{secrets.token_hex(4)}')
+            cursor.itersize = tamano_lote
+            try:
+                cursor.execute(SQL['exportar_lecturas'], (sistema_id, desde, hasta))
+                while True:
+                    filas = cursor.fetchmany(tamano_lote)
+                    if not filas:
+                        return
+                    yield filas
+            finally:
+                cursor.close()
+                conn.rollback()
+        return
+
+    from particiones import tablas_sqlite
+    with db_connection() as conn:
+        tablas = tablas_sqlite(conn.cursor(), desde, hasta)
+        conn.rollback()
+
+    limite = _valor_timestamp(hasta)
+    for tabla in tablas:
+        sentencia = _sentencia_exportacion_sqlite(tabla)
+        ultimo_momento, ultimo_id = _valor_timestamp(desde), -1
+        while True:
+            # Cada página se lee entera y se cierra la lectura antes de entregarla
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    SQL.ejecutar(cursor, sentencia, (sistema_id, limite, ultimo_momento,
+                                                     ultimo_momento, ultimo_id, tamano_lote))
+                    filas = cursor.fetchmany(tamano_lote)
+                except sqlite3.OperationalError:
+                    # La tabla se eliminó (retención) durante la exportación
+                    filas = []
+                conn.rollback()
+            if not filas:
+                break
+            ultimo_id, ultimo_momento = filas[-1][0], filas[-1][1]
+            if convertir_timestamp:
+                yield [(_a_datetime(fila[1]),) + tuple(fila[2:]) for fila in filas]
+            else:
+                yield [tuple(fila[1:]) for fila in filas]
+            if len(filas) < tamano_lote:
+                break
+
+SQL.registrar(
+    'sistemas_existentes',
+    sqlite='SELECT id FROM sistema_caec WHERE id IN (SELECT value FROM json_each(?))',
+    postgres='SELECT id FROM sistema_caec WHERE id = ANY(?)',
+    preparar=True,
+)
+
+@medir_db
+def sistemas_desconocidos(sistema_ids):
+    """Los sistema_id de la lista que no existen en sistema_caec (una sola consulta)"""
+    sistemas = sorted(set(sistema_ids))
+    if not sistemas:
+        return []
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        SQL.ejecutar(cursor, 'sistemas_existentes', (_lista_ids(sistemas),))
+        existentes = {fila[0] for fila in cursor.fetchall()}
+    return [sistema_id for sistema_id in sistemas if sistema_id not in existentes]
+
+# Progreso de la cosecha: grados-día (temperatura por encima de temp_base) y
+# horas de luz acumulados por sistema. Cada lote de lecturas integra solo el
+# tramo nuevo desde la última lectura contada, sin releer el histórico.
+
+# Segundos máximos que se da por válida una lectura si no llega la siguiente
+# (un controlador desconectado no sigue sumando horas con su último valor)
+COSECHA_HUECO_MAX = float(os.environ.get('CAEC_COSECHA_HUECO_MAX', 900))
+
+COLUMNAS_COSECHA = (
+    'sistema_id', 'cultivo', 'fecha_siembra', 'temp_base', 'grados_dia', 'horas_luz',
+    'ultima_lectura', 'ultima_temperatura', 'ultima_luz', 'actualizado',
+)
+
+SQL.registrar(
+    'cosecha_crear',
+    sqlite='''
+        INSERT INTO progreso_cosecha (sistema_id, fecha_siembra) VALUES (?, ?)
+        ON CONFLICT (sistema_id) DO NOTHING
+    ''',
+    postgres='''
+        INSERT INTO progreso_cosecha (sistema_id, fecha_siembra) VALUES ?
+        ON CONFLICT (sistema_id) DO NOTHING
+    ''',
+)
+SQL.registrar(
+    'cosecha_bloquear',
+    sqlite='''
+        SELECT sistema_id, fecha_siembra, temp_base, ultima_lectura, ultima_temperatura, ultima_luz
+        FROM progreso_cosecha WHERE sistema_id IN (SELECT value FROM json_each(?))
+    ''',
+    postgres='''
+        SELECT sistema_id, fecha_siembra, temp_base, ultima_lectura, ultima_temperatura, ultima_luz
+        FROM progreso_cosecha WHERE sistema_id = ANY(?)
+        ORDER BY sistema_id
+        FOR UPDATE
+    ''',
+)
+SQL.registrar(
+    'cosecha_acumular',
+    sqlite='''
+        UPDATE progreso_cosecha SET
+            grados_dia = grados_dia + ?, horas_luz = horas_luz + ?,
+            ultima_lectura = ?, ultima_temperatura = ?, ultima_luz = ?,
+            actualizado = CURRENT_TIMESTAMP
+        WHERE sistema_id = ?
+    ''',
+    postgres='''
+        UPDATE progreso_cosecha p SET
+            grados_dia = p.grados_dia + v.grados_dia::double precision,
+            horas_luz = p.horas_luz + v.horas_luz::double precision,
+            ultima_lectura = v.ultima_lectura::timestamp,
+            ultima_temperatura = v.ultima_temperatura::double precision,
+            ultima_luz = v.ultima_luz::boolean,
+            actualizado = CURRENT_TIMESTAMP
+        FROM (VALUES ?) AS v (grados_dia, horas_luz, ultima_lectura, ultima_temperatura, ultima_luz, sistema_id)
+        WHERE p.sistema_id = v.sistema_id
+    ''',
+)
+
+def _acumular_cosecha(estado, lecturas):
+    """Integrar las lecturas de un sistema sobre su estado de cosecha
+
+    Cada tramo entre dos lecturas suma con la temperatura y la luz de la
+    lectura que lo abre (hasta COSECHA_HUECO_MAX segundos) y solo desde la
+    fecha de siembra. Las lecturas anteriores a la última contada llegan
+    atrasadas y no se integran. Devuelve (grados_dia, horas_luz,
+    ultima_lectura, ultima_temperatura, ultima_luz).
+    """
+    momento = _a_datetime(estado['ultima_lectura'])
+    temperatura = estado['ultima_temperatura']
+    luz = None if estado['ultima_luz'] is None else bool(estado['ultima_luz'])
+    siembra = _a_datetime(estado['fecha_siembra'])
+    grados = horas = 0.0
+
+    for lectura in sorted(lecturas, key=lambda lectura: lectura['timestamp']):
+        instante = lectura['timestamp']
+        if momento is not None:
+            if instante <= momento:
+                continue
+            inicio = max(momento, siembra)
+            fin = min(instante, momento + timedelta(seconds=COSECHA_HUECO_MAX))
+            segundos = (fin - inicio).total_seconds()
+            if segundos > 0:
+                if temperatura is not None and temperatura > estado['temp_base']:
+                    grados += (temperatura - estado['temp_base']) * segundos / 86400
+                if luz:
+                    horas += segundos / 3600
+        momento = instante
+        if lectura.get('temperatura') is not None:
+            temperatura = float(lectura['temperatura'])
+        if lectura.get('luz_activa') is not None:
+            luz = bool(lectura['luz_activa'])
+
+    return grados, horas, momento, temperatura, luz
+
+def _actualizar_cosecha(cursor, lecturas):
+    """Sumar un lote de lecturas a los acumuladores de cosecha de sus sistemas
+
+    Un sistema sin fila empieza su cultivo con la primera lectura del lote.
+    En PostgreSQL las filas se bloquean (FOR UPDATE, en orden de sistema_id)
+    para que dos workers no integren el mismo tramo; en SQLite la transacción
+    ya tiene el bloqueo de escritura.
+    """
+    por_sistema = {}
+    for lectura in lecturas:
+        por_sistema.setdefault(lectura['sistema_id'], []).append(lectura)
+    sistemas = sorted(por_sistema)
+
+    nuevas = [
+        (sistema_id, _valor_timestamp(min(lectura['timestamp'] for lectura in por_sistema[sistema_id])))
+        for sistema_id in sistemas
+    ]
+    SQL.ejecutar_lote(cursor, 'cosecha_crear', nuevas)
+
+    SQL.ejecutar(cursor, 'cosecha_bloquear', (_lista_ids(sistemas),))
+    columnas = [columna[0] for columna in cursor.description]
+    filas = []
+    for fila in cursor.fetchall():
+        estado = dict(zip(columnas, fila))
+        grados, horas, momento, temperatura, luz = _acumular_cosecha(estado, por_sistema[estado['sistema_id']])
+        filas.append((grados, horas, _valor_timestamp(momento), temperatura, luz, estado['sistema_id']))
+    if SQL.postgres:
+        SQL.ejecutar_lote(cursor, 'cosecha_acumular', filas)
+    else:
+        cursor.executemany(SQL['cosecha_acumular'], filas)
+
+SQL.registrar('progreso_cosecha', f'''
+    SELECT {', '.join(COLUMNAS_COSECHA)} FROM progreso_cosecha WHERE sistema_id = ?
+''', preparar=True)
+
+@medir_db
+def obtener_progreso_cosecha(sistema_id):
+    """Acumuladores de cosecha de un sistema (una fila por clave primaria), o None"""
+    with db_connection() as conn:
+        cursor = get_cursor(conn)
+        SQL.ejecutar(cursor, 'progreso_cosecha', (sistema_id,))
+        fila = cursor.fetchone()
+    if fila is None:
+        return None
+    progreso = dict(fila)
+    for columna in ('fecha_siembra', 'ultima_lectura', 'actualizado'):
+        progreso[columna] = _a_datetime(progreso[columna])
+    if progreso['ultima_luz'] is not None:
+        progreso['ultima_luz'] = bool(progreso['ultima_luz'])
+    return progreso
+
+SQL.registrar('reiniciar_cosecha', '''
+    INSERT INTO progreso_cosecha
+    (sistema_id, cultivo, fecha_siembra, temp_base, grados_dia, horas_luz, ultima_lectura, actualizado)
+    VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (sistema_id) DO UPDATE SET
+        cultivo = excluded.cultivo, fecha_siembra = excluded.fecha_siembra,
+        temp_base = excluded.temp_base, grados_dia = excluded.grados_dia,
+        horas_luz = excluded.horas_luz, ultima_lectura = excluded.ultima_lectura,
+        ultima_temperatura = NULL, ultima_luz = NULL, actualizado = CURRENT_TIMESTAMP
+''')
+
+@medir_db
+def iniciar_cosecha(sistema_id, cultivo, fecha_siembra, temp_base):
+    """Empezar un cultivo nuevo en un sistema
+
+    Si la siembra es anterior a la hora en curso, los acumuladores parten de
+    los agregados por hora desde la siembra (cada hora con lecturas cuenta
+    entera, con su temperatura media y la fracción de lecturas con luz); desde
+    ahí siguen con la ingesta.
+    """
+    corte = _inicio_bucket(datetime.now(timezone.utc).replace(tzinfo=None), 'hora')
+    grados = horas = 0.0
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if fecha_siembra < corte:
+            SQL.ejecutar(cursor, 'historial_hora',
+                         (sistema_id, _valor_timestamp(fecha_siembra), _valor_timestamp(corte)))
+            indices = {columna: 1 + i for i, columna in enumerate(COLUMNAS_ROLLUP)}
+            for fila in cursor.fetchall():
+                if fila[indices['temperatura_cuenta']]:
+                    media = fila[indices['temperatura_suma']] / fila[indices['temperatura_cuenta']]
+                    grados += max(media - temp_base, 0) / 24
+                if fila[indices['luz_activa_cuenta']]:
+                    horas += fila[indices['luz_activa_suma']] / fila[indices['luz_activa_cuenta']]
+
+        SQL.ejecutar(cursor, 'reiniciar_cosecha', (
+            sistema_id, cultivo, _valor_timestamp(fecha_siembra), temp_base,
+            grados, horas, _valor_timestamp(max(corte, fecha_siembra)),
+        ))
+        conn.commit()
+
+# Alertas: reglas por sistema y métrica, estado de cada alerta (solo existe
+# para las métricas que alguna vez salieron de rango) y notificaciones
+
+COLUMNAS_REGLA_ALERTA = ('minimo', 'maximo', 'histeresis', 'espera', 'activa')
+
+SQL.registrar(
+    'reglas_alerta',
+    sqlite=f'''
+        SELECT sistema_id, metrica, {', '.join(COLUMNAS_REGLA_ALERTA)} FROM reglas_alerta
+        WHERE sistema_id IN (SELECT value FROM json_each(?))
+    ''',
+    postgres=f'''
+        SELECT sistema_id, metrica, {', '.join(COLUMNAS_REGLA_ALERTA)} FROM reglas_alerta
+        WHERE sistema_id = ANY(?)
+    ''',
+    preparar=True,
+)
+
+@medir_db
+def obtener_reglas_alerta(sistema_ids):
+    """Reglas guardadas de varios sistemas: {sistema_id: {metrica: regla}} (una sola consulta)"""
+    sistemas = sorted(set(sistema_ids))
+    reglas = {sistema_id: {} for sistema_id in sistemas}
+    if not sistemas:
+        return reglas
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        SQL.ejecutar(cursor, 'reglas_alerta', (_lista_ids(sistemas),))
+        for fila in cursor.fetchall():
+            regla = dict(zip(COLUMNAS_REGLA_ALERTA, fila[2:]))
+            regla['activa'] = bool(regla['activa'])
+            reglas[fila[0]][fila[1]] = regla
+    return reglas
+
+SQL.registrar('guardar_regla_alerta', f'''
+    INSERT INTO reglas_alerta (sistema_id, metrica, {', '.join(COLUMNAS_REGLA_ALERTA)}, actualizado)
+    VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (sistema_id, metrica) DO UPDATE SET
+        {', '.join(f'{columna} = excluded.{columna}' for columna in COLUMNAS_REGLA_ALERTA)},
+        actualizado = CURRENT_TIMESTAMP
+''')
+
+@medir_db
+def guardar_reglas_alerta(sistema_id, reglas):
+    """Guardar las reglas de un sistema ({metrica: regla}) en una transacción"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        for metrica, regla in sorted(reglas.items()):
+            SQL.ejecutar(cursor, 'guardar_regla_alerta', (sistema_id, metrica) + tuple(
+                regla[columna] for columna in COLUMNAS_REGLA_ALERTA
+            ))
+        conn.commit()
+
+SQL.registrar(
+    'estados_alerta',
+    sqlite='''
+        SELECT sistema_id, metrica, estado, desde, valor FROM estado_alerta
+        WHERE sistema_id IN (SELECT value FROM json_each(?))
+    ''',
+    postgres='''
+        SELECT sistema_id, metrica, estado, desde, valor FROM estado_alerta
+        WHERE sistema_id = ANY(?)
+        ORDER BY sistema_id, metrica
+        FOR UPDATE
+    ''',
+)
+SQL.registrar(
+    'guardar_estados_alerta',
+    sqlite='''
+        INSERT INTO estado_alerta (sistema_id, metrica, estado, desde, valor, actualizado)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (sistema_id, metrica) DO UPDATE SET
+            estado = excluded.estado, desde = excluded.desde, valor = excluded.valor,
+            actualizado = CURRENT_TIMESTAMP
+    ''',
+    postgres='''
+        INSERT INTO estado_alerta (sistema_id, metrica, estado, desde, valor) VALUES ?
+        ON CONFLICT (sistema_id, metrica) DO UPDATE SET
+            estado = excluded.estado, desde = excluded.desde, valor = excluded.valor,
+            actualizado = CURRENT_TIMESTAMP
+    ''',
+)
+SQL.registrar(
+    'crear_notificaciones',
+    sqlite='''
+        INSERT INTO notificaciones (sistema_id, metrica, tipo, mensaje, valor, creada)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''',
+    postgres='''
+        INSERT INTO notificaciones (sistema_id, metrica, tipo, mensaje, valor, creada) VALUES ?
+    ''',
+)
+
+@medir_db
+def evaluar_alertas(sistema_ids, evaluar):
+    """Aplicar `evaluar` al estado de las alertas de varios sistemas en una transacción
+
+    `evaluar(estados)` recibe {(sistema_id, metrica): estado} con los estados
+    guardados (bloqueados con FOR UPDATE en PostgreSQL; en SQLite la
+    transacción toma el bloqueo de escritura) y devuelve (cambios,
+    notificaciones): los estados que cambiaron con la misma clave y las
+    notificaciones a crear. Devuelve las notificaciones creadas.
+    """
+    sistemas = sorted(set(sistema_ids))
+    if not sistemas:
+        return []
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        if not SQL.postgres:
+            cursor.execute('BEGIN IMMEDIATE')
+        SQL.ejecutar(cursor, 'estados_alerta', (_lista_ids(sistemas),))
+        estados = {
+            (fila[0], fila[1]): {'estado': fila[2], 'desde': _a_datetime(fila[3]), 'valor': fila[4]}
+            for fila in cursor.fetchall()
+        }
+        cambios, notificaciones = evaluar(estados)
+        if not cambios and not notificaciones:
+            conn.rollback()
+            return []
+
+        SQL.ejecutar_lote(cursor, 'guardar_estados_alerta', [
+            (sistema_id, metrica, estado['estado'], _valor_timestamp(estado['desde']), estado['valor'])
+            for (sistema_id, metrica), estado in sorted(cambios.items())
+        ])
+        if notificaciones:
+            SQL.ejecutar_lote(cursor, 'crear_notificaciones', [
+                (n['sistema_id'], n['metrica'], n['tipo'], n['mensaje'], n['valor'], _valor_timestamp(n['creada']))
+                for n in notificaciones
+            ])
+        conn.commit()
+    return notificaciones
+
+COLUMNAS_NOTIFICACION = ('id', 'metrica', 'tipo', 'mensaje', 'valor', 'creada', 'leida')
+
+SQL.registrar('notificaciones', f'''
+    SELECT {', '.join(COLUMNAS_NOTIFICACION)} FROM notificaciones
+    WHERE sistema_id = ? AND id < ?
+    ORDER BY id DESC
+    LIMIT ?
+''', preparar=True)
+SQL.registrar('notificaciones_sin_leer', '''
+    SELECT COUNT(*) FROM notificaciones WHERE sistema_id = ? AND NOT leida
+''', preparar=True)
+
+@medir_db
+def obtener_notificaciones(sistema_id, limite=20, antes_de=None):
+    """Notificaciones de un sistema de la más nueva a la más antigua
+
+    `antes_de` es el id de la última notificación de la página anterior.
+    Devuelve (notificaciones, sin_leer).
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        SQL.ejecutar(cursor, 'notificaciones', (sistema_id, antes_de or 2 ** 62, limite))
+        notificaciones = [dict(zip(COLUMNAS_NOTIFICACION, fila)) for fila in cursor.fetchall()]
+        SQL.ejecutar(cursor, 'notificaciones_sin_leer', (sistema_id,))
+        sin_leer = cursor.fetchone()[0]
+    for notificacion in notificaciones:
+        notificacion['creada'] = _a_datetime(notificacion['creada'])
+        notificacion['leida'] = bool(notificacion['leida'])
+    return notificaciones, sin_leer
+
+SQL.registrar('marcar_notificaciones', '''
+    UPDATE notificaciones SET leida = TRUE
+    WHERE sistema_id = ? AND id <= ? AND NOT leida
+''')
+
+@medir_db
+def marcar_notificaciones_leidas(sistema_id, hasta_id):
+    """Marcar como leídas las notificaciones de un sistema hasta un id; devuelve cuántas"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        SQL.ejecutar(cursor, 'marcar_notificaciones', (sistema_id, hasta_id))
+        marcadas = cursor.rowcount
+        conn.commit()
+    return marcadas
+
+# En PostgreSQL sensor_data reparte las filas entre sus particiones; en
+# SQLite es una vista y se inserta en la tabla diaria (ver particiones.py)
+if SQL.postgres:
+    SQL.registrar('insertar_lecturas', f'''
+        INSERT INTO sensor_data (sistema_id, timestamp, {', '.join(COLUMNAS_LECTURA)})
+        VALUES ?
+    ''')
+
+def _sentencia_insercion_sqlite(tabla):
+    """Nombre de la sentencia que inserta en una tabla diaria de SQLite (se registra al primer uso)"""
+    nombre = f'insertar_{tabla}'
+    if nombre not in SQL:
+        SQL.registrar(nombre, f'''
+            INSERT INTO {tabla} (sistema_id, timestamp, {', '.join(COLUMNAS_LECTURA)})
+            VALUES ({', '.join('?' for _ in range(2 + len(COLUMNAS_LECTURA)))})
+        ''')
+    return nombre
+
+SQL.registrar(
+    'sync_sistemas',
+    sqlite='''
+        UPDATE sistema_caec SET ultimo_sync = CURRENT_TIMESTAMP
+        WHERE id IN (SELECT value FROM json_each(?))
+    ''',
+    postgres='''
+        UPDATE sistema_caec SET ultimo_sync = CURRENT_TIMESTAMP
+        WHERE id = ANY(?)
+    ''',
+    preparar=True,
+)
+
+@medir_db
+def insertar_lecturas(lecturas):
+    """Insertar un lote de lecturas de sensores en una sola transacción
+
+    Cada lectura es un diccionario con sistema_id, timestamp (datetime UTC)
+    y las columnas de COLUMNAS_LECTURA. Devuelve (insertadas, sistemas_desconocidos):
+    si algún sistema_id no existe no se inserta nada.
+    """
+    if not lecturas:
+        return 0, []
+
+    filas = [
+        (lectura['sistema_id'], _valor_timestamp(lectura['timestamp']))
+        + tuple(lectura.get(columna) for columna in COLUMNAS_LECTURA)
+        for lectura in lecturas
+    ]
+    sistemas = sorted({lectura['sistema_id'] for lectura in lecturas})
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Validar todos los sistemas del lote con una sola consulta
+        SQL.ejecutar(cursor, 'sistemas_existentes', (_lista_ids(sistemas),))
+        existentes = {fila[0] for fila in cursor.fetchall()}
+        desconocidos = [sistema_id for sistema_id in sistemas if sistema_id not in existentes]
+        if desconocidos:
+            return 0, desconocidos
+
+        if SQL.postgres:
+            # Inserción multi-fila: una sentencia por cada 1000 lecturas
+            SQL.ejecutar_lote(cursor, 'insertar_lecturas', filas)
+        else:
+            from particiones import particion_sqlite
+            por_dia = {}
+            for lectura, fila in zip(lecturas, filas):
+                por_dia.setdefault(lectura['timestamp'].date(), []).append(fila)
+            for dia, filas_dia in sorted(por_dia.items()):
+                tabla = particion_sqlite(cursor, dia)
+                SQL.ejecutar_lote(cursor, _sentencia_insercion_sqlite(tabla), filas_dia)
+        SQL.ejecutar(cursor, 'sync_sistemas', (_lista_ids(sistemas),))
+
+        # Mantener los agregados y la cosecha en la misma transacción que las lecturas
+        _actualizar_rollups(cursor, lecturas)
+        _actualizar_cosecha(cursor, lecturas)
+
+        conn.commit()
+
+    return len(filas), []
 
 # Inicializar la base de datos al importar el módulo
 if __name__ == "__main__":
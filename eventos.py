@@ -0,0 +1,75 @@
+"""
+Hub de eventos en memoria: reparte cada evento publicado para una clave
+(p. ej. un sistema_id) entre todos sus suscriptores del proceso
+"""
+
+import queue
+import threading
+
+
+class Suscripcion:
+    """Cola de eventos de un suscriptor"""
+
+    def __init__(self, clave, max_cola):
+        self.clave = clave
+        self._cola = queue.Queue(maxsize=max_cola)
+
+    def _entregar(self, evento):
+        # Si el suscriptor va atrasado se descarta su evento más antiguo
+        while True:
+            try:
+                self._cola.put_nowait(evento)
+                return
+            except queue.Full:
+                try:
+                    self._cola.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def esperar(self, timeout=None):
+        """Esperar el siguiente evento; devuelve None si vence el timeout"""
+        try:
+            return self._cola.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Hub:
+    """Fan-out de eventos por clave: publicar no consulta la base de datos
+    ni depende del número de suscriptores más allá de encolar"""
+
+    def __init__(self, max_cola=100):
+        self.max_cola = max_cola
+        self._suscriptores = {}
+        self._lock = threading.Lock()
+
+    def suscribir(self, clave):
+        suscripcion = Suscripcion(clave, self.max_cola)
+        with self._lock:
+            self._suscriptores.setdefault(clave, set()).add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, suscripcion):
+        with self._lock:
+            suscriptores = self._suscriptores.get(suscripcion.clave)
+            if suscriptores is not None:
+                suscriptores.discard(suscripcion)
+                if not suscriptores:
+                    del self._suscriptores[suscripcion.clave]
+
+    def publicar(self, clave, evento):
+        """Entregar un evento a todos los suscriptores de la clave"""
+        with self._lock:
+            suscriptores = list(self._suscriptores.get(clave, ()))
+        for suscripcion in suscriptores:
+            suscripcion._entregar(evento)
+        return len(suscriptores)
+
+    def claves(self):
+        """Claves con al menos un suscriptor"""
+        with self._lock:
+            return list(self._suscriptores)
+
+    def total_suscriptores(self):
+        with self._lock:
+            return sum(len(s) for s in self._suscriptores.values())
@@ -0,0 +1,85 @@
+"""
+Exportación del histórico de lecturas en CSV o JSON Lines, generada por trozos
+
+Las filas llegan en lotes desde database.iterar_lecturas() y cada lote se
+convierte (y opcionalmente se comprime con gzip) antes de pedir el
+siguiente, así la memoria no depende del rango exportado.
+"""
+
+import csv
+import io
+import json
+import os
+import zlib
+
+from database import COLUMNAS_LECTURA, iterar_lecturas
+
+FORMATOS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+}
+
+# Nivel de compresión gzip (1 = más rápido, 9 = más pequeño)
+NIVEL_GZIP = int(os.environ.get('CAEC_EXPORT_NIVEL_GZIP', 6))
+
+COLUMNAS_BOOLEANAS = ('irrigacion_activa', 'luz_activa')
+
+
+def _valor(columna, valor):
+    if valor is None:
+        return None
+    if columna in COLUMNAS_BOOLEANAS:
+        return bool(valor)
+    return float(valor)
+
+
+def _texto_csv(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, bool):
+        return 'true' if valor else 'false'
+    return repr(valor)
+
+
+def _filas_csv(lote):
+    salida = io.StringIO()
+    escritor = csv.writer(salida, lineterminator='\n')
+    for fila in lote:
+        escritor.writerow([fila[0].strftime('%Y-%m-%dT%H:%M:%SZ')] + [
+            _texto_csv(_valor(columna, valor)) for columna, valor in zip(COLUMNAS_LECTURA, fila[1:])
+        ])
+    return salida.getvalue()
+
+
+def _filas_jsonl(lote):
+    lineas = []
+    for fila in lote:
+        registro = {'timestamp': fila[0].strftime('%Y-%m-%dT%H:%M:%SZ')}
+        for columna, valor in zip(COLUMNAS_LECTURA, fila[1:]):
+            registro[columna] = _valor(columna, valor)
+        lineas.append(json.dumps(registro, separators=(',', ':')) + '\n')
+    return ''.join(lineas)
+
+
+def generar_exportacion(sistema_id, desde, hasta, formato='csv', comprimir=False):
+    """Generador de bytes con el histórico de un sistema en [desde, hasta)"""
+    # wbits=31: formato gzip (cabecera y CRC), no deflate crudo
+    compresor = zlib.compressobj(NIVEL_GZIP, zlib.DEFLATED, 31) if comprimir else None
+
+    def trozo(texto):
+        datos = texto.encode('utf-8')
+        return compresor.compress(datos) if compresor else datos
+
+    if formato == 'csv':
+        convertir = _filas_csv
+        yield trozo(','.join(('timestamp',) + COLUMNAS_LECTURA) + '\n')
+    else:
+        convertir = _filas_jsonl
+
+    for lote in iterar_lecturas(sistema_id, desde, hasta):
+        datos = trozo(convertir(lote))
+        if datos:
+            yield datos
+
+    if compresor:
+        yield compresor.flush()
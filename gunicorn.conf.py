@@ -0,0 +1,47 @@
+"""
+Configuración de gunicorn (se carga automáticamente al ejecutar `gunicorn app:app`
+desde la raíz del proyecto)
+"""
+
+import os
+
+# Segundos que tiene un worker para terminar al reiniciar o desplegar
+graceful_timeout = int(os.environ.get('CAEC_GRACEFUL_TIMEOUT', 30))
+
+# `sync` atiende una petición por worker; con `gevent` cada worker mantiene
+# hasta worker_connections conexiones abiertas (long-polls, SSE) en greenlets
+worker_class = os.environ.get('CAEC_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('CAEC_WORKER_CONNECTIONS', 2000))
+
+# Identificador de esta ejecución para el directorio de métricas (ver
+# metricas.py): el pid del maestro, heredado por los workers
+os.environ.setdefault('CAEC_METRICAS_EJECUCION', str(os.getpid()))
+
+
+def on_starting(server):
+    """Subir el límite de descriptores abiertos para las conexiones de los workers"""
+    try:
+        import resource
+    except ImportError:
+        return
+    suave, duro = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # Cada conexión usa un socket; el resto (base de datos, logs) cabe en el margen
+    necesarios = worker_connections + 1024
+    if suave != resource.RLIM_INFINITY and suave < necesarios:
+        nuevo = necesarios if duro == resource.RLIM_INFINITY else min(necesarios, duro)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (nuevo, duro))
+        if nuevo < necesarios:
+            server.log.warning("Límite de descriptores (%s) menor que worker_connections", nuevo)
+
+
+def worker_exit(server, worker):
+    """Escribir las lecturas que siguen en la cola antes de que el worker termine"""
+    from ingesta import cola_lecturas
+    if not cola_lecturas.drenar(timeout=max(graceful_timeout - 5, 1)):
+        server.log.warning("El worker %s termina con lecturas sin escribir", worker.pid)
+
+
+def child_exit(server, worker):
+    """Conservar los contadores del worker terminado y borrar su archivo de métricas"""
+    import metricas
+    metricas.registro.proceso_terminado(worker.pid)
@@ -0,0 +1,329 @@
+"""
+Ingesta de lecturas de sensores enviadas por los controladores CAEC
+"""
+
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import metricas
+from alertas import evaluar
+from cache import FALTA, TTLCache
+from cola_escritura import ColaEscritura
+from database import (
+    COLUMNAS_LECTURA, insertar_lecturas, obtener_ultima_lectura, obtener_ultimas_lecturas,
+    sistemas_desconocidos
+)
+from eventos import Hub
+
+# Máximo de lecturas aceptadas en una sola petición
+MAX_LOTE = int(os.environ.get('CAEC_INGESTA_MAX_LOTE', 5000))
+
+# Intervalo nominal (segundos) entre lecturas de un controlador
+INTERVALO_LECTURAS = float(os.environ.get('CAEC_INTERVALO_LECTURAS', 5))
+
+# Última lectura por sistema_id, actualizada directamente por la ingesta
+ultimas_lecturas = TTLCache(
+    max_size=int(os.environ.get('CAEC_CACHE_LECTURAS_MAX', 10000)),
+    ttl=float(os.environ.get('CAEC_CACHE_LECTURAS_TTL', 5)),
+)
+
+# Reparto de lecturas nuevas a los streams en vivo (clave: sistema_id)
+hub_lecturas = Hub()
+
+# Cada cuántos segundos se buscan lecturas ingeridas por otros workers
+INTERVALO_SONDEO = float(os.environ.get('CAEC_SSE_SONDEO', 2))
+
+# Escritura diferida: la petición se responde al encolar y un hilo por worker
+# inserta las lecturas en lotes de CAEC_INGESTA_LOTE filas o cada
+# CAEC_INGESTA_INTERVALO_MS milisegundos (lo que ocurra antes)
+ASINCRONA = os.environ.get('CAEC_INGESTA_ASINCRONA', '1') != '0'
+
+# Segundos que se pide esperar al controlador cuando la cola está llena
+RETRY_AFTER = int(os.environ.get('CAEC_INGESTA_RETRY_AFTER', 2))
+
+# Sistemas que existen, para validar los lotes sin consultar la base de datos
+sistemas_conocidos = TTLCache(
+    max_size=int(os.environ.get('CAEC_CACHE_LECTURAS_MAX', 10000)),
+    ttl=300,
+)
+
+COLUMNAS_NUMERICAS = ('nivel_agua', 'ph', 'temperatura', 'nivel_nutrientes')
+COLUMNAS_BOOLEANAS = ('irrigacion_activa', 'luz_activa')
+
+
+class LecturaInvalida(ValueError):
+    """La lectura enviada por el controlador no es válida"""
+
+
+class IngestaSaturada(Exception):
+    """La cola de escritura de lecturas está llena"""
+
+
+def ahora_utc():
+    """Instante actual en UTC sin zona horaria (formato de sensor_data)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def parsear_timestamp(valor):
+    """Convertir un timestamp ISO 8601 o epoch a datetime UTC sin zona"""
+    if valor is None:
+        return ahora_utc()
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        try:
+            momento = datetime.fromtimestamp(valor, timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise LecturaInvalida(f"timestamp no válido: {valor!r}")
+    elif isinstance(valor, str):
+        try:
+            momento = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+        except ValueError:
+            raise LecturaInvalida(f"timestamp no válido: {valor!r}")
+    else:
+        raise LecturaInvalida(f"timestamp no válido: {valor!r}")
+
+    if momento.tzinfo is not None:
+        momento = momento.astimezone(timezone.utc).replace(tzinfo=None)
+    return momento.replace(microsecond=0)
+
+
+def _parsear_numero(nombre, valor):
+    if valor is None:
+        return None
+    if isinstance(valor, bool) or not isinstance(valor, (int, float, str)):
+        raise LecturaInvalida(f"{nombre} debe ser numérico")
+    try:
+        numero = float(valor)
+    except ValueError:
+        raise LecturaInvalida(f"{nombre} debe ser numérico")
+    if numero != numero or numero in (float('inf'), float('-inf')):
+        raise LecturaInvalida(f"{nombre} debe ser un número finito")
+    return numero
+
+
+def _parsear_booleano(nombre, valor):
+    if valor is None:
+        return None
+    if isinstance(valor, bool):
+        return valor
+    if valor in (0, 1):
+        return bool(valor)
+    if isinstance(valor, str) and valor.lower() in ('true', 'false', '1', '0'):
+        return valor.lower() in ('true', '1')
+    raise LecturaInvalida(f"{nombre} debe ser booleano")
+
+
+def normalizar_lectura(datos, sistema_id=None):
+    """Validar una lectura y convertirla al formato de insertar_lecturas()
+
+    `sistema_id` es el valor por defecto cuando la lectura no trae el suyo
+    (peticiones con un único sistema).
+    """
+    if not isinstance(datos, dict):
+        raise LecturaInvalida("Cada lectura debe ser un objeto JSON")
+
+    sistema = datos.get('sistema_id', sistema_id)
+    if isinstance(sistema, bool) or not isinstance(sistema, int) or sistema <= 0:
+        raise LecturaInvalida("sistema_id no válido")
+
+    lectura = {
+        'sistema_id': sistema,
+        'timestamp': parsear_timestamp(datos.get('timestamp')),
+    }
+    for columna in COLUMNAS_NUMERICAS:
+        lectura[columna] = _parsear_numero(columna, datos.get(columna))
+    for columna in COLUMNAS_BOOLEANAS:
+        lectura[columna] = _parsear_booleano(columna, datos.get(columna))
+
+    if all(lectura[columna] is None for columna in COLUMNAS_LECTURA):
+        raise LecturaInvalida("La lectura no contiene ninguna medición")
+
+    return lectura
+
+
+def normalizar_lote(payload):
+    """Extraer y validar las lecturas de una petición de ingesta
+
+    Acepta {"lecturas": [...]} con sistema_id en cada lectura, o
+    {"sistema_id": N, "lecturas": [...]} para un único sistema.
+    """
+    if not isinstance(payload, dict):
+        raise LecturaInvalida("El cuerpo debe ser un objeto JSON")
+
+    lecturas = payload.get('lecturas')
+    if not isinstance(lecturas, list) or not lecturas:
+        raise LecturaInvalida("Se requiere una lista 'lecturas' no vacía")
+    if len(lecturas) > MAX_LOTE:
+        raise LecturaInvalida(f"Máximo {MAX_LOTE} lecturas por petición")
+
+    sistema_id = payload.get('sistema_id')
+    normalizadas = []
+    for indice, datos in enumerate(lecturas):
+        try:
+            normalizadas.append(normalizar_lectura(datos, sistema_id))
+        except LecturaInvalida as e:
+            raise LecturaInvalida(f"Lectura {indice}: {e}")
+    return normalizadas
+
+
+def procesar_lote(lecturas):
+    """Guardar un lote de lecturas ya normalizadas
+
+    Devuelve (insertadas, sistemas_desconocidos).
+    """
+    insertadas, desconocidos = insertar_lecturas(lecturas)
+    if insertadas:
+        _actualizar_ultimas_lecturas(lecturas)
+        _evaluar_alertas(lecturas)
+    return insertadas, desconocidos
+
+
+def encolar_lote(lecturas):
+    """Aceptar un lote para escribirlo en segundo plano
+
+    Devuelve (aceptadas, sistemas_desconocidos); si algún sistema no existe
+    no se acepta nada. Lanza IngestaSaturada si la cola no tiene sitio.
+    """
+    sistemas = {lectura['sistema_id'] for lectura in lecturas}
+    pendientes = [sistema_id for sistema_id in sistemas if sistemas_conocidos.get(sistema_id, None) is None]
+    if pendientes:
+        desconocidos = sistemas_desconocidos(pendientes)
+        if desconocidos:
+            return 0, desconocidos
+        for sistema_id in pendientes:
+            sistemas_conocidos.set(sistema_id, True)
+
+    if not cola_lecturas.encolar(lecturas):
+        raise IngestaSaturada()
+    return len(lecturas), []
+
+
+def _escribir_lecturas(lecturas):
+    """Escritor de la cola: insertar un lote y publicar las últimas lecturas"""
+    insertadas, desconocidos = insertar_lecturas(lecturas)
+    if desconocidos:
+        # Sistemas eliminados después de aceptar sus lecturas: se descartan
+        print(f"Lecturas descartadas de sistemas eliminados: {desconocidos}")
+        for sistema_id in desconocidos:
+            sistemas_conocidos.delete(sistema_id)
+        lecturas = [lectura for lectura in lecturas if lectura['sistema_id'] not in desconocidos]
+        insertadas, _ = insertar_lecturas(lecturas)
+    if insertadas:
+        _actualizar_ultimas_lecturas(lecturas)
+        _evaluar_alertas(lecturas)
+
+
+def _evaluar_alertas(lecturas):
+    """Evaluar las reglas de alerta sobre lecturas ya guardadas
+
+    Un fallo no se propaga: las lecturas están escritas y la cola de escritura
+    reintentaría el lote entero.
+    """
+    try:
+        evaluar(lecturas)
+    except Exception as e:
+        print(f"Error al evaluar alertas: {e}")
+
+
+cola_lecturas = ColaEscritura(
+    _escribir_lecturas,
+    capacidad=int(os.environ.get('CAEC_INGESTA_COLA_MAX', 50000)),
+    lote=int(os.environ.get('CAEC_INGESTA_LOTE', 500)),
+    intervalo=float(os.environ.get('CAEC_INGESTA_INTERVALO_MS', 200)) / 1000,
+    nombre='escritor-lecturas',
+)
+
+# Al terminar el worker (también desde el hook worker_exit de gunicorn.conf.py)
+atexit.register(cola_lecturas.drenar)
+
+lecturas_en_cola = metricas.registro.gauge(
+    'caec_ingest_queue_readings', 'Lecturas en la cola de escritura (pendientes y capacidad)', ('state',))
+lecturas_procesadas = metricas.registro.contador(
+    'caec_ingest_readings_total', 'Lecturas de la cola por resultado (escritas, rechazadas, descartadas)', ('result',))
+_contadas = {}
+
+
+@metricas.registro.recolector
+def _metricas_cola():
+    estadisticas = cola_lecturas.estadisticas()
+    for estado in ('pendientes', 'capacidad'):
+        lecturas_en_cola.set(estado, valor=estadisticas[estado])
+    for resultado in ('escritas', 'rechazadas', 'descartadas'):
+        nuevas = estadisticas[resultado] - _contadas.get(resultado, 0)
+        if nuevas:
+            lecturas_procesadas.inc(resultado, cantidad=nuevas)
+            _contadas[resultado] = estadisticas[resultado]
+
+
+def _actualizar_ultimas_lecturas(lecturas):
+    """Actualizar la caché de últimas lecturas con lo más reciente del lote"""
+    recientes = {}
+    for lectura in lecturas:
+        actual = recientes.get(lectura['sistema_id'])
+        if actual is None or lectura['timestamp'] >= actual['timestamp']:
+            recientes[lectura['sistema_id']] = lectura
+
+    for lectura in recientes.values():
+        _publicar_si_nueva(lectura)
+
+
+def _publicar_si_nueva(lectura, misma_hora=True):
+    """Guardar la lectura en caché y notificar a los streams si es la más reciente
+
+    `misma_hora` acepta una lectura con el mismo timestamp que la guardada
+    (lecturas recién ingeridas); el sondeo la rechaza para no republicar.
+    """
+    en_cache = ultimas_lecturas.get(lectura['sistema_id'], None)
+    # Las lecturas atrasadas no reemplazan a una más nueva
+    if (en_cache is None or lectura['timestamp'] > en_cache['timestamp']
+            or (misma_hora and lectura['timestamp'] == en_cache['timestamp'])):
+        lectura = dict(lectura)
+        ultimas_lecturas.set(lectura['sistema_id'], lectura)
+        hub_lecturas.publicar(lectura['sistema_id'], lectura)
+
+
+def obtener_lectura_actual(sistema_id):
+    """Última lectura de un sistema: desde la caché o, si no está, de la base de datos"""
+    lectura = ultimas_lecturas.get(sistema_id)
+    if lectura is FALTA:
+        lectura = obtener_ultima_lectura(sistema_id)
+        # También se guarda None para no consultar en cada poll a sistemas sin datos
+        ultimas_lecturas.set(sistema_id, lectura)
+    return lectura
+
+
+_sondeo_pid = None
+_sondeo_lock = threading.Lock()
+
+
+def iniciar_sondeo():
+    """Arrancar (una vez por proceso) el hilo que trae lecturas de otros workers
+
+    Con varios workers de gunicorn la lectura puede ingerirse en un proceso
+    distinto del que mantiene el stream. El hilo hace una única consulta por
+    intervalo para todos los sistemas con suscriptores en este proceso, sin
+    importar cuántos streams haya abiertos.
+    """
+    global _sondeo_pid
+    with _sondeo_lock:
+        if _sondeo_pid == os.getpid():
+            return
+        _sondeo_pid = os.getpid()
+        threading.Thread(target=_bucle_sondeo, name='sondeo-lecturas', daemon=True).start()
+
+
+def _bucle_sondeo():
+    while True:
+        time.sleep(INTERVALO_SONDEO)
+        sistemas = hub_lecturas.claves()
+        if not sistemas:
+            continue
+        try:
+            lecturas = obtener_ultimas_lecturas(sistemas)
+        except Exception as e:
+            print(f"Error en el sondeo de lecturas: {e}")
+            continue
+        for lectura in lecturas.values():
+            _publicar_si_nueva(lectura, misma_hora=False)
@@ -0,0 +1,373 @@
+"""
+Métricas en formato de texto de Prometheus, agregadas entre workers
+
+Cada proceso acumula sus métricas en memoria y las vuelca (como mucho una
+vez por CAEC_METRICAS_VOLCADO segundos) a un archivo propio en un directorio
+compartido. /metrics lee los archivos de todos los procesos y los combina:
+contadores e histogramas se suman; los gauges se suman solo entre procesos
+vivos (un worker muerto ya no tiene peticiones en curso). Cuando gunicorn
+recoge a un worker terminado, sus contadores e histogramas pasan al archivo
+común de los procesos terminados y se borra el suyo.
+"""
+
+import atexit
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, request
+
+# Directorio compartido por los workers. Por defecto uno por ejecución del
+# servidor: el primer proceso que lo necesita (el maestro de gunicorn, desde
+# gunicorn.conf.py) fija CAEC_METRICAS_EJECUCION a su pid y los workers la
+# heredan, así un reinicio no suma los valores de la ejecución anterior.
+os.environ.setdefault('CAEC_METRICAS_EJECUCION', str(os.getpid()))
+DIRECTORIO = os.environ.get('CAEC_METRICAS_DIR') or os.path.join(
+    tempfile.gettempdir(), f"caec-metricas-{os.environ['CAEC_METRICAS_EJECUCION']}"
+)
+
+# Archivo con lo acumulado por los procesos ya terminados
+TERMINADOS = 'terminados.json'
+
+# Segundos mínimos entre volcados del proceso a su archivo
+INTERVALO_VOLCADO = float(os.environ.get('CAEC_METRICAS_VOLCADO', 1))
+
+# Límites (segundos) de los histogramas de latencia
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def _clave(self, valores):
+        if len(valores) != len(self.etiquetas):
+            raise ValueError(f"{self.nombre} espera las etiquetas {self.etiquetas}")
+        return tuple(str(valor) for valor in valores)
+
+    def exportar(self):
+        with self._lock:
+            return [[list(clave), valor] for clave, valor in self._valores.items()]
+
+
+class Contador(_Metrica):
+    """Valor que solo crece"""
+    tipo = 'counter'
+
+    def inc(self, *etiquetas, cantidad=1):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
+
+
+class Gauge(_Metrica):
+    """Valor que sube y baja (o se fija)"""
+    tipo = 'gauge'
+
+    def inc(self, *etiquetas, cantidad=1):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
+
+    def dec(self, *etiquetas, cantidad=1):
+        self.inc(*etiquetas, cantidad=-cantidad)
+
+    def set(self, *etiquetas, valor):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = valor
+
+
+class Histograma(_Metrica):
+    """Distribución de observaciones en buckets acumulativos"""
+    tipo = 'histogram'
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_LATENCIA):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *etiquetas, valor):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            estado = self._valores.get(clave)
+            if estado is None:
+                # [cuentas por bucket (sin acumular) + inf, suma]
+                estado = self._valores[clave] = [[0] * (len(self.buckets) + 1), 0.0]
+            for indice, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    break
+            else:
+                indice = len(self.buckets)
+            estado[0][indice] += 1
+            estado[1] += valor
+
+
+class Registro:
+    """Métricas del proceso y volcado/lectura de los archivos compartidos"""
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+        self._metricas = {}
+        self._recolectores = []
+        self._ultimo_volcado = 0.0
+        self._lock_volcado = threading.Lock()
+
+    def _registrar(self, metrica):
+        self._metricas[metrica.nombre] = metrica
+        return metrica
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._registrar(Contador(nombre, ayuda, etiquetas))
+
+    def gauge(self, nombre, ayuda, etiquetas=()):
+        return self._registrar(Gauge(nombre, ayuda, etiquetas))
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_LATENCIA):
+        return self._registrar(Histograma(nombre, ayuda, etiquetas, buckets))
+
+    def recolector(self, funcion):
+        """Registrar una función que actualiza gauges justo antes de cada volcado"""
+        self._recolectores.append(funcion)
+        return funcion
+
+    def volcar(self, forzar=False):
+        """Escribir las métricas del proceso en su archivo (atómico)"""
+        ahora = time.monotonic()
+        if not forzar and ahora - self._ultimo_volcado < INTERVALO_VOLCADO:
+            return
+        if not self._lock_volcado.acquire(blocking=forzar):
+            return
+        try:
+            self._ultimo_volcado = ahora
+            for funcion in self._recolectores:
+                try:
+                    funcion()
+                except Exception as e:
+                    print(f"Error al recolectar métricas: {e}")
+
+            datos = {
+                nombre: {
+                    'tipo': metrica.tipo,
+                    'ayuda': metrica.ayuda,
+                    'etiquetas': list(metrica.etiquetas),
+                    'buckets': list(getattr(metrica, 'buckets', ())),
+                    'valores': metrica.exportar(),
+                }
+                for nombre, metrica in self._metricas.items()
+            }
+            os.makedirs(self.directorio, exist_ok=True)
+            ruta = os.path.join(self.directorio, f'{os.getpid()}.json')
+            temporal = f'{ruta}.tmp'
+            with open(temporal, 'w') as f:
+                json.dump(datos, f)
+            os.replace(temporal, ruta)
+        finally:
+            self._lock_volcado.release()
+
+    def _leer(self, archivo):
+        try:
+            with open(os.path.join(self.directorio, archivo)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _leer_procesos(self):
+        """Métricas volcadas por cada proceso: lista de (pid, vivo, datos)
+
+        Lo acumulado por los procesos terminados va con pid None.
+        """
+        procesos = []
+        if not os.path.isdir(self.directorio):
+            return procesos
+        for archivo in os.listdir(self.directorio):
+            if not archivo.endswith('.json'):
+                continue
+            datos = self._leer(archivo)
+            if datos is None:
+                continue
+            if archivo == TERMINADOS:
+                procesos.append((None, False, datos))
+            else:
+                pid = int(archivo[:-5])
+                procesos.append((pid, _proceso_vivo(pid), datos))
+        return procesos
+
+    def proceso_terminado(self, pid):
+        """Pasar las métricas de un proceso terminado a TERMINADOS y borrar su archivo
+
+        Lo llama el maestro de gunicorn (child_exit) al recoger a un worker:
+        contadores e histogramas no retroceden y el directorio no crece con
+        cada worker reiniciado. Los gauges del proceso se descartan.
+        """
+        ruta = os.path.join(self.directorio, f'{pid}.json')
+        datos = self._leer(f'{pid}.json')
+        if datos is not None:
+            combinadas = {}
+            _sumar(combinadas, self._leer(TERMINADOS) or {}, gauges=False)
+            _sumar(combinadas, datos, gauges=False)
+            temporal = os.path.join(self.directorio, f'{TERMINADOS}.tmp')
+            with open(temporal, 'w') as f:
+                json.dump({
+                    nombre: dict(metrica, valores=[[list(clave), valor] for clave, valor in metrica['valores'].items()])
+                    for nombre, metrica in combinadas.items()
+                }, f)
+            os.replace(temporal, os.path.join(self.directorio, TERMINADOS))
+        for archivo in (ruta, f'{ruta}.tmp'):
+            try:
+                os.remove(archivo)
+            except FileNotFoundError:
+                pass
+
+    def exponer(self):
+        """Texto de Prometheus con las métricas combinadas de todos los procesos"""
+        self.volcar(forzar=True)
+
+        combinadas = {}
+        for pid, vivo, datos in self._leer_procesos():
+            _sumar(combinadas, datos, gauges=vivo)
+
+        lineas = []
+        for nombre in sorted(combinadas):
+            metrica = combinadas[nombre]
+            lineas.append(f"# HELP {nombre} {metrica['ayuda']}")
+            lineas.append(f"# TYPE {nombre} {metrica['tipo']}")
+            for clave, valor in sorted(metrica['valores'].items()):
+                etiquetas = list(zip(metrica['etiquetas'], clave))
+                if metrica['tipo'] != 'histogram':
+                    lineas.append(f"{nombre}{_etiquetas(etiquetas)} {_numero(valor)}")
+                    continue
+                cuentas, suma = valor
+                acumulado = 0
+                for limite, cuenta in zip(list(metrica['buckets']) + ['+Inf'], cuentas):
+                    acumulado += cuenta
+                    le = limite if limite == '+Inf' else _numero(limite)
+                    lineas.append(f"{nombre}_bucket{_etiquetas(etiquetas + [('le', le)])} {acumulado}")
+                lineas.append(f"{nombre}_sum{_etiquetas(etiquetas)} {_numero(suma)}")
+                lineas.append(f"{nombre}_count{_etiquetas(etiquetas)} {acumulado}")
+        return '\n'.join(lineas) + '\n'
+
+
+def _sumar(combinadas, datos, gauges):
+    """Sumar las métricas volcadas por un proceso a `combinadas` (por nombre)"""
+    for nombre, metrica in datos.items():
+        if metrica['tipo'] == 'gauge' and not gauges:
+            continue
+        destino = combinadas.setdefault(nombre, dict(metrica, valores={}))
+        for clave, valor in metrica['valores']:
+            clave = tuple(clave)
+            actual = destino['valores'].get(clave)
+            if metrica['tipo'] == 'histogram':
+                if actual is None:
+                    destino['valores'][clave] = [list(valor[0]), valor[1]]
+                else:
+                    actual[0] = [a + b for a, b in zip(actual[0], valor[0])]
+                    actual[1] += valor[1]
+            else:
+                destino['valores'][clave] = (actual or 0) + valor
+
+
+def _proceso_vivo(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _numero(valor):
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+def _etiquetas(pares):
+    if not pares:
+        return ''
+    texto = ','.join(
+        f'{nombre}="' + str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for nombre, valor in pares
+    )
+    return '{' + texto + '}'
+
+
+registro = Registro(DIRECTORIO)
+
+# HTTP
+peticiones_total = registro.contador(
+    'caec_http_requests_total', 'Peticiones HTTP atendidas', ('endpoint', 'method', 'status'))
+duracion_peticiones = registro.histograma(
+    'caec_http_request_duration_seconds', 'Latencia de las peticiones HTTP', ('endpoint', 'method'))
+peticiones_en_curso = registro.gauge(
+    'caec_http_requests_in_flight', 'Peticiones HTTP en curso')
+
+# Base de datos
+duracion_db = registro.histograma(
+    'caec_db_call_duration_seconds', 'Latencia de las funciones de database.py', ('function',))
+errores_db = registro.contador(
+    'caec_db_errors_total', 'Errores en las funciones de database.py', ('function',))
+conexiones_pool = registro.gauge(
+    'caec_db_pool_connections', 'Conexiones del pool por estado (total, en_uso, libres, esperando, ...)', ('state',))
+
+
+def medir_db(funcion):
+    """Decorador: latencia y errores (excepciones) de una función de acceso a datos"""
+    nombre = funcion.__name__
+
+    @functools.wraps(funcion)
+    def envoltura(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return funcion(*args, **kwargs)
+        except Exception:
+            errores_db.inc(nombre)
+            raise
+        finally:
+            duracion_db.observe(nombre, valor=time.perf_counter() - inicio)
+    return envoltura
+
+
+def contar_error_db(nombre):
+    """Contar un error que la función de datos captura y no propaga"""
+    errores_db.inc(nombre)
+
+
+def instrumentar(app):
+    """Registrar en la app los hooks de latencia por endpoint y peticiones en curso"""
+
+    # Lo acumulado desde el último volcado no se pierde al terminar el worker
+    # (solo en los procesos que sirven la app: el maestro de gunicorn también
+    # importa el módulo, en child_exit, y no debe dejar archivo)
+    atexit.register(registro.volcar, True)
+
+    @app.before_request
+    def _inicio_peticion():
+        g._metricas_inicio = time.perf_counter()
+        peticiones_en_curso.inc()
+
+    @app.after_request
+    def _estado_peticion(respuesta):
+        g._metricas_estado = respuesta.status_code
+        return respuesta
+
+    @app.teardown_request
+    def _fin_peticion(error):
+        inicio = g.pop('_metricas_inicio', None)
+        if inicio is None:
+            return
+        peticiones_en_curso.dec()
+        endpoint = request.endpoint or 'desconocido'
+        estado = g.pop('_metricas_estado', 500 if error else 0)
+        duracion_peticiones.observe(endpoint, request.method, valor=time.perf_counter() - inicio)
+        peticiones_total.inc(endpoint, request.method, estado)
+        registro.volcar()
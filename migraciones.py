@@ -0,0 +1,383 @@
+"""
+Migraciones versionadas del esquema CAEC
+
+Cada migración se aplica una sola vez y queda registrada en schema_version.
+El despliegue las ejecuta antes de arrancar (`python migraciones.py`, ver
+render.yaml); los workers solo comprueban la versión al iniciar. Si la base
+está atrasada y CAEC_AUTO_MIGRAR=1, el primer worker que llegue la migra
+bajo un bloqueo exclusivo y el resto espera y vuelve a comprobar.
+"""
+
+import os
+import sys
+
+from database import (
+    COLUMNAS_ROLLUP, SQL, TABLAS_ROLLUP, db_connection, get_db_connection
+)
+from particiones import convertir_sensor_data
+
+# Clave del pg_advisory_lock que serializa las migraciones entre procesos
+CLAVE_BLOQUEO = 0x43414543
+
+# Migrar desde los workers si el despliegue no lo hizo antes
+AUTO_MIGRAR = os.environ.get('CAEC_AUTO_MIGRAR', '1') == '1'
+
+
+def _m001_esquema_base(cursor, postgres):
+    """Tablas de usuarios, contacto, sistemas y lecturas"""
+    serial = 'SERIAL PRIMARY KEY' if postgres else 'INTEGER PRIMARY KEY AUTOINCREMENT'
+    tipo_timestamp = 'TIMESTAMP' if postgres else 'DATETIME'
+    verdadero = 'TRUE' if postgres else '1'
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS usuario (
+            id {serial},
+            nombre VARCHAR(100) NOT NULL,
+            apellido VARCHAR(100) NOT NULL,
+            email VARCHAR(150) UNIQUE NOT NULL,
+            password VARCHAR(255) NOT NULL,
+            fecha_registro {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP,
+            ultimo_acceso {tipo_timestamp},
+            activo BOOLEAN DEFAULT {verdadero}
+        )
+    ''')
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS contacto (
+            id {serial},
+            usuario_id INTEGER NOT NULL,
+            telefono VARCHAR(20),
+            celular VARCHAR(20),
+            direccion TEXT,
+            ciudad VARCHAR(100),
+            pais VARCHAR(100),
+            codigo_postal VARCHAR(20),
+            FOREIGN KEY (usuario_id) REFERENCES usuario(id) ON DELETE CASCADE
+        )
+    ''')
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS sistema_caec (
+            id {serial},
+            codigo_sistema VARCHAR(50) UNIQUE NOT NULL,
+            usuario_id INTEGER,
+            nombre_sistema VARCHAR(100),
+            fecha_vinculacion {tipo_timestamp},
+            ultimo_sync {tipo_timestamp},
+            estado VARCHAR(20) DEFAULT 'activo',
+            modelo VARCHAR(50),
+            version_firmware VARCHAR(20),
+            FOREIGN KEY (usuario_id) REFERENCES usuario(id) ON DELETE SET NULL
+        )
+    ''')
+
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS sensor_data (
+            id {serial},
+            sistema_id INTEGER NOT NULL,
+            timestamp {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP,
+            nivel_agua REAL,
+            ph REAL,
+            temperatura REAL,
+            nivel_nutrientes REAL,
+            irrigacion_activa BOOLEAN,
+            luz_activa BOOLEAN,
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        )
+    ''')
+
+
+def _m002_historico(cursor, postgres):
+    """Índice del histórico y tablas de agregados por minuto, hora y día"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sensor_data_sistema_timestamp
+        ON sensor_data (sistema_id, timestamp)
+    ''')
+
+    tipo_timestamp = 'TIMESTAMP' if postgres else 'DATETIME'
+    columnas = ',\n'.join(
+        f"            {columna} {'INTEGER NOT NULL DEFAULT 0' if columna.endswith('_cuenta') else 'REAL'}"
+        for columna in COLUMNAS_ROLLUP
+    )
+    for tabla in TABLAS_ROLLUP.values():
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {tabla} (
+                sistema_id INTEGER NOT NULL,
+                bucket {tipo_timestamp} NOT NULL,
+{columnas},
+                PRIMARY KEY (sistema_id, bucket),
+                FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+            )
+        ''')
+
+
+def _m003_sistemas_demo(cursor, postgres):
+    """Sistemas CAEC de ejemplo para pruebas"""
+    insertar = 'INSERT INTO' if postgres else 'INSERT OR IGNORE INTO'
+    conflicto = 'ON CONFLICT (codigo_sistema) DO NOTHING' if postgres else ''
+    cursor.execute(f'''
+        {insertar} sistema_caec
+        (codigo_sistema, nombre_sistema, estado, modelo, version_firmware)
+        VALUES
+        ('CAEC-2024-0001', 'Sistema Demo 1', 'disponible', 'CAEC-V1', '1.0.0'),
+        ('CAEC-2024-0002', 'Sistema Demo 2', 'disponible', 'CAEC-V1', '1.0.0'),
+        ('CAEC-2024-0003', 'Sistema Demo 3', 'disponible', 'CAEC-V2', '1.2.0'),
+        ('CAEC-2024-TEST', 'Sistema Test', 'disponible', 'CAEC-V1', '1.0.0')
+        {conflicto}
+    ''')
+
+
+def _m004_particionado(cursor, postgres):
+    """sensor_data particionada por día (ver particiones.py)"""
+    convertir_sensor_data(cursor, postgres)
+
+
+def _m005_config_irrigacion(cursor, postgres):
+    """Configuración de irrigación versionada por sistema"""
+    tipo_timestamp = 'TIMESTAMP' if postgres else 'DATETIME'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS config_irrigacion (
+            sistema_id INTEGER PRIMARY KEY,
+            potencia_ahorro INTEGER NOT NULL,
+            duracion_ahorro INTEGER NOT NULL,
+            duracion_abundante INTEGER NOT NULL,
+            version INTEGER NOT NULL,
+            actualizado {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        )
+    ''')
+
+
+def _m006_comandos(cursor, postgres):
+    """Cola de comandos para los controladores"""
+    serial = 'BIGSERIAL PRIMARY KEY' if postgres else 'INTEGER PRIMARY KEY AUTOINCREMENT'
+    tipo_timestamp = 'TIMESTAMP' if postgres else 'DATETIME'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS comandos_sistema (
+            id {serial},
+            sistema_id INTEGER NOT NULL,
+            tipo VARCHAR(50) NOT NULL,
+            payload TEXT NOT NULL,
+            estado VARCHAR(20) NOT NULL DEFAULT 'pendiente',
+            creado {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP,
+            entregado {tipo_timestamp},
+            confirmado {tipo_timestamp},
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        )
+    ''')
+    # Solo los comandos sin confirmar se consultan por sistema
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_comandos_sistema_pendientes
+        ON comandos_sistema (sistema_id, id) WHERE estado <> 'confirmado'
+    ''')
+
+
+def _m007_indice_flota(cursor, postgres):
+    """Índice de la vista de flota paginada por (fecha_vinculacion, id)"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sistema_caec_usuario_vinculacion
+        ON sistema_caec (usuario_id, fecha_vinculacion, id)
+    ''')
+
+
+def _m008_progreso_cosecha(cursor, postgres):
+    """Acumuladores del progreso de la cosecha por sistema"""
+    tipo_timestamp = 'TIMESTAMP' if postgres else 'DATETIME'
+    real = 'DOUBLE PRECISION' if postgres else 'REAL'
+    # temp_base por defecto: la de la lechuga (cultivo por defecto, ver cosecha.py)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS progreso_cosecha (
+            sistema_id INTEGER PRIMARY KEY,
+            cultivo VARCHAR(50),
+            fecha_siembra {tipo_timestamp} NOT NULL,
+            temp_base {real} NOT NULL DEFAULT 4,
+            grados_dia {real} NOT NULL DEFAULT 0,
+            horas_luz {real} NOT NULL DEFAULT 0,
+            ultima_lectura {tipo_timestamp},
+            ultima_temperatura {real},
+            ultima_luz BOOLEAN,
+            actualizado {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        )
+    ''')
+
+
+def _m009_alertas(cursor, postgres):
+    """Reglas de alerta por sistema, estado de cada alerta y notificaciones"""
+    serial = 'BIGSERIAL PRIMARY KEY' if postgres else 'INTEGER PRIMARY KEY AUTOINCREMENT'
+    tipo_timestamp = 'TIMESTAMP' if postgres else 'DATETIME'
+    verdadero, falso = ('TRUE', 'FALSE') if postgres else ('1', '0')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS reglas_alerta (
+            sistema_id INTEGER NOT NULL,
+            metrica VARCHAR(30) NOT NULL,
+            minimo REAL,
+            maximo REAL,
+            histeresis REAL NOT NULL DEFAULT 0,
+            espera INTEGER NOT NULL DEFAULT 0,
+            activa BOOLEAN NOT NULL DEFAULT {verdadero},
+            actualizado {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sistema_id, metrica),
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS estado_alerta (
+            sistema_id INTEGER NOT NULL,
+            metrica VARCHAR(30) NOT NULL,
+            estado VARCHAR(20) NOT NULL,
+            desde {tipo_timestamp} NOT NULL,
+            valor REAL,
+            actualizado {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sistema_id, metrica),
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS notificaciones (
+            id {serial},
+            sistema_id INTEGER NOT NULL,
+            metrica VARCHAR(30),
+            tipo VARCHAR(20) NOT NULL,
+            mensaje TEXT NOT NULL,
+            valor REAL,
+            creada {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP,
+            leida BOOLEAN NOT NULL DEFAULT {falso},
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notificaciones_sistema
+        ON notificaciones (sistema_id, id)
+    ''')
+    # El contador de la campana solo mira las no leídas
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notificaciones_sin_leer
+        ON notificaciones (sistema_id) WHERE NOT leida
+    ''')
+
+
+# (versión, descripción, función) en orden de aplicación. Las migraciones
+# aplicadas no se modifican: los cambios de esquema van en una nueva.
+MIGRACIONES = [
+    (1, 'Esquema base', _m001_esquema_base),
+    (2, 'Índice del histórico y tablas de agregados', _m002_historico),
+    (3, 'Sistemas de demostración', _m003_sistemas_demo),
+    (4, 'Particionado diario de sensor_data', _m004_particionado),
+    (5, 'Configuración de irrigación', _m005_config_irrigacion),
+    (6, 'Cola de comandos de los controladores', _m006_comandos),
+    (7, 'Índice de la flota por usuario', _m007_indice_flota),
+    (8, 'Progreso de la cosecha', _m008_progreso_cosecha),
+    (9, 'Reglas de alerta y notificaciones', _m009_alertas),
+]
+
+VERSION_ESQUEMA = MIGRACIONES[-1][0]
+
+
+def _crear_tabla_version(cursor, postgres):
+    tipo_timestamp = 'TIMESTAMP' if postgres else 'DATETIME'
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descripcion VARCHAR(200) NOT NULL,
+            aplicada {tipo_timestamp} DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+SQL.registrar('registrar_migracion', 'INSERT INTO schema_version (version, descripcion) VALUES (?, ?)')
+
+
+def _leer_version(cursor):
+    cursor.execute('SELECT MAX(version) FROM schema_version')
+    fila = cursor.fetchone()
+    return fila[0] or 0
+
+
+def version_actual():
+    """Versión del esquema aplicada (0 si la base no tiene schema_version)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            return _leer_version(cursor)
+        except Exception:
+            # La tabla aún no existe
+            conn.rollback()
+            return 0
+
+
+def migrar(verbose=False):
+    """Aplicar las migraciones pendientes bajo un bloqueo exclusivo
+
+    Usa una conexión propia (fuera del pool): en PostgreSQL para mantener el
+    advisory lock de sesión y en SQLite para tomar el bloqueo de escritura
+    con BEGIN IMMEDIATE. Devuelve la lista de versiones aplicadas.
+    """
+    postgres = SQL.postgres
+    conn = get_db_connection()
+    aplicadas = []
+    try:
+        cursor = conn.cursor()
+        if postgres:
+            # La espera por el bloqueo y el DDL pueden superar CAEC_DB_STATEMENT_TIMEOUT_MS
+            cursor.execute('SET statement_timeout = 0')
+            cursor.execute('SELECT pg_advisory_lock(%s)', (CLAVE_BLOQUEO,))
+            _crear_tabla_version(cursor, postgres)
+            conn.commit()
+        else:
+            # Bloqueo de escritura hasta el commit: los demás procesos esperan
+            cursor.execute('BEGIN IMMEDIATE')
+            _crear_tabla_version(cursor, postgres)
+
+        # Releer bajo el bloqueo: otro proceso pudo migrar mientras esperábamos
+        version = _leer_version(cursor)
+        for numero, descripcion, migracion in MIGRACIONES:
+            if numero <= version:
+                continue
+            migracion(cursor, postgres)
+            SQL.ejecutar(cursor, 'registrar_migracion', (numero, descripcion))
+            if postgres:
+                # DDL transaccional: cada migración se confirma con su versión
+                conn.commit()
+            aplicadas.append(numero)
+            if verbose:
+                print(f"Migración {numero:03d} aplicada: {descripcion}")
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if postgres and not conn.closed:
+            cursor = conn.cursor()
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (CLAVE_BLOQUEO,))
+            conn.commit()
+        conn.close()
+    return aplicadas
+
+
+def comprobar_esquema():
+    """Comprobación de arranque de los workers: una consulta de versión
+
+    Si el esquema está atrasado se migra (CAEC_AUTO_MIGRAR=1) o se aborta el
+    arranque para no servir con un esquema incompatible.
+    """
+    version = version_actual()
+    if version >= VERSION_ESQUEMA:
+        return version
+    if not AUTO_MIGRAR:
+        raise RuntimeError(
+            f"Esquema en versión {version}, se requiere {VERSION_ESQUEMA}: "
+            "ejecuta `python migraciones.py` antes de arrancar"
+        )
+    migrar()
+    return VERSION_ESQUEMA
+
+
+if __name__ == '__main__':
+    if '--estado' in sys.argv[1:]:
+        print(f"Esquema en versión {version_actual()} (última: {VERSION_ESQUEMA})")
+    else:
+        aplicadas = migrar(verbose=True)
+        if not aplicadas:
+            print(f"Esquema al día (versión {VERSION_ESQUEMA})")
@@ -0,0 +1,371 @@
+"""
+Particionado por día de las lecturas crudas (sensor_data)
+
+PostgreSQL: sensor_data es una tabla particionada por rango de timestamp,
+con una partición por día (sensor_data_pAAAAMMDD). La tabla anterior a la
+migración queda adjunta como partición histórica (sensor_data_legado), y
+una partición DEFAULT recoge las lecturas que no caen en ninguna partición.
+
+SQLite no tiene particionado: cada día es una tabla con el mismo nombre y
+sensor_data es una vista UNION ALL sobre todas ellas. Las lecturas se
+insertan directamente en la tabla de su día.
+
+En ambos casos borrar un día antiguo es un DROP TABLE, sin DELETE fila a
+fila que hinche la tabla o bloquee a los escritores.
+"""
+
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+from psycopg2 import errors
+
+from database import COLUMNAS_LECTURA
+
+PREFIJO = 'sensor_data_p'
+TABLA_LEGADO = 'sensor_data_legado'
+TABLA_DEFAULT = 'sensor_data_default'
+
+# Días futuros con partición ya creada (las lecturas nunca esperan a un DDL)
+DIAS_ADELANTE = int(os.environ.get('CAEC_PARTICIONES_ADELANTE', 7))
+
+# Milisegundos que el DDL de particiones de PostgreSQL espera su bloqueo sobre
+# sensor_data; pasado ese plazo se desiste y se reintenta en otra pasada
+ESPERA_BLOQUEO_MS = int(os.environ.get('CAEC_PARTICIONES_LOCK_TIMEOUT_MS', 2000))
+
+# Columnas de las particiones, en el orden de la tabla original
+COLUMNAS = ('id', 'sistema_id', 'timestamp') + COLUMNAS_LECTURA
+
+# En SQLite cada tabla diaria numera sus ids desde dia.toordinal() * ESPACIO_IDS
+# para que sigan siendo únicos (y crecientes) en toda la vista
+ESPACIO_IDS = 10 ** 10
+
+
+def nombre_particion(dia):
+    """Nombre de la partición de un día (date)"""
+    return f'{PREFIJO}{dia:%Y%m%d}'
+
+
+def dia_particion(nombre):
+    """Día de una partición a partir de su nombre (None si no es diaria)"""
+    if not nombre.startswith(PREFIJO):
+        return None
+    try:
+        return datetime.strptime(nombre[len(PREFIJO):], '%Y%m%d').date()
+    except ValueError:
+        return None
+
+
+def _inicio_dia(dia):
+    return datetime(dia.year, dia.month, dia.day)
+
+
+def _existe_tabla(cursor, postgres, nombre):
+    if postgres:
+        cursor.execute('SELECT to_regclass(%s)', (nombre,))
+    else:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (nombre,))
+    fila = cursor.fetchone()
+    return fila is not None and fila[0] is not None
+
+
+def listar_particiones(cursor, postgres):
+    """Particiones diarias existentes: lista ordenada de (día, nombre)"""
+    if postgres:
+        cursor.execute('''
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = 'sensor_data'
+        ''')
+    else:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'sensor_data_p%'")
+    particiones = []
+    for (nombre,) in cursor.fetchall():
+        dia = dia_particion(nombre)
+        if dia is not None:
+            particiones.append((dia, nombre))
+    return sorted(particiones)
+
+
+def tablas_sqlite(cursor, desde, hasta):
+    """Tablas de SQLite con lecturas en [desde, hasta), en orden cronológico"""
+    tablas = [
+        nombre for dia, nombre in listar_particiones(cursor, False)
+        if desde < _inicio_dia(dia) + timedelta(days=1) and _inicio_dia(dia) < hasta
+    ]
+    if _existe_tabla(cursor, False, TABLA_LEGADO):
+        tablas.insert(0, TABLA_LEGADO)
+    return tablas
+
+
+def _reconstruir_vista(cursor):
+    """Rehacer la vista sensor_data de SQLite con las tablas actuales"""
+    tablas = [nombre for _, nombre in listar_particiones(cursor, False)]
+    if _existe_tabla(cursor, False, TABLA_LEGADO):
+        tablas.insert(0, TABLA_LEGADO)
+    seleccion = ', '.join(COLUMNAS)
+    cursor.execute('DROP VIEW IF EXISTS sensor_data')
+    cursor.execute('CREATE VIEW sensor_data AS ' + ' UNION ALL '.join(
+        f'SELECT {seleccion} FROM {tabla}' for tabla in tablas
+    ))
+
+
+def _iniciar_transaccion_sqlite(cursor):
+    """Abrir la transacción antes del DDL de una tabla diaria
+
+    El módulo sqlite3 ejecuta CREATE TABLE fuera de transacción (se confirma
+    sola): si la inserción que sigue fallara, el rollback dejaría la tabla
+    creada pero fuera de la vista. Con BEGIN IMMEDIATE la tabla, su índice,
+    la semilla de ids y la vista se confirman o se deshacen juntas.
+    """
+    if not cursor.connection.in_transaction:
+        cursor.execute('BEGIN IMMEDIATE')
+
+
+def _crear_particion_sqlite(cursor, dia):
+    nombre = nombre_particion(dia)
+    _iniciar_transaccion_sqlite(cursor)
+    columnas = ',\n'.join(
+        f"            {columna} {'REAL' if columna in ('nivel_agua', 'ph', 'temperatura', 'nivel_nutrientes') else 'BOOLEAN'}"
+        for columna in COLUMNAS_LECTURA
+    )
+    cursor.execute(f'''
+        CREATE TABLE {nombre} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sistema_id INTEGER NOT NULL,
+            timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+{columnas},
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute(f'CREATE INDEX idx_{nombre}_sistema_timestamp ON {nombre} (sistema_id, timestamp)')
+    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (nombre, dia.toordinal() * ESPACIO_IDS))
+    _reconstruir_vista(cursor)
+
+
+def _crear_particion_postgres(cursor, dia):
+    nombre = nombre_particion(dia)
+    inicio = _inicio_dia(dia)
+    fin = inicio + timedelta(days=1)
+    # Se crea suelta y se adjunta: así las lecturas de ese día que hubieran
+    # caído en la partición DEFAULT se mueven antes de adjuntarla
+    cursor.execute(f'CREATE TABLE {nombre} (LIKE sensor_data INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    cursor.execute(f'''
+        WITH movidas AS (
+            DELETE FROM {TABLA_DEFAULT}
+            WHERE timestamp >= %s AND timestamp < %s
+            RETURNING {', '.join(COLUMNAS)}
+        )
+        INSERT INTO {nombre} ({', '.join(COLUMNAS)}) SELECT * FROM movidas
+    ''', (inicio, fin))
+    cursor.execute(f'''
+        ALTER TABLE sensor_data ATTACH PARTITION {nombre}
+        FOR VALUES FROM ('{inicio:%Y-%m-%d}') TO ('{fin:%Y-%m-%d}')
+    ''')
+
+
+# Tablas diarias de SQLite ya comprobadas (en la vista y con su semilla) en este proceso
+_verificadas = set()
+
+
+def _reparar_particion_sqlite(cursor, dia):
+    """Completar una tabla diaria que quedó fuera de la vista o sin su semilla de ids
+
+    Ocurre en bases escritas antes de crear las tablas dentro de la
+    transacción: la tabla sobrevivió a un rollback y sus lecturas no se
+    veían en sensor_data.
+    """
+    nombre = nombre_particion(dia)
+    if nombre in _verificadas:
+        return
+    base = dia.toordinal() * ESPACIO_IDS
+    cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (nombre,))
+    fila = cursor.fetchone()
+    sembrada = fila is not None and fila[0] >= base
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'sensor_data'")
+    vista = cursor.fetchone()
+    en_vista = vista is not None and re.search(rf'\bFROM {nombre}\b', vista[0]) is not None
+
+    if sembrada and en_vista:
+        _verificadas.add(nombre)
+        return
+
+    # Se vuelve a comprobar en la próxima inserción, por si esta transacción no se confirma
+    _iniciar_transaccion_sqlite(cursor)
+    if not sembrada:
+        # Las filas insertadas sin semilla pasan al rango de ids de su día
+        cursor.execute(f'UPDATE {nombre} SET id = id + ? WHERE id < ?', (base, base))
+        cursor.execute(f'SELECT MAX(id) FROM {nombre}')
+        ultimo = max(cursor.fetchone()[0] or 0, base)
+        cursor.execute('DELETE FROM sqlite_sequence WHERE name = ?', (nombre,))
+        cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (nombre, ultimo))
+    if not en_vista:
+        _reconstruir_vista(cursor)
+
+
+def crear_particion(cursor, postgres, dia):
+    """Crear la partición de un día si no existe; devuelve su nombre
+
+    En SQLite una tabla existente se repara si quedó fuera de la vista o sin
+    su semilla de ids.
+    """
+    nombre = nombre_particion(dia)
+    if not _existe_tabla(cursor, postgres, nombre):
+        if postgres:
+            _crear_particion_postgres(cursor, dia)
+        else:
+            _crear_particion_sqlite(cursor, dia)
+    elif not postgres:
+        _reparar_particion_sqlite(cursor, dia)
+    return nombre
+
+
+def asegurar_particiones(cursor, postgres, desde, dias):
+    """Crear las particiones de `dias` días a partir de `desde` (date)
+
+    En PostgreSQL se omiten los días cubiertos por la partición histórica.
+    """
+    limite_legado = _fin_legado(cursor) if postgres else None
+    creadas = []
+    for desplazamiento in range(dias):
+        dia = desde + timedelta(days=desplazamiento)
+        if limite_legado is not None and _inicio_dia(dia) < limite_legado:
+            continue
+        nombre = nombre_particion(dia)
+        if not _existe_tabla(cursor, postgres, nombre):
+            crear_particion(cursor, postgres, dia)
+            creadas.append(nombre)
+    return creadas
+
+
+def _fin_legado(cursor):
+    """Límite superior de la partición histórica de PostgreSQL (None si no existe)"""
+    cursor.execute('''
+        SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_class c
+        WHERE c.relname = %s AND c.relispartition
+    ''', (TABLA_LEGADO,))
+    fila = cursor.fetchone()
+    if not fila:
+        return None
+    # "FOR VALUES FROM (MINVALUE) TO ('AAAA-MM-DD 00:00:00')"
+    return datetime.fromisoformat(fila[0].rsplit("'", 2)[1])
+
+
+def hoy_utc():
+    return datetime.now(timezone.utc).date()
+
+
+def convertir_sensor_data(cursor, postgres, dias_adelante=DIAS_ADELANTE):
+    """Migración: pasar la tabla sensor_data existente al esquema particionado"""
+    cursor.execute(f'ALTER TABLE sensor_data RENAME TO {TABLA_LEGADO}')
+
+    hoy = hoy_utc()
+    if not postgres:
+        for desplazamiento in range(dias_adelante + 1):
+            _crear_particion_sqlite(cursor, hoy + timedelta(days=desplazamiento))
+        return
+
+    cursor.execute(f'ALTER INDEX IF EXISTS idx_sensor_data_sistema_timestamp RENAME TO idx_{TABLA_LEGADO}_sistema_timestamp')
+    cursor.execute(f'UPDATE {TABLA_LEGADO} SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL')
+    cursor.execute(f'ALTER TABLE {TABLA_LEGADO} ALTER COLUMN timestamp SET NOT NULL')
+    # Los ids pasan a BIGINT: con muchos dispositivos INTEGER se agota
+    cursor.execute(f'ALTER TABLE {TABLA_LEGADO} ALTER COLUMN id TYPE BIGINT')
+    cursor.execute('ALTER SEQUENCE sensor_data_id_seq AS BIGINT')
+
+    cursor.execute('''
+        CREATE TABLE sensor_data (
+            id BIGINT NOT NULL DEFAULT nextval('sensor_data_id_seq'),
+            sistema_id INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            nivel_agua REAL,
+            ph REAL,
+            temperatura REAL,
+            nivel_nutrientes REAL,
+            irrigacion_activa BOOLEAN,
+            luz_activa BOOLEAN,
+            FOREIGN KEY (sistema_id) REFERENCES sistema_caec(id) ON DELETE CASCADE
+        ) PARTITION BY RANGE (timestamp)
+    ''')
+    # La secuencia pasa a la tabla nueva para que no se borre con la histórica
+    cursor.execute('ALTER SEQUENCE sensor_data_id_seq OWNED BY sensor_data.id')
+    cursor.execute('CREATE INDEX idx_sensor_data_sistema_timestamp ON sensor_data (sistema_id, timestamp)')
+
+    # La histórica cubre hasta el día siguiente a su última lectura (o a hoy)
+    cursor.execute(f'SELECT MAX(timestamp) FROM {TABLA_LEGADO}')
+    ultima = cursor.fetchone()[0]
+    fin_legado = max(hoy, ultima.date() if ultima else hoy) + timedelta(days=1)
+    cursor.execute(f'''
+        ALTER TABLE sensor_data ATTACH PARTITION {TABLA_LEGADO}
+        FOR VALUES FROM (MINVALUE) TO ('{fin_legado:%Y-%m-%d}')
+    ''')
+    cursor.execute(f'CREATE TABLE {TABLA_DEFAULT} PARTITION OF sensor_data DEFAULT')
+
+    for desplazamiento in range(dias_adelante + 1):
+        dia = fin_legado + timedelta(days=desplazamiento)
+        _crear_particion_postgres(cursor, dia)
+
+
+def particion_sqlite(cursor, dia):
+    """Tabla diaria de SQLite donde insertar las lecturas de `dia` (se crea si falta)"""
+    return crear_particion(cursor, False, dia)
+
+
+def eliminar_particiones_antiguas(cursor, postgres, limite):
+    """Borrar con DROP TABLE las particiones cuyo día termina antes de `limite` (datetime)
+
+    La partición histórica se borra cuando ya no tiene lecturas posteriores
+    al límite; en PostgreSQL, la DEFAULT (pequeña) se poda con DELETE.
+    Devuelve los nombres de las tablas eliminadas.
+    """
+    antiguas = [
+        nombre for dia, nombre in listar_particiones(cursor, postgres)
+        if _inicio_dia(dia) + timedelta(days=1) <= limite
+    ]
+
+    if _existe_tabla(cursor, postgres, TABLA_LEGADO):
+        marca = '%s' if postgres else '?'
+        cursor.execute(f'SELECT 1 FROM {TABLA_LEGADO} WHERE timestamp >= {marca} LIMIT 1',
+                       (limite if postgres else limite.strftime('%Y-%m-%d %H:%M:%S'),))
+        if cursor.fetchone() is None:
+            antiguas.append(TABLA_LEGADO)
+
+    if postgres:
+        eliminadas = [nombre for nombre in antiguas if _eliminar_particion_postgres(cursor, nombre)]
+        cursor.execute(f'DELETE FROM {TABLA_DEFAULT} WHERE timestamp < %s', (limite,))
+        return eliminadas
+
+    if antiguas:
+        # La vista deja de referenciarlas antes del DROP y se rehace después
+        cursor.execute('DROP VIEW IF EXISTS sensor_data')
+        for nombre in antiguas:
+            cursor.execute(f'DROP TABLE {nombre}')
+        _reconstruir_vista(cursor)
+
+    return antiguas
+
+
+def limitar_espera_bloqueo(cursor):
+    """Aplicar ESPERA_BLOQUEO_MS a la transacción actual de PostgreSQL"""
+    cursor.execute(f'SET LOCAL lock_timeout = {ESPERA_BLOQUEO_MS}')
+
+
+def _eliminar_particion_postgres(cursor, nombre):
+    """DROP de una partición en su propia transacción corta; False si no pudo
+
+    El DROP toma ACCESS EXCLUSIVE sobre sensor_data: con lock_timeout no se
+    queda esperando detrás de una exportación abierta (con la ingesta y las
+    lecturas en cola detrás de él) y el commit lo suelta enseguida. La
+    partición que no se pudo borrar se reintenta en la siguiente pasada.
+    """
+    conexion = cursor.connection
+    conexion.commit()
+    try:
+        limitar_espera_bloqueo(cursor)
+        cursor.execute(f'DROP TABLE {nombre}')
+        conexion.commit()
+        return True
+    except errors.LockNotAvailable:
+        conexion.rollback()
+        print(f"Partición {nombre} en uso; se eliminará en la siguiente pasada")
+        return False
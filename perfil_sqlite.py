@@ -0,0 +1,209 @@
+"""
+Perfil de producción de SQLite: WAL, pragmas de rendimiento y un único escritor
+
+Cada conexión se abre en modo WAL (los lectores no se bloquean con las
+escrituras ni al revés) con synchronous=NORMAL, mmap, caché y busy_timeout
+configurables. Las transacciones de escritura se serializan entre hilos y
+procesos (workers de gunicorn) con un bloqueo sobre un archivo junto a la
+base: quien escribe lo toma antes de su primera sentencia de escritura y lo
+suelta en el commit o el rollback, así SQLite nunca devuelve "database is
+locked" por dos escritores que compiten ni por una transacción de lectura
+que intenta pasar a escritura sobre una instantánea vieja.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Sin flock (Windows): los escritores se serializan solo dentro del proceso
+    fcntl = None
+
+import metricas
+
+# Pragmas aplicados a cada conexión
+BUSY_TIMEOUT_MS = int(os.environ.get('CAEC_SQLITE_BUSY_TIMEOUT_MS', 5000))
+PRAGMAS = (
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+    ('journal_mode', 'WAL'),
+    ('synchronous', os.environ.get('CAEC_SQLITE_SYNCHRONOUS', 'NORMAL')),
+    ('mmap_size', int(os.environ.get('CAEC_SQLITE_MMAP_MB', 256)) * 1024 * 1024),
+    # Negativo: tamaño en KiB en vez de páginas (la caché es de cada conexión)
+    ('cache_size', -int(os.environ.get('CAEC_SQLITE_CACHE_KB', 8192))),
+    ('temp_store', 'MEMORY'),
+    # Tamaño al que se recorta el WAL tras cada checkpoint
+    ('journal_size_limit', 64 * 1024 * 1024),
+)
+
+# Serializar los escritores con un bloqueo entre procesos (0 lo desactiva)
+BLOQUEO_ESCRITURA = os.environ.get('CAEC_SQLITE_BLOQUEO_ESCRITURA', '1') == '1'
+
+# Sentencias que convierten la transacción en una de escritura
+_ESCRITURA = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'BEGIN')
+# DDL: el módulo sqlite3 no abre transacción para ellas, se respeta
+_DDL = ('CREATE', 'DROP', 'ALTER')
+
+espera_escritura = metricas.registro.histograma(
+    'caec_sqlite_writer_lock_wait_seconds', 'Espera por el bloqueo de escritura de SQLite')
+
+
+class BloqueoEscritura:
+    """Exclusión mutua entre los escritores de todos los hilos y procesos
+
+    Un threading.Lock ordena los hilos del proceso y flock sobre `ruta`
+    ordena los procesos. El descriptor se abre de nuevo en cada proceso: uno
+    heredado por fork compartiría el bloqueo con el padre.
+    """
+
+    def __init__(self, ruta, timeout):
+        self.ruta = ruta
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._despues_de_fork)
+
+    def _despues_de_fork(self):
+        # El hijo no hereda al escritor que tuviera el bloqueo en el padre
+        self._lock = threading.Lock()
+
+    def adquirir(self):
+        inicio = time.monotonic()
+        # Con timeout, como busy_timeout: dos conexiones que escriben en el
+        # mismo hilo fallan en vez de esperarse para siempre
+        if not self._lock.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError('database is locked (bloqueo de escritura)')
+        try:
+            if fcntl is not None:
+                if self._pid != os.getpid():
+                    self._fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT, 0o600)
+                    self._pid = os.getpid()
+                self._flock(inicio + self.timeout)
+        except BaseException:
+            self._lock.release()
+            raise
+        espera_escritura.observe(valor=time.monotonic() - inicio)
+
+    def _flock(self, limite):
+        # Sin bloquear y con plazo, como busy_timeout: un flock bloqueante
+        # dejaría esperando para siempre a los escritores si otro proceso se
+        # cuelga con el bloqueo, y con gevent pararía todo el worker
+        # (time.sleep sí cede el control)
+        espera = 0.0005
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise sqlite3.OperationalError('database is locked')
+                time.sleep(min(espera, restante))
+                espera = min(espera * 2, 0.01)
+
+    def liberar(self):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+
+_bloqueos = {}
+_bloqueos_lock = threading.Lock()
+
+
+def bloqueo_escritura(ruta):
+    """Bloqueo de escritura (uno por proceso) de la base en `ruta`"""
+    ruta = os.path.abspath(ruta)
+    with _bloqueos_lock:
+        if ruta not in _bloqueos:
+            _bloqueos[ruta] = BloqueoEscritura(f'{ruta}-escritura', BUSY_TIMEOUT_MS / 1000)
+        return _bloqueos[ruta]
+
+
+def _primera_palabra(sentencia):
+    return sentencia.lstrip()[:7].upper()
+
+
+class CursorSQLite(sqlite3.Cursor):
+    """Cursor que toma el bloqueo de escritura antes de la primera escritura"""
+
+    def execute(self, sentencia, parametros=()):
+        self.connection._antes_de(sentencia)
+        return super().execute(sentencia, parametros)
+
+    def executemany(self, sentencia, parametros):
+        self.connection._antes_de(sentencia)
+        return super().executemany(sentencia, parametros)
+
+
+class ConexionSQLite(sqlite3.Connection):
+    """Conexión con el bloqueo de escritura del proceso
+
+    El bloqueo se toma al ejecutar la primera sentencia de escritura y se
+    suelta al terminar la transacción (commit, rollback o close). Las
+    escrituras empiezan con BEGIN IMMEDIATE en vez del BEGIN diferido que
+    abre el módulo sqlite3.
+    """
+
+    bloqueo = None
+    _escribiendo = False
+
+    def cursor(self, factory=CursorSQLite):
+        return super().cursor(factory)
+
+    def _antes_de(self, sentencia):
+        if self.bloqueo is None or self._escribiendo:
+            return
+        palabra = _primera_palabra(sentencia)
+        ddl = palabra.startswith(_DDL)
+        if not ddl and not palabra.startswith(_ESCRITURA):
+            return
+
+        self.bloqueo.adquirir()
+        self._escribiendo = True
+        if not ddl and not palabra.startswith('BEGIN') and not self.in_transaction:
+            try:
+                super().execute('BEGIN IMMEDIATE')
+            except BaseException:
+                self._liberar()
+                raise
+
+    def _liberar(self):
+        if self._escribiendo:
+            self._escribiendo = False
+            self.bloqueo.liberar()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._liberar()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._liberar()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._liberar()
+
+
+def conectar(ruta):
+    """Abrir una conexión SQLite con los pragmas del perfil y el bloqueo de escritura"""
+    conn = sqlite3.connect(ruta, timeout=BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, factory=ConexionSQLite)
+    for pragma, valor in PRAGMAS:
+        conn.execute(f'PRAGMA {pragma} = {valor}')
+    if BLOQUEO_ESCRITURA and ruta != ':memory:':
+        conn.bloqueo = bloqueo_escritura(ruta)
+    return conn
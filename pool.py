@@ -0,0 +1,211 @@
+"""
+Pool de conexiones a la base de datos (PostgreSQL o SQLite)
+
+Mantiene un conjunto de conexiones abiertas por proceso para no pagar el
+handshake TCP+TLS+auth en cada consulta. Es seguro ante fork (workers de
+gunicorn): las conexiones heredadas del proceso padre nunca se reutilizan.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class PoolAgotado(Exception):
+    """No hay conexiones disponibles dentro del tiempo de espera"""
+
+
+class ConnectionPool:
+    """Pool de conexiones con tamaño mínimo/máximo y verificación al prestar"""
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=10.0,
+                 check_interval=30.0, health_check=None, reset=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Tamaños de pool inválidos")
+
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._health_check = health_check
+        self._reset = reset
+
+        self._lock = threading.Condition()
+        self._iniciar_estado()
+
+    def _iniciar_estado(self):
+        """Reiniciar el estado interno (al crear el pool o tras un fork)"""
+        self._pid = os.getpid()
+        # Conexiones libres: (conexion, instante en que se devolvió)
+        self._libres = deque()
+        self._total = 0
+        self._en_uso = 0
+        # Hilos bloqueados esperando una conexión libre
+        self._esperando = 0
+
+    def _verificar_fork(self):
+        """Descartar las conexiones heredadas si estamos en un proceso hijo"""
+        if self._pid != os.getpid():
+            # No cerramos las conexiones del padre: cerrar el socket desde el
+            # hijo terminaría la sesión que el padre sigue usando. Se guardan
+            # para que el recolector de basura no las cierre.
+            _heredadas.extend(conn for conn, _ in self._libres)
+            self._iniciar_estado()
+
+    def _abrir(self):
+        """Abrir una conexión física nueva (sin el lock tomado)"""
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._total -= 1
+                self._lock.notify()
+            raise
+
+    def _es_valida(self, conn, devuelta_en):
+        """Health check al prestar: solo si la conexión lleva tiempo inactiva"""
+        if self._health_check is None:
+            return True
+        if time.monotonic() - devuelta_en < self.check_interval:
+            return True
+        try:
+            return self._health_check(conn)
+        except Exception:
+            return False
+
+    def _descartar(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def llenar(self):
+        """Abrir conexiones hasta alcanzar el tamaño mínimo"""
+        with self._lock:
+            self._verificar_fork()
+            faltan = max(0, self.min_size - self._total)
+            self._total += faltan
+
+        for _ in range(faltan):
+            conn = self._abrir()
+            with self._lock:
+                self._libres.append((conn, time.monotonic()))
+                self._lock.notify()
+
+    def obtener(self):
+        """Prestar una conexión del pool (bloquea hasta `timeout` segundos)"""
+        limite = time.monotonic() + self.timeout
+
+        while True:
+            with self._lock:
+                self._verificar_fork()
+
+                while not self._libres and self._total >= self.max_size:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        raise PoolAgotado(
+                            f"Sin conexiones libres tras {self.timeout}s "
+                            f"(máximo {self.max_size})"
+                        )
+                    self._esperando += 1
+                    try:
+                        self._lock.wait(restante)
+                    finally:
+                        self._esperando -= 1
+                    self._verificar_fork()
+
+                if self._libres:
+                    conn, devuelta_en = self._libres.pop()
+                    self._en_uso += 1
+                else:
+                    conn, devuelta_en = None, None
+                    self._total += 1
+                    self._en_uso += 1
+
+            if conn is None:
+                try:
+                    return self._abrir()
+                except Exception:
+                    with self._lock:
+                        self._en_uso -= 1
+                    raise
+
+            if self._es_valida(conn, devuelta_en):
+                return conn
+
+            # Conexión rota: descartarla y volver a intentar
+            self._descartar(conn)
+            with self._lock:
+                self._total -= 1
+                self._en_uso -= 1
+                self._lock.notify()
+
+    def devolver(self, conn, descartar=False):
+        """Devolver una conexión al pool"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Conexión prestada antes del fork: no pertenece a este proceso
+                return
+
+        if not descartar and self._reset is not None:
+            try:
+                self._reset(conn)
+            except Exception:
+                descartar = True
+
+        with self._lock:
+            self._en_uso -= 1
+            if descartar:
+                self._total -= 1
+            else:
+                self._libres.append((conn, time.monotonic()))
+            self._lock.notify()
+
+        if descartar:
+            self._descartar(conn)
+
+    @contextmanager
+    def conexion(self):
+        """Context manager: presta una conexión y la devuelve al salir"""
+        conn = self.obtener()
+        descartar = False
+        try:
+            yield conn
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                descartar = True
+            raise
+        finally:
+            self.devolver(conn, descartar=descartar)
+
+    def cerrar(self):
+        """Cerrar todas las conexiones libres del pool"""
+        with self._lock:
+            self._verificar_fork()
+            libres = list(self._libres)
+            self._libres.clear()
+            self._total -= len(libres)
+
+        for conn, _ in libres:
+            self._descartar(conn)
+
+    def estadisticas(self):
+        """Estado actual del pool"""
+        with self._lock:
+            return {
+                'total': self._total,
+                'en_uso': self._en_uso,
+                'libres': len(self._libres),
+                'esperando': self._esperando,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            }
+
+
+# Conexiones heredadas de un proceso padre (ver ConnectionPool._verificar_fork)
+_heredadas = []
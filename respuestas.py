@@ -0,0 +1,99 @@
+"""
+ETag, peticiones condicionales y compresión de las respuestas de la app
+
+Se aplica como after_request a todas las respuestas:
+
+- JSON (GET/HEAD): ETag fuerte calculado del contenido (salvo que la vista
+  haya puesto el suyo, p. ej. a partir de una versión de los datos) y 304
+  sin cuerpo si coincide con If-None-Match. Al comprimir, el ETag lleva el
+  sufijo de la codificación (`"<etag>-gzip"`): cada una es una
+  representación distinta.
+- Texto (JSON, HTML, CSS, JS) por encima de CAEC_COMPRESION_MINIMO bytes:
+  gzip o deflate según Accept-Encoding.
+
+Las respuestas en streaming (SSE, exportaciones) y las que ya llevan
+Content-Encoding no se tocan.
+"""
+
+import gzip
+import os
+import zlib
+
+from flask import request
+
+# Bytes mínimos del cuerpo para comprimir (por debajo no compensa)
+MINIMO = int(os.environ.get('CAEC_COMPRESION_MINIMO', 1024))
+
+# Nivel de compresión (1 = más rápido, 9 = más pequeño; 0 desactiva la compresión)
+NIVEL = int(os.environ.get('CAEC_COMPRESION_NIVEL', 6))
+
+# Codificaciones soportadas, por orden de preferencia
+CODIFICACIONES = ('gzip', 'deflate')
+
+COMPRIMIBLES = {
+    'application/json', 'text/html', 'text/plain', 'text/css',
+    'text/javascript', 'application/javascript',
+}
+
+
+def _codificacion():
+    """Codificación preferida por el cliente entre las soportadas (None si ninguna)"""
+    if NIVEL <= 0:
+        return None
+    return request.accept_encodings.best_match(CODIFICACIONES)
+
+
+def etag_solicitado(etag):
+    """ETag de If-None-Match que corresponde a `etag` en alguna codificación (o None)
+
+    Para las vistas que comparan su propio ETag antes de generar la
+    respuesta: el cliente devuelve el que recibió, con el sufijo de la
+    codificación, y el 304 debe repetirlo.
+    """
+    for sufijo in ('', *(f'-{codificacion}' for codificacion in CODIFICACIONES)):
+        if request.if_none_match.contains(f'{etag}{sufijo}'):
+            return f'{etag}{sufijo}'
+    return None
+
+
+def _comprimir(datos, codificacion):
+    if codificacion == 'gzip':
+        return gzip.compress(datos, compresslevel=NIVEL, mtime=0)
+    return zlib.compress(datos, NIVEL)
+
+
+def optimizar_respuestas(app):
+    """Registrar el after_request de ETag y compresión"""
+
+    @app.after_request
+    def _optimizar(respuesta):
+        if (respuesta.is_streamed or respuesta.direct_passthrough
+                or 'Content-Encoding' in respuesta.headers
+                or respuesta.status_code not in (200, 201, 202)):
+            return respuesta
+
+        comprimible = respuesta.mimetype in COMPRIMIBLES
+        if comprimible:
+            respuesta.vary.add('Accept-Encoding')
+        datos = respuesta.get_data()
+        codificacion = _codificacion() if comprimible and len(datos) >= MINIMO else None
+
+        if (respuesta.mimetype == 'application/json' and request.method in ('GET', 'HEAD')
+                and respuesta.status_code == 200):
+            if 'ETag' not in respuesta.headers:
+                respuesta.add_etag()
+            if codificacion:
+                # Cada codificación es una representación distinta
+                etag, debil = respuesta.get_etag()
+                respuesta.set_etag(f'{etag}-{codificacion}', weak=debil)
+            if 'Cache-Control' not in respuesta.headers:
+                # El navegador puede guardarla, pero revalida siempre con If-None-Match
+                respuesta.headers['Cache-Control'] = 'private, no-cache'
+            respuesta.make_conditional(request)
+            if respuesta.status_code == 304:
+                return respuesta
+
+        if codificacion:
+            respuesta.set_data(_comprimir(datos, codificacion))
+            respuesta.headers['Content-Encoding'] = codificacion
+        return respuesta
@@ -0,0 +1,182 @@
+"""
+Mantenimiento del histórico: particiones futuras y retención de datos
+
+Cada pasada crea las particiones de los próximos días y elimina los datos
+más antiguos que la retención configurada para cada granularidad:
+
+- raw: lecturas crudas de sensor_data; se borran particiones enteras.
+- minuto / hora / dia: tablas de agregados; se podan con DELETE por cubeta
+  (son pequeñas). 0 significa conservar para siempre.
+- comandos: comandos ya confirmados por los controladores.
+- notificaciones: notificaciones de alertas (leídas o no).
+
+En PostgreSQL el DDL de particiones bloquea sensor_data: cada paso va en su
+propia transacción corta con lock_timeout, y los DELETE de las tablas
+pequeñas se hacen después, sin ningún bloqueo de sensor_data retenido.
+
+Cada worker arranca un hilo que hace una pasada cada CAEC_RETENCION_INTERVALO
+segundos; un bloqueo exclusivo asegura que solo uno trabaja a la vez. También
+se puede ejecutar a mano o desde un cron: `python retencion.py`.
+"""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from psycopg2 import errors
+
+from database import SQL, TABLAS_ROLLUP, get_db_connection
+from particiones import (
+    DIAS_ADELANTE, asegurar_particiones, eliminar_particiones_antiguas, hoy_utc, limitar_espera_bloqueo
+)
+
+# Días que se conservan por granularidad (0 = para siempre)
+RETENCION_DIAS = {
+    'raw': int(os.environ.get('CAEC_RETENCION_RAW_DIAS', 14)),
+    'minuto': int(os.environ.get('CAEC_RETENCION_MINUTO_DIAS', 0)),
+    'hora': int(os.environ.get('CAEC_RETENCION_HORA_DIAS', 0)),
+    'dia': int(os.environ.get('CAEC_RETENCION_DIA_DIAS', 0)),
+    'comandos': int(os.environ.get('CAEC_RETENCION_COMANDOS_DIAS', 7)),
+    'notificaciones': int(os.environ.get('CAEC_RETENCION_NOTIFICACIONES_DIAS', 30)),
+}
+
+# Segundos entre pasadas del hilo de mantenimiento (0 lo desactiva)
+INTERVALO = float(os.environ.get('CAEC_RETENCION_INTERVALO', 3600))
+
+# Clave del pg_advisory_lock del mantenimiento (distinta de la de migraciones)
+CLAVE_BLOQUEO = 0x43414544
+
+
+def _limite(dias, hoy):
+    """Instante (inicio de día UTC) anterior al cual se borran los datos"""
+    return datetime(hoy.year, hoy.month, hoy.day) - timedelta(days=dias)
+
+
+def ejecutar_mantenimiento(hoy=None):
+    """Hacer una pasada de mantenimiento
+
+    Devuelve un resumen {'creadas', 'eliminadas', 'agregados_borrados',
+    'comandos_borrados', 'notificaciones_borradas'} o None si otro proceso tiene el bloqueo.
+    """
+    hoy = hoy or hoy_utc()
+    postgres = SQL.postgres
+    conn = get_db_connection()
+    bloqueado = False
+    try:
+        cursor = conn.cursor()
+        if postgres:
+            # Los borrados del mantenimiento pueden superar CAEC_DB_STATEMENT_TIMEOUT_MS
+            cursor.execute('SET statement_timeout = 0')
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', (CLAVE_BLOQUEO,))
+            bloqueado = cursor.fetchone()[0]
+            if not bloqueado:
+                conn.rollback()
+                return None
+        else:
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError:
+                # Otro proceso está escribiendo; se reintenta en la siguiente pasada
+                return None
+
+        resumen = {'creadas': [], 'eliminadas': [], 'agregados_borrados': {}, 'comandos_borrados': 0,
+                   'notificaciones_borradas': 0}
+
+        # Primero las particiones nuevas, para que nunca se quede sin ninguna
+        if postgres:
+            # ATTACH PARTITION bloquea la DEFAULT: sin esperar detrás de una
+            # exportación (hay DIAS_ADELANTE días de margen para reintentar)
+            try:
+                limitar_espera_bloqueo(cursor)
+                resumen['creadas'] = asegurar_particiones(cursor, postgres, hoy, DIAS_ADELANTE + 1)
+                conn.commit()
+            except errors.LockNotAvailable:
+                conn.rollback()
+                print("Particiones en uso; se crearán en la siguiente pasada")
+        else:
+            resumen['creadas'] = asegurar_particiones(cursor, postgres, hoy, DIAS_ADELANTE + 1)
+
+        if RETENCION_DIAS['raw'] > 0:
+            limite = _limite(RETENCION_DIAS['raw'], hoy)
+            resumen['eliminadas'] = eliminar_particiones_antiguas(cursor, postgres, limite)
+        if postgres:
+            # Los DELETE siguientes no retienen ningún bloqueo de sensor_data
+            conn.commit()
+
+        marca = '%s' if postgres else '?'
+        for resolucion, tabla in TABLAS_ROLLUP.items():
+            dias = RETENCION_DIAS[resolucion]
+            if dias <= 0:
+                continue
+            limite = _limite(dias, hoy)
+            cursor.execute(f'DELETE FROM {tabla} WHERE bucket < {marca}',
+                           (limite if postgres else limite.strftime('%Y-%m-%d %H:%M:%S'),))
+            resumen['agregados_borrados'][resolucion] = cursor.rowcount
+
+        if RETENCION_DIAS['comandos'] > 0:
+            limite = _limite(RETENCION_DIAS['comandos'], hoy)
+            cursor.execute(f"DELETE FROM comandos_sistema WHERE estado = 'confirmado' AND confirmado < {marca}",
+                           (limite if postgres else limite.strftime('%Y-%m-%d %H:%M:%S'),))
+            resumen['comandos_borrados'] = cursor.rowcount
+
+        if RETENCION_DIAS['notificaciones'] > 0:
+            limite = _limite(RETENCION_DIAS['notificaciones'], hoy)
+            cursor.execute(f"DELETE FROM notificaciones WHERE creada < {marca}",
+                           (limite if postgres else limite.strftime('%Y-%m-%d %H:%M:%S'),))
+            resumen['notificaciones_borradas'] = cursor.rowcount
+
+        conn.commit()
+        return resumen
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if bloqueado:
+            cursor = conn.cursor()
+            cursor.execute('SELECT pg_advisory_unlock(%s)', (CLAVE_BLOQUEO,))
+            conn.commit()
+        conn.close()
+
+
+_hilo_pid = None
+_hilo_lock = threading.Lock()
+
+
+def iniciar_mantenimiento():
+    """Arrancar (una vez por proceso) el hilo de mantenimiento periódico"""
+    global _hilo_pid
+    if INTERVALO <= 0 or _hilo_pid == os.getpid():
+        return
+    with _hilo_lock:
+        if _hilo_pid == os.getpid():
+            return
+        _hilo_pid = os.getpid()
+        threading.Thread(target=_bucle_mantenimiento, name='retencion', daemon=True).start()
+
+
+def _bucle_mantenimiento():
+    while True:
+        try:
+            resumen = ejecutar_mantenimiento()
+            if resumen and (resumen['creadas'] or resumen['eliminadas']):
+                print(f"Mantenimiento del histórico: creadas {resumen['creadas']}, "
+                      f"eliminadas {resumen['eliminadas']}")
+        except Exception as e:
+            print(f"Error en el mantenimiento del histórico: {e}")
+        time.sleep(INTERVALO)
+
+
+if __name__ == '__main__':
+    resumen = ejecutar_mantenimiento()
+    if resumen is None:
+        print("Otro proceso está ejecutando el mantenimiento")
+        sys.exit(1)
+    print(f"Particiones creadas: {', '.join(resumen['creadas']) or 'ninguna'}")
+    print(f"Particiones eliminadas: {', '.join(resumen['eliminadas']) or 'ninguna'}")
+    for resolucion, filas in resumen['agregados_borrados'].items():
+        print(f"Agregados por {resolucion} borrados: {filas}")
+    print(f"Comandos confirmados borrados: {resumen['comandos_borrados']}")
+    print(f"Notificaciones borradas: {resumen['notificaciones_borradas']}")
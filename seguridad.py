@@ -0,0 +1,126 @@
+"""
+Hash de contraseñas con scrypt (hashlib) ejecutado en un pool acotado
+
+scrypt es deliberadamente costoso en CPU y memoria. hashlib libera el GIL
+mientras calcula, así que un pool de hilos permite atender varios logins en
+paralelo sin bloquear el resto de hilos del worker; la cola acotada evita
+que una ráfaga de logins acumule trabajo sin límite.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+
+import cooperativo
+
+PREFIJO = 'scrypt'
+
+# Coste de scrypt: N (potencia de 2), r y p. Subir N invalida los hashes
+# anteriores, que se recalculan en el siguiente login del usuario.
+SCRYPT_N = int(os.environ.get('CAEC_SCRYPT_N', 2 ** 14))
+SCRYPT_R = int(os.environ.get('CAEC_SCRYPT_R', 8))
+SCRYPT_P = int(os.environ.get('CAEC_SCRYPT_P', 1))
+
+# Hilos que calculan hashes y cuántos hashes pueden esperar en cola
+HASH_HILOS = int(os.environ.get('CAEC_HASH_HILOS', os.cpu_count() or 2))
+HASH_COLA = int(os.environ.get('CAEC_HASH_COLA', HASH_HILOS * 4))
+# Segundos máximos que una petición espera turno en la cola
+HASH_ESPERA = float(os.environ.get('CAEC_HASH_ESPERA', 5))
+
+
+class ServidorOcupado(Exception):
+    """El pool de hashing está saturado"""
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+        maxmem=256 * n * r * p + 1024 * 1024, dklen=32,
+    )
+
+
+def _b64(datos):
+    return base64.b64encode(datos).decode('ascii')
+
+
+def calcular_hash(password, n=None, r=None, p=None):
+    """Hash en el formato scrypt$N$r$p$salt$hash (ejecución directa, sin pool)"""
+    n, r, p = n or SCRYPT_N, r or SCRYPT_R, p or SCRYPT_P
+    salt = secrets.token_bytes(16)
+    return f"{PREFIJO}${n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, n, r, p))}"
+
+
+def comprobar_hash(password, almacenado):
+    """Comparar una contraseña con el valor guardado (ejecución directa, sin pool)
+
+    Devuelve (valida, necesita_rehash). Los valores sin prefijo son
+    contraseñas en texto plano de antes de usar hashes: se aceptan una vez
+    y se marcan para migrar.
+    """
+    if not almacenado.startswith(PREFIJO + '$'):
+        valida = hmac.compare_digest(password.encode('utf-8'), almacenado.encode('utf-8'))
+        return valida, valida
+
+    try:
+        _, n, r, p, salt, esperado = almacenado.split('$')
+        n, r, p = int(n), int(r), int(p)
+        calculado = _scrypt(password, base64.b64decode(salt), n, r, p)
+    except (ValueError, TypeError):
+        return False, False
+
+    valida = hmac.compare_digest(calculado, base64.b64decode(esperado))
+    return valida, valida and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+# Hash de referencia para igualar el tiempo de respuesta cuando el email no existe
+_HASH_FICTICIO = None
+
+_ejecutor = None
+_ejecutor_pid = None
+_ejecutor_lock = threading.Lock()
+_cola = threading.BoundedSemaphore(HASH_HILOS + HASH_COLA)
+
+
+def _obtener_ejecutor():
+    """Pool de hilos del proceso (se recrea tras un fork)"""
+    global _ejecutor, _ejecutor_pid, _cola
+    with _ejecutor_lock:
+        if _ejecutor_pid != os.getpid():
+            _ejecutor = cooperativo.ejecutor_hilos(HASH_HILOS, thread_name_prefix='hash')
+            _cola = threading.BoundedSemaphore(HASH_HILOS + HASH_COLA)
+            _ejecutor_pid = os.getpid()
+        return _ejecutor
+
+
+def _en_pool(funcion, *args):
+    ejecutor = _obtener_ejecutor()
+    cola = _cola
+    if not cola.acquire(timeout=HASH_ESPERA):
+        raise ServidorOcupado("Demasiados cálculos de contraseña en curso")
+    try:
+        return ejecutor.submit(funcion, *args).result()
+    finally:
+        cola.release()
+
+
+def hashear_password(password):
+    """Calcular el hash de una contraseña nueva en el pool"""
+    return _en_pool(calcular_hash, password)
+
+
+def verificar_password(password, almacenado):
+    """Verificar una contraseña en el pool; devuelve (valida, necesita_rehash)
+
+    Con `almacenado` None (usuario inexistente) se calcula igualmente un
+    hash para que la respuesta tarde lo mismo.
+    """
+    global _HASH_FICTICIO
+    if almacenado is None:
+        if _HASH_FICTICIO is None:
+            _HASH_FICTICIO = calcular_hash(secrets.token_hex(8))
+        _en_pool(comprobar_hash, password, _HASH_FICTICIO)
+        return False, False
+    return _en_pool(comprobar_hash, password, almacenado)
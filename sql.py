@@ -0,0 +1,138 @@
+"""
+Registro de sentencias SQL pre-renderizadas por dialecto
+
+Cada sentencia se escribe una vez con marcadores `?` y se traduce al cargar
+el módulo al formato del driver activo (`?` en SQLite, `%s` en psycopg2).
+En PostgreSQL las sentencias marcadas con preparar=True se preparan en el
+servidor (PREPARE) la primera vez que se usan en cada conexión y después se
+ejecutan con EXECUTE, sin volver a planificarlas.
+"""
+
+import threading
+import weakref
+
+import psycopg2.extras
+
+
+def _traducir(texto, marcador, escapar_porcentaje):
+    """Reemplazar los `?` que están fuera de literales de texto
+
+    `marcador` recibe el número de parámetro (desde 1) y devuelve su texto.
+    Devuelve el texto traducido y el número de parámetros.
+    """
+    partes = []
+    en_literal = False
+    numero = 0
+    for caracter in texto:
+        if caracter == "'":
+            en_literal = not en_literal
+            partes.append(caracter)
+        elif caracter == '?' and not en_literal:
+            numero += 1
+            partes.append(marcador(numero))
+        elif caracter == '%' and escapar_porcentaje:
+            partes.append('%%')
+        else:
+            partes.append(caracter)
+    return ''.join(partes), numero
+
+
+class Sentencia:
+    """Texto de una sentencia listo para el driver del dialecto activo"""
+
+    __slots__ = ('nombre', 'texto', 'texto_prepare', 'parametros', 'preparar')
+
+    def __init__(self, nombre, texto, texto_prepare=None, parametros=0, preparar=False):
+        self.nombre = nombre
+        self.texto = texto
+        self.texto_prepare = texto_prepare
+        self.parametros = parametros
+        self.preparar = preparar
+
+
+class Sentencias:
+    """Sentencias del dialecto resuelto al arrancar"""
+
+    def __init__(self, dialecto, preparar=True):
+        if dialecto not in ('sqlite', 'postgres'):
+            raise ValueError(f"Dialecto no soportado: {dialecto}")
+        self.dialecto = dialecto
+        self.postgres = dialecto == 'postgres'
+        self.usar_prepare = preparar and self.postgres
+        self._sentencias = {}
+        # Sentencias ya preparadas en cada conexión (se olvidan al cerrarla)
+        self._preparadas = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def registrar(self, nombre, sql=None, sqlite=None, postgres=None, preparar=False):
+        """Registrar una sentencia
+
+        `sql` es el texto común; `sqlite` y `postgres` lo sustituyen en su
+        dialecto. Todos se escriben con marcadores `?` (en las plantillas de
+        execute_values, `VALUES ?` se traduce a `VALUES %s`).
+        """
+        variante = postgres if self.postgres else sqlite
+        if variante is not None:
+            sql = variante
+        if sql is None:
+            raise ValueError(f"La sentencia {nombre} no tiene texto para {self.dialecto}")
+
+        if self.postgres:
+            texto, parametros = _traducir(sql, lambda numero: '%s', True)
+            texto_prepare = None
+            if preparar and self.usar_prepare:
+                texto_prepare, _ = _traducir(sql, lambda numero: f'${numero}', False)
+            sentencia = Sentencia(nombre, texto, texto_prepare, parametros, texto_prepare is not None)
+        else:
+            sentencia = Sentencia(nombre, sql)
+
+        self._sentencias[nombre] = sentencia
+        return sentencia
+
+    def __contains__(self, nombre):
+        return nombre in self._sentencias
+
+    def __getitem__(self, nombre):
+        return self._sentencias[nombre].texto
+
+    def ejecutar(self, cursor, nombre, parametros=()):
+        """Ejecutar una sentencia registrada"""
+        sentencia = self._sentencias[nombre]
+        if not sentencia.preparar:
+            cursor.execute(sentencia.texto, parametros)
+            return cursor
+
+        conn = cursor.connection
+        with self._lock:
+            preparadas = self._preparadas.setdefault(conn, set())
+            pendiente = nombre not in preparadas
+        if pendiente:
+            cursor.execute(f"PREPARE {nombre} AS {sentencia.texto_prepare}")
+            with self._lock:
+                preparadas.add(nombre)
+
+        if sentencia.parametros:
+            marcas = ', '.join(['%s'] * sentencia.parametros)
+            cursor.execute(f"EXECUTE {nombre} ({marcas})", parametros)
+        else:
+            cursor.execute(f"EXECUTE {nombre}")
+        return cursor
+
+    def ejecutar_lote(self, cursor, nombre, filas, page_size=1000):
+        """Insertar muchas filas con una sentencia registrada (sin preparar)
+
+        En PostgreSQL la sentencia es una plantilla `VALUES ?` para
+        execute_values (una sentencia multi-fila por página); en SQLite una
+        fila `VALUES (?, ...)` para executemany.
+        """
+        texto = self._sentencias[nombre].texto
+        if self.postgres:
+            psycopg2.extras.execute_values(cursor, texto, filas, page_size=page_size)
+        else:
+            cursor.executemany(texto, filas)
+        return cursor
+
+    def olvidar_conexion(self, conn):
+        """Olvidar las sentencias preparadas de una conexión (p. ej. tras DISCARD)"""
+        with self._lock:
+            self._preparadas.pop(conn, None)
@@ -129,6 +129,9 @@ function openSensorModal(sensorType) {
         detailsContainer.appendChild(row);
     });
 
+    // Cargar el histórico del sensor
+    loadSensorHistory(sensorType);
+
     // Mostrar modal
     modal.style.display = 'block';
 
@@ -136,6 +139,67 @@ function openSensorModal(sensorType) {
     document.body.style.overflow = 'hidden';
 }
 
+// Columna de sensor_data asociada a cada tarjeta
+const sensorColumns = {
+    water: 'nivel_agua',
+    ph: 'ph',
+    irrigation: 'irrigacion_activa',
+    temperature: 'temperatura',
+    nutrient: 'nivel_nutrientes',
+    light: 'luz_activa'
+};
+
+// Función para cargar el histórico de 30 días del sensor (el servidor elige la resolución)
+async function loadSensorHistory(sensorType) {
+    const container = document.getElementById('sensorHistory');
+    const column = sensorColumns[sensorType];
+    if (!container || !column) return;
+
+    container.innerHTML = '';
+
+    try {
+        const response = await fetch(`/api/sensor-history?metricas=${column}&dias=30&puntos=720`);
+        const result = await response.json();
+        if (!result.success) return;
+
+        const values = result.puntos
+            .filter(punto => punto[column])
+            .map(punto => punto[column].avg);
+
+        if (values.length > 1) {
+            container.innerHTML = createHistoryChart(values, sensorConfig[sensorType].color);
+        }
+    } catch (error) {
+        console.error('Error al cargar el histórico:', error);
+    }
+}
+
+// Gráfico de línea simple con los promedios del histórico
+function createHistoryChart(values, color) {
+    const width = 300;
+    const height = 80;
+    const min = Math.min(...values);
+    const max = Math.max(...values);
+    const range = (max - min) || 1;
+
+    const points = values.map((value, index) => {
+        const x = (index / (values.length - 1)) * width;
+        const y = height - ((value - min) / range) * (height - 10) - 5;
+        return `${x.toFixed(1)},${y.toFixed(1)}`;
+    }).join(' ');
+
+    return `
+        <div class="sensor-history-title">Últimos 30 días</div>
+        <svg viewBox="0 0 ${width} ${height}" preserveAspectRatio="none" class="sensor-history-chart">
+            <polyline points="${points}" fill="none" stroke="${color}" stroke-width="2" />
+        </svg>
+        <div class="sensor-history-range">
+            <span>Mín: ${min.toFixed(1)}</span>
+            <span>Máx: ${max.toFixed(1)}</span>
+        </div>
+    `;
+}
+
 // Función para cerrar el modal
 function closeSensorModal() {
     const modal = document.getElementById('sensorModal');
@@ -679,28 +743,6 @@ function updateWavePosition(percentage) {
     }
 }
 
-// Función para simular cambios en los datos
-function simulateDataChanges() {
-    // Nivel de agua disminuye gradualmente
-    systemData.water.value -= Math.random() * 0.5;
-    systemData.water.value = Math.max(0, Math.min(100, systemData.water.value));
-
-    // pH varía ligeramente
-    systemData.ph.value += (Math.random() - 0.5) * 0.1;
-    systemData.ph.value = Math.max(5.0, Math.min(8.5, systemData.ph.value));
-
-    // Temperatura varía ligeramente
-    systemData.temperature.value += (Math.random() - 0.5) * 0.3;
-    systemData.temperature.value = Math.max(15, Math.min(30, systemData.temperature.value));
-
-    // Nutrientes disminuyen gradualmente
-    systemData.nutrient.value -= Math.random() * 0.3;
-    systemData.nutrient.value = Math.max(0, Math.min(100, systemData.nutrient.value));
-
-    // Actualizar valores en las tarjetas
-    updateCardValues();
-}
-
 // Función para cerrar modal al hacer clic fuera de él
 function closeModalOnOutsideClick(event) {
     if (event.target.id === 'sensorModal') {
@@ -711,19 +753,42 @@ function closeModalOnOutsideClick(event) {
     }
 }
 
-// Datos de la cosecha
+// Datos de la cosecha (los calcula el servidor con la temperatura y la luz registradas)
 const harvestData = {
     cropType: 'Lechuga',
-    plantDate: new Date('2025-11-01'),
-    estimatedHarvestDate: new Date('2025-12-20T18:00:00'),
-    get progress() {
-        const now = new Date();
-        const totalTime = this.estimatedHarvestDate.getTime() - this.plantDate.getTime();
-        const elapsedTime = now.getTime() - this.plantDate.getTime();
-        return Math.min(100, Math.max(0, (elapsedTime / totalTime) * 100));
-    }
+    plantDate: null,
+    estimatedHarvestDate: null,
+    progress: 0
 };
 
+// Intervalo de actualización del progreso de la cosecha (ms)
+const HARVEST_REFRESH_MS = 60000;
+
+// Traer el progreso de la cosecha del sistema activo
+async function loadHarvest() {
+    try {
+        const response = await fetch('/api/harvest');
+        const data = await response.json();
+        if (!data.success) return;
+
+        const harvest = data.harvest;
+        harvestData.cropType = harvest.cropName;
+        harvestData.plantDate = harvest.plantDate ? new Date(harvest.plantDate) : null;
+        harvestData.estimatedHarvestDate = harvest.estimatedHarvestDate ? new Date(harvest.estimatedHarvestDate) : null;
+        harvestData.progress = harvest.progress;
+
+        updateHarvestCountdown();
+        updateHarvestProgress();
+    } catch (error) {
+        console.error('Error al obtener el progreso de la cosecha:', error);
+    }
+}
+
+// Fecha en formato local o marcador si aún no hay datos
+function formatHarvestDate(fecha) {
+    return fecha ? fecha.toLocaleDateString('es-ES') : '--/--/----';
+}
+
 // Función para abrir el modal de cosecha
 function openHarvestModal() {
     const modal = document.getElementById('harvestModal');
@@ -731,8 +796,8 @@ function openHarvestModal() {
 
     // Llenar datos del modal
     document.getElementById('harvestCropType').textContent = harvestData.cropType;
-    document.getElementById('harvestPlantDate').textContent = harvestData.plantDate.toLocaleDateString('es-ES');
-    document.getElementById('harvestEstimatedDate').textContent = harvestData.estimatedHarvestDate.toLocaleDateString('es-ES');
+    document.getElementById('harvestPlantDate').textContent = formatHarvestDate(harvestData.plantDate);
+    document.getElementById('harvestEstimatedDate').textContent = formatHarvestDate(harvestData.estimatedHarvestDate);
     
     updateHarvestProgress();
 
@@ -770,8 +835,8 @@ document.addEventListener('DOMContentLoaded', function() {
     // Actualizar valores iniciales
     updateCardValues();
 
-    // Simular actualización de datos cada 5 segundos
-    setInterval(simulateDataChanges, 5000);
+    // Recibir las lecturas del sistema en vivo
+    connectLiveData();
 
     // Cerrar modal con ESC
     document.addEventListener('keydown', function(e) {
@@ -782,14 +847,21 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 
-// Función para exportar datos (para futuro uso)
-function exportData() {
-    const dataToExport = {
-        timestamp: new Date().toISOString(),
-        ...systemData
-    };
-    console.log('Datos exportados:', dataToExport);
-    return dataToExport;
+// Descargar el histórico del sistema activo (lo genera el servidor por trozos)
+// opciones: { formato: 'csv' | 'jsonl', dias, desde, hasta, gzip }
+function exportData(opciones = {}) {
+    const params = new URLSearchParams({ formato: opciones.formato || 'csv' });
+    if (opciones.desde) params.set('desde', opciones.desde);
+    if (opciones.hasta) params.set('hasta', opciones.hasta);
+    if (opciones.dias) params.set('dias', opciones.dias);
+    if (opciones.gzip) params.set('gzip', '1');
+
+    const enlace = document.createElement('a');
+    enlace.href = `/api/export?${params}`;
+    enlace.download = '';
+    document.body.appendChild(enlace);
+    enlace.click();
+    enlace.remove();
 }
 
 // Función para obtener datos del servidor (para futuro uso con API)
@@ -798,12 +870,53 @@ async function fetchDataFromServer() {
         const response = await fetch('/api/system-data');
         const data = await response.json();
         // Actualizar systemData con los datos del servidor
-        console.log('Datos del servidor:', data);
+        applyServerData(data);
     } catch (error) {
         console.error('Error al obtener datos:', error);
     }
 }
 
+// Conectar al stream de datos en vivo (Server-Sent Events)
+// El navegador reconecta solo y envía Last-Event-ID; sin soporte se usa polling
+function connectLiveData() {
+    // El servidor solo ofrece el stream con workers cooperativos (gevent);
+    // si no, se sondea /api/system-data
+    const liveStream = document.body.dataset.liveStream === 'true';
+    if (!liveStream || !window.EventSource) {
+        fetchDataFromServer();
+        setInterval(fetchDataFromServer, Number(document.body.dataset.pollMs) || 5000);
+        return;
+    }
+
+    const source = new EventSource('/api/system-data/stream');
+    source.onmessage = function(event) {
+        applyServerData(JSON.parse(event.data));
+    };
+}
+
+// Aplicar una lectura del servidor a systemData (los campos nulos se ignoran)
+function applyServerData(data) {
+    if (data.waterLevel != null) systemData.water.value = data.waterLevel;
+    if (data.phLevel != null) systemData.ph.value = data.phLevel;
+    if (data.waterTemp != null) systemData.temperature.value = data.waterTemp;
+    if (data.nutrientLevel != null) systemData.nutrient.value = data.nutrientLevel;
+    if (data.lightActive != null) {
+        systemData.light.status = data.lightActive;
+        systemData.light.value = data.lightActive ? 'Encendido' : 'Apagado';
+    }
+    if (data.irrigationActive != null && data.irrigationActive !== systemData.irrigation.status) {
+        systemData.irrigation.status = data.irrigationActive;
+        systemData.irrigation.value = data.irrigationActive ? 'Activo' : 'Inactivo';
+        const irrigationCard = document.querySelector('.irrigation-card');
+        if (irrigationCard) {
+            irrigationCard.classList.toggle('inactive', !data.irrigationActive);
+        }
+        updateIrrigationVisualization(data.irrigationActive);
+    }
+
+    updateCardValues();
+}
+
 // ===== FUNCIONES DE CONTROL DE IRRIGACIÓN =====
 
 // Nueva función para el interruptor rápido
@@ -957,16 +1070,35 @@ async function updateServerIrrigationConfig(config) {
             })
         });
         const data = await response.json();
+        if (!data.success) {
+            console.error('Error al guardar configuración:', data.message);
+            return;
+        }
         console.log('Configuración guardada en servidor:', data);
     } catch (error) {
         console.error('Error al guardar configuración:', error);
     }
 }
 
+// Cargar la configuración de irrigación guardada en el servidor
+async function loadIrrigationConfig() {
+    try {
+        const response = await fetch('/api/irrigation-config');
+        const data = await response.json();
+        if (!data.success) return;
+        systemData.irrigation.savingPower = data.config.savingPower;
+        systemData.irrigation.savingDuration = data.config.savingDuration;
+        systemData.irrigation.abundantDuration = data.config.abundantDuration;
+    } catch (error) {
+        console.error('Error al cargar configuración:', error);
+    }
+}
+
 // Inicializar visualización de irrigación según estado inicial
 document.addEventListener('DOMContentLoaded', () => {
     updateIrrigationVisualization(systemData.irrigation.status);
     updateCardValues();
+    loadIrrigationConfig();
 });
 
 
@@ -988,6 +1120,136 @@ function toggleProfileMenu() {
     }
 }
 
+// ===== NOTIFICACIONES DE ALERTAS =====
+
+// Intervalo de consulta de notificaciones nuevas (ms)
+const NOTIFICATIONS_REFRESH_MS = 30000;
+
+// Estado de la lista de notificaciones cargada
+const notificationState = {
+    items: [],
+    unread: 0,
+    next: null
+};
+
+// Texto relativo de una fecha ("Hace 5 minutos")
+function timeAgo(fecha) {
+    const minutos = Math.max(0, Math.floor((Date.now() - fecha.getTime()) / 60000));
+    if (minutos < 1) return 'Hace un momento';
+    if (minutos < 60) return `Hace ${minutos} minuto${minutos === 1 ? '' : 's'}`;
+    const horas = Math.floor(minutos / 60);
+    if (horas < 24) return `Hace ${horas} hora${horas === 1 ? '' : 's'}`;
+    const dias = Math.floor(horas / 24);
+    return `Hace ${dias} día${dias === 1 ? '' : 's'}`;
+}
+
+// Dibujar la lista de notificaciones y el contador de no leídas
+function renderNotifications() {
+    const badge = document.getElementById('notificationBadge');
+    if (badge) {
+        badge.textContent = notificationState.unread > 99 ? '99+' : notificationState.unread;
+        badge.style.display = notificationState.unread > 0 ? '' : 'none';
+    }
+
+    const list = document.getElementById('notificationList');
+    if (!list) return;
+    list.innerHTML = '';
+
+    if (notificationState.items.length === 0) {
+        list.innerHTML = '<div class="notification-item"><div class="notification-content">'
+            + '<div class="notification-title">Sin notificaciones</div></div></div>';
+    }
+
+    notificationState.items.forEach(notification => {
+        const item = document.createElement('div');
+        item.className = 'notification-item';
+
+        const icon = document.createElement('div');
+        icon.className = 'notification-icon';
+        const config = sensorConfig[notification.metric];
+        icon.textContent = notification.type === 'normalizada' ? '✅' : (config ? config.icon : '⚠️');
+
+        const content = document.createElement('div');
+        content.className = 'notification-content';
+        const title = document.createElement('div');
+        title.className = 'notification-title';
+        title.textContent = notification.message;
+        if (!notification.read) title.style.fontWeight = 'bold';
+        const time = document.createElement('div');
+        time.className = 'notification-time';
+        time.textContent = timeAgo(new Date(notification.time));
+
+        content.appendChild(title);
+        content.appendChild(time);
+        item.appendChild(icon);
+        item.appendChild(content);
+        list.appendChild(item);
+    });
+
+    const more = document.getElementById('notificationMore');
+    if (more) {
+        more.style.display = notificationState.next ? '' : 'none';
+    }
+}
+
+// Traer la primera página de notificaciones del sistema activo
+async function loadNotifications() {
+    try {
+        const response = await fetch('/api/notifications');
+        const data = await response.json();
+        if (!data.success) return;
+
+        notificationState.items = data.notifications;
+        notificationState.unread = data.unread;
+        notificationState.next = data.next;
+        renderNotifications();
+    } catch (error) {
+        console.error('Error al obtener notificaciones:', error);
+    }
+}
+
+// Añadir la página siguiente de notificaciones (pie del desplegable)
+async function loadMoreNotifications(event) {
+    event.stopPropagation();
+    if (!notificationState.next) return;
+
+    try {
+        const response = await fetch(`/api/notifications?antes=${notificationState.next}`);
+        const data = await response.json();
+        if (!data.success) return;
+
+        notificationState.items = notificationState.items.concat(data.notifications);
+        notificationState.next = data.next;
+        renderNotifications();
+    } catch (error) {
+        console.error('Error al obtener notificaciones:', error);
+    }
+}
+
+// Marcar como leídas las notificaciones mostradas
+async function markNotificationsRead() {
+    if (notificationState.unread === 0 || notificationState.items.length === 0) return;
+
+    try {
+        const response = await fetch('/api/read-notifications', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ upTo: notificationState.items[0].id })
+        });
+        const data = await response.json();
+        if (!data.success) return;
+
+        notificationState.unread = Math.max(0, notificationState.unread - data.marked);
+        const badge = document.getElementById('notificationBadge');
+        if (badge) {
+            badge.style.display = notificationState.unread > 0 ? '' : 'none';
+            badge.textContent = notificationState.unread;
+        }
+    } catch (error) {
+        console.error('Error al marcar notificaciones:', error);
+    }
+}
+
 /**
  * Muestra u oculta el menú desplegable de notificaciones.
  */
@@ -997,6 +1259,10 @@ function toggleNotifications() {
 
     if (notificationDropdown) {
         notificationDropdown.classList.toggle('show');
+        // Al abrir se dan por vistas las notificaciones de la lista
+        if (notificationDropdown.classList.contains('show')) {
+            markNotificationsRead();
+        }
         // Cerrar perfil si está abierto
         if (profileDropdown) {
             profileDropdown.classList.remove('show');
@@ -1021,41 +1287,45 @@ document.addEventListener('click', function(event) {
 });
 
 /**
- * Inicia el contador regresivo para la cosecha.
+ * Actualiza el contador de días hasta la cosecha estimada por el servidor.
  */
-function startHarvestCountdown() {
-    // Fecha estimada de cosecha (puedes cambiarla o hacerla dinámica)
-    const harvestDate = new Date('2025-12-20T18:00:00');
-    
+function updateHarvestCountdown() {
+    const harvestDate = harvestData.estimatedHarvestDate;
+
     const harvestDateElement = document.getElementById('harvestDate');
-    if(harvestDateElement) {
+    if (harvestDateElement && harvestDate) {
         const formattedDate = harvestDate.toLocaleDateString('es-ES', { day: '2-digit', month: '2-digit', year: 'numeric' });
         harvestDateElement.textContent = `Fecha: ${formattedDate}`;
     }
 
     const daysEl = document.getElementById('days');
 
-    if (!daysEl) return;
+    if (!daysEl || !harvestDate) return;
 
-    const interval = setInterval(() => {
-        const now = new Date();
-        const distance = harvestDate.getTime() - now.getTime();
+    const distance = harvestDate.getTime() - Date.now();
 
-        if (distance < 0) {
-            clearInterval(interval);
-            document.getElementById('harvestCountdown').innerHTML = "<div style='font-size: 1.2rem; font-weight: bold; color: #388e3c;'>¡Cosecha Lista!</div>";
-            return;
+    if (distance < 0 || harvestData.progress >= 100) {
+        const countdown = document.getElementById('harvestCountdown');
+        if (countdown) {
+            countdown.innerHTML = "<div style='font-size: 1.2rem; font-weight: bold; color: #388e3c;'>¡Cosecha Lista!</div>";
         }
+        daysEl.textContent = '00';
+        return;
+    }
 
-        const days = Math.floor(distance / (1000 * 60 * 60 * 24));
-        daysEl.textContent = String(days).padStart(2, '0');
-    }, 1000);
+    const days = Math.floor(distance / (1000 * 60 * 60 * 24));
+    daysEl.textContent = String(days).padStart(2, '0');
 }
 
 // Event Listeners adicionales
 document.addEventListener('DOMContentLoaded', function() {
-    // Iniciar contador de cosecha
-    startHarvestCountdown();
+    // Progreso y contador de la cosecha
+    loadHarvest();
+    setInterval(loadHarvest, HARVEST_REFRESH_MS);
+
+    // Notificaciones de alertas
+    loadNotifications();
+    setInterval(loadNotifications, NOTIFICATIONS_REFRESH_MS);
 
     // Cerrar el menú de perfil si se hace clic fuera de él
     window.onclick = function(event) {
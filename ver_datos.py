@@ -1,118 +1,351 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-Script para ver los datos almacenados en la base de datos CAEC
+Consulta de los datos de CAEC para administración
+
+Usa la misma base que la aplicación: PostgreSQL si DATABASE_URL está
+definida y si no SQLite (CAEC_SQLITE_PATH, caec.db por defecto). Las filas
+se leen por lotes (cursor del servidor en PostgreSQL) y se escriben según
+llegan, así que la memoria no depende del tamaño de las tablas.
+
+Uso:
+    python ver_datos.py                       resumen de usuarios, sistemas, contactos y estadísticas
+    python ver_datos.py usuarios --activos --formato jsonl
+    python ver_datos.py sistemas --estado activo --modelo CAEC-V1 --formato csv --salida sistemas.csv
+    python ver_datos.py contactos --pais Chile
+    python ver_datos.py lecturas --sistema 3 --dias 7 --formato csv
+    python ver_datos.py estadisticas
 """
 
-import sqlite3
-from datetime import datetime
+import argparse
+import csv
+import json
+import secrets
+import sys
+from datetime import datetime, timedelta, timezone
+
+import psycopg2.extras
+
+from database import SQL, get_db_connection, iterar_lecturas
+from exportacion import generar_exportacion
+
+FORMATOS = ('texto', 'jsonl', 'csv')
+
+# Consultas de cada tabla: (columnas, FROM ... con sus JOIN, orden)
+CONSULTAS = {
+    'usuarios': (
+        'u.id, u.nombre, u.apellido, u.email, u.fecha_registro, u.ultimo_acceso, u.activo',
+        'usuario u',
+        'u.id',
+    ),
+    'sistemas': (
+        's.id, s.codigo_sistema, s.nombre_sistema, s.usuario_id, u.nombre, u.apellido, '
+        's.fecha_vinculacion, s.ultimo_sync, s.estado, s.modelo, s.version_firmware',
+        'sistema_caec s LEFT JOIN usuario u ON s.usuario_id = u.id',
+        's.id',
+    ),
+    'contactos': (
+        'c.id, c.usuario_id, u.nombre, u.apellido, c.telefono, c.celular, '
+        'c.direccion, c.ciudad, c.pais, c.codigo_postal',
+        'contacto c INNER JOIN usuario u ON c.usuario_id = u.id',
+        'c.id',
+    ),
+}
+
+# Estadísticas: un agregado por tabla, en una sola consulta
+SQL.registrar('admin_estadisticas', '''
+    SELECT u.usuarios, u.usuarios_activos, s.sistemas, s.vinculados, s.disponibles, s.activos
+    FROM (
+        SELECT COUNT(*) AS usuarios,
+               COALESCE(SUM(CASE WHEN activo THEN 1 ELSE 0 END), 0) AS usuarios_activos
+        FROM usuario
+    ) u
+    CROSS JOIN (
+        SELECT COUNT(*) AS sistemas,
+               COALESCE(SUM(CASE WHEN usuario_id IS NOT NULL THEN 1 ELSE 0 END), 0) AS vinculados,
+               COALESCE(SUM(CASE WHEN usuario_id IS NULL THEN 1 ELSE 0 END), 0) AS disponibles,
+               COALESCE(SUM(CASE WHEN estado = 'activo' THEN 1 ELSE 0 END), 0) AS activos
+        FROM sistema_caec
+    ) s
+''')
+
+
+def _filtros(tabla, args):
+    """Condiciones (con marcadores `?`) y parámetros de los filtros pedidos"""
+    condiciones, parametros = [], []
+
+    def filtro(condicion, *valores):
+        condiciones.append(condicion)
+        parametros.extend(valores)
+
+    if tabla == 'usuarios':
+        if args.activos:
+            filtro('u.activo = ?', True)
+        if args.inactivos:
+            filtro('(u.activo = ? OR u.activo IS NULL)', False)
+        if args.email:
+            filtro('LOWER(u.email) LIKE ?', f'%{args.email.lower()}%')
+    elif tabla == 'sistemas':
+        if args.estado:
+            filtro('s.estado = ?', args.estado)
+        if args.modelo:
+            filtro('s.modelo = ?', args.modelo)
+        if args.usuario:
+            filtro('s.usuario_id = ?', args.usuario)
+        if args.vinculados:
+            condiciones.append('s.usuario_id IS NOT NULL')
+        if args.disponibles:
+            condiciones.append('s.usuario_id IS NULL')
+    elif tabla == 'contactos':
+        if args.usuario:
+            filtro('c.usuario_id = ?', args.usuario)
+        if args.ciudad:
+            filtro('LOWER(c.ciudad) = ?', args.ciudad.lower())
+        if args.pais:
+            filtro('LOWER(c.pais) = ?', args.pais.lower())
+    return condiciones, parametros
+
+
+def _sentencia(tabla, condiciones, con_limite):
+    """Nombre de la sentencia de una tabla con los filtros pedidos (se registra al usarla)"""
+    nombre = f"admin_{tabla}"
+    columnas, origen, orden = CONSULTAS[tabla]
+    donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ''
+    limite = 'LIMIT ?' if con_limite else ''
+    SQL.registrar(nombre, f'SELECT {columnas} FROM {origen} {donde} ORDER BY {orden} {limite}')
+    return nombre
 
-def ver_base_datos():
+
+def iterar_filas(nombre, parametros, tamano_lote=1000):
+    """Recorrer el resultado de una sentencia como diccionarios, de lote en lote
+
+    Usa una conexión propia (fuera del pool). En PostgreSQL las filas se
+    quedan en el servidor (cursor con nombre); en SQLite el cursor avanza
+    sobre la consulta sin materializarla.
+    """
+    conn = get_db_connection()
     try:
-        conn = sqlite3.connect('caec.db')
-        cursor = conn.cursor()
-
-        print("\n" + "="*60)
-        print("           SISTEMA CAEC - DATOS DE LA BASE DE DATOS")
-        print("="*60)
-
-        # USUARIOS REGISTRADOS
-        print("\n>>> USUARIOS REGISTRADOS:")
-        print("-" * 60)
-        cursor.execute("SELECT id, nombre, apellido, email, fecha_registro, activo FROM usuario")
-        usuarios = cursor.fetchall()
-
-        if usuarios:
-            for row in usuarios:
-                print(f"\nID: {row[0]}")
-                print(f"  Nombre: {row[1]} {row[2]}")
-                print(f"  Email: {row[3]}")
-                print(f"  Registrado: {row[4]}")
-                print(f"  Estado: {'Activo' if row[5] else 'Inactivo'}")
+        if SQL.postgres:
+            cursor = conn.cursor(name=f'admin_{secrets.token_hex(4)}',
+                                 cursor_factory=psycopg2.extras.RealDictCursor)
+            cursor.itersize = tamano_lote
+            cursor.execute(SQL[nombre], parametros)
         else:
-            print("  No hay usuarios registrados")
-
-        # SISTEMAS CAEC
-        print("\n" + "="*60)
-        print(">>> SISTEMAS CAEC:")
-        print("-" * 60)
-        cursor.execute("""
-            SELECT s.id, s.codigo_sistema, s.usuario_id, u.nombre, u.apellido,
-                   s.fecha_vinculacion, s.estado, s.modelo
-            FROM sistema_caec s
-            LEFT JOIN usuario u ON s.usuario_id = u.id
-            ORDER BY s.id
-        """)
-        sistemas = cursor.fetchall()
-
-        if sistemas:
-            for row in sistemas:
-                print(f"\nSistema: {row[1]} (ID: {row[0]})")
-                print(f"  Modelo: {row[7]}")
-                if row[2]:  # Tiene usuario vinculado
-                    print(f"  Usuario: {row[3]} {row[4]} (ID: {row[2]})")
-                    print(f"  Fecha vinculacion: {row[5]}")
-                else:
-                    print(f"  Estado: DISPONIBLE - Sin vincular")
-                print(f"  Estado: {row[6]}")
-        else:
-            print("  No hay sistemas registrados")
-
-        # INFORMACIÓN DE CONTACTO
-        print("\n" + "="*60)
-        print(">>> INFORMACION DE CONTACTO:")
-        print("-" * 60)
-        cursor.execute("""
-            SELECT c.id, u.nombre, u.apellido, c.telefono, c.celular,
-                   c.direccion, c.ciudad, c.pais
-            FROM contacto c
-            INNER JOIN usuario u ON c.usuario_id = u.id
-        """)
-        contactos = cursor.fetchall()
-
-        if contactos:
-            for row in contactos:
-                print(f"\n{row[1]} {row[2]}:")
-                if row[3]:
-                    print(f"  Telefono: {row[3]}")
-                if row[4]:
-                    print(f"  Celular: {row[4]}")
-                if row[5]:
-                    print(f"  Direccion: {row[5]}")
-                if row[6]:
-                    print(f"  Ciudad: {row[6]}")
-                if row[7]:
-                    print(f"  Pais: {row[7]}")
-                if not any([row[3], row[4], row[5], row[6], row[7]]):
-                    print("  Sin informacion de contacto")
+            cursor = conn.cursor()
+            SQL.ejecutar(cursor, nombre, parametros)
+        while True:
+            filas = cursor.fetchmany(tamano_lote)
+            if not filas:
+                return
+            for fila in filas:
+                yield dict(fila)
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def estadisticas():
+    """Totales de usuarios y sistemas (una consulta)"""
+    return list(iterar_filas('admin_estadisticas', ()))[0]
+
+
+def _texto(valor):
+    if isinstance(valor, datetime):
+        return valor.strftime('%Y-%m-%d %H:%M:%S')
+    return valor
+
+
+def _imprimir_usuario(fila, salida):
+    print(f"\nID: {fila['id']}", file=salida)
+    print(f"  Nombre: {fila['nombre']} {fila['apellido']}", file=salida)
+    print(f"  Email: {fila['email']}", file=salida)
+    print(f"  Registrado: {_texto(fila['fecha_registro'])}", file=salida)
+    print(f"  Estado: {'Activo' if fila['activo'] else 'Inactivo'}", file=salida)
+
+
+def _imprimir_sistema(fila, salida):
+    print(f"\nSistema: {fila['codigo_sistema']} (ID: {fila['id']})", file=salida)
+    print(f"  Modelo: {fila['modelo']}", file=salida)
+    if fila['usuario_id']:  # Tiene usuario vinculado
+        print(f"  Usuario: {fila['nombre']} {fila['apellido']} (ID: {fila['usuario_id']})", file=salida)
+        print(f"  Fecha vinculacion: {_texto(fila['fecha_vinculacion'])}", file=salida)
+    else:
+        print("  Estado: DISPONIBLE - Sin vincular", file=salida)
+    print(f"  Estado: {fila['estado']}", file=salida)
+
+
+def _imprimir_contacto(fila, salida):
+    print(f"\n{fila['nombre']} {fila['apellido']}:", file=salida)
+    campos = [('Telefono', 'telefono'), ('Celular', 'celular'), ('Direccion', 'direccion'),
+              ('Ciudad', 'ciudad'), ('Pais', 'pais')]
+    for etiqueta, columna in campos:
+        if fila[columna]:
+            print(f"  {etiqueta}: {fila[columna]}", file=salida)
+    if not any(fila[columna] for _, columna in campos):
+        print("  Sin informacion de contacto", file=salida)
+
+
+IMPRESORES = {
+    'usuarios': (_imprimir_usuario, "No hay usuarios registrados"),
+    'sistemas': (_imprimir_sistema, "No hay sistemas registrados"),
+    'contactos': (_imprimir_contacto, "No hay informacion de contacto"),
+}
+
+
+def escribir_filas(filas, formato, salida, tabla=None):
+    """Escribir las filas según llegan; devuelve cuántas se escribieron"""
+    total = 0
+    escritor = None
+    for fila in filas:
+        if formato == 'jsonl':
+            salida.write(json.dumps(fila, default=str, ensure_ascii=False) + '\n')
+        elif formato == 'csv':
+            if escritor is None:
+                escritor = csv.DictWriter(salida, fieldnames=list(fila), lineterminator='\n')
+                escritor.writeheader()
+            escritor.writerow({columna: _texto(valor) for columna, valor in fila.items()})
         else:
-            print("  No hay informacion de contacto")
+            IMPRESORES[tabla][0](fila, salida)
+        total += 1
+    if total == 0 and formato == 'texto':
+        print(f"  {IMPRESORES[tabla][1]}", file=salida)
+    return total
 
-        # ESTADÍSTICAS
-        print("\n" + "="*60)
-        print(">>> ESTADISTICAS:")
-        print("-" * 60)
 
-        cursor.execute("SELECT COUNT(*) FROM usuario WHERE activo = 1")
-        usuarios_activos = cursor.fetchone()[0]
-        print(f"  Usuarios activos: {usuarios_activos}")
+def _imprimir_estadisticas(totales, salida):
+    print(f"  Usuarios activos: {totales['usuarios_activos']} (de {totales['usuarios']})", file=salida)
+    print(f"  Sistemas vinculados: {totales['vinculados']}", file=salida)
+    print(f"  Sistemas disponibles: {totales['disponibles']}", file=salida)
+    print(f"  Sistemas activos: {totales['activos']}", file=salida)
 
-        cursor.execute("SELECT COUNT(*) FROM sistema_caec WHERE usuario_id IS NOT NULL")
-        sistemas_vinculados = cursor.fetchone()[0]
-        print(f"  Sistemas vinculados: {sistemas_vinculados}")
 
-        cursor.execute("SELECT COUNT(*) FROM sistema_caec WHERE usuario_id IS NULL")
-        sistemas_disponibles = cursor.fetchone()[0]
-        print(f"  Sistemas disponibles: {sistemas_disponibles}")
+def ver_base_datos(salida=sys.stdout, tamano_lote=1000):
+    """Resumen completo en texto (lo que muestra el script sin argumentos)"""
+    secciones = [
+        ('usuarios', ">>> USUARIOS REGISTRADOS:"),
+        ('sistemas', ">>> SISTEMAS CAEC:"),
+        ('contactos', ">>> INFORMACION DE CONTACTO:"),
+    ]
 
-        print("\n" + "="*60 + "\n")
+    print("\n" + "="*60, file=salida)
+    print("           SISTEMA CAEC - DATOS DE LA BASE DE DATOS", file=salida)
+    print("="*60, file=salida)
 
-        conn.close()
+    for tabla, titulo in secciones:
+        if tabla != 'usuarios':
+            print("\n" + "="*60, file=salida)
+        print(f"\n{titulo}" if tabla == 'usuarios' else titulo, file=salida)
+        print("-" * 60, file=salida)
+        nombre = _sentencia(tabla, [], con_limite=False)
+        escribir_filas(iterar_filas(nombre, (), tamano_lote), 'texto', salida, tabla)
+
+    print("\n" + "="*60, file=salida)
+    print(">>> ESTADISTICAS:", file=salida)
+    print("-" * 60, file=salida)
+    _imprimir_estadisticas(estadisticas(), salida)
+    print("\n" + "="*60 + "\n", file=salida)
+
+
+def _fecha(texto):
+    """Fecha ISO 8601 (se interpreta en UTC, como los timestamps de la base)"""
+    try:
+        return datetime.fromisoformat(texto.replace('Z', '')).replace(tzinfo=None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Fecha no válida: {texto}")
+
+
+def _exportar_lecturas(args, salida):
+    hasta = args.hasta or datetime.now(timezone.utc).replace(tzinfo=None)
+    desde = args.desde or hasta - timedelta(days=args.dias)
+
+    if args.formato == 'texto':
+        total = 0
+        for lote in iterar_lecturas(args.sistema, desde, hasta, tamano_lote=args.lote):
+            for fila in lote:
+                valores = ', '.join(f"{v}" for v in fila[1:])
+                print(f"{_texto(fila[0])} | {valores}", file=salida)
+            total += len(lote)
+        print(f"\n{total} lecturas del sistema {args.sistema}", file=sys.stderr)
+        return
 
-    except sqlite3.Error as e:
-        print(f"\nError al acceder a la base de datos: {e}")
+    # Mismo formato que /api/export, escrito por trozos
+    binaria = salida.buffer if hasattr(salida, 'buffer') else salida
+    salida.flush()
+    for trozo in generar_exportacion(args.sistema, desde, hasta, args.formato):
+        binaria.write(trozo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consulta de los datos de CAEC (SQLite o PostgreSQL)')
+    parser.add_argument('--formato', choices=FORMATOS, default='texto', help='Formato de salida')
+    parser.add_argument('--salida', help='Escribir en este archivo en vez de la salida estándar')
+    parser.add_argument('--lote', type=int, default=1000, help='Filas leídas de la base por lote')
+    subparsers = parser.add_subparsers(dest='informe')
+
+    comunes = argparse.ArgumentParser(add_help=False)
+    comunes.add_argument('--formato', choices=FORMATOS, default=argparse.SUPPRESS, help='Formato de salida')
+    comunes.add_argument('--salida', default=argparse.SUPPRESS, help='Archivo de salida')
+    comunes.add_argument('--limite', type=int, help='Número máximo de filas')
+
+    usuarios = subparsers.add_parser('usuarios', parents=[comunes], help='Usuarios registrados')
+    activos = usuarios.add_mutually_exclusive_group()
+    activos.add_argument('--activos', action='store_true', help='Solo usuarios activos')
+    activos.add_argument('--inactivos', action='store_true', help='Solo usuarios inactivos')
+    usuarios.add_argument('--email', help='Email que contiene este texto')
+
+    sistemas = subparsers.add_parser('sistemas', parents=[comunes], help='Sistemas CAEC')
+    sistemas.add_argument('--estado', help='Estado del sistema (activo, inactivo, disponible...)')
+    sistemas.add_argument('--modelo', help='Modelo del sistema')
+    sistemas.add_argument('--usuario', type=int, help='Id del usuario vinculado')
+    vinculo = sistemas.add_mutually_exclusive_group()
+    vinculo.add_argument('--vinculados', action='store_true', help='Solo sistemas con usuario')
+    vinculo.add_argument('--disponibles', action='store_true', help='Solo sistemas sin usuario')
+
+    contactos = subparsers.add_parser('contactos', parents=[comunes], help='Información de contacto')
+    contactos.add_argument('--usuario', type=int, help='Id del usuario')
+    contactos.add_argument('--ciudad', help='Ciudad')
+    contactos.add_argument('--pais', help='País')
+
+    lecturas = subparsers.add_parser('lecturas', parents=[comunes], help='Lecturas crudas de un sistema')
+    lecturas.add_argument('--sistema', type=int, required=True, help='Id del sistema')
+    lecturas.add_argument('--desde', type=_fecha, help='Inicio del rango (ISO 8601, UTC)')
+    lecturas.add_argument('--hasta', type=_fecha, help='Fin del rango (ISO 8601, UTC; por defecto ahora)')
+    lecturas.add_argument('--dias', type=float, default=1, help='Días hasta --hasta si no se indica --desde')
+
+    subparsers.add_parser('estadisticas', parents=[comunes], help='Totales de usuarios y sistemas')
+
+    args = parser.parse_args()
+    salida = open(args.salida, 'w', encoding='utf-8', newline='') if args.salida else sys.stdout
+
+    try:
+        if args.informe is None:
+            ver_base_datos(salida, args.lote)
+        elif args.informe == 'lecturas':
+            _exportar_lecturas(args, salida)
+        elif args.informe == 'estadisticas':
+            totales = estadisticas()
+            if args.formato == 'texto':
+                _imprimir_estadisticas(totales, salida)
+            else:
+                escribir_filas([totales], args.formato, salida)
+        else:
+            condiciones, parametros = _filtros(args.informe, args)
+            if args.limite is not None:
+                parametros.append(args.limite)
+            nombre = _sentencia(args.informe, condiciones, con_limite=args.limite is not None)
+            total = escribir_filas(iterar_filas(nombre, tuple(parametros), args.lote),
+                                   args.formato, salida, args.informe)
+            print(f"\n{total} filas", file=sys.stderr)
+    except BrokenPipeError:
+        # Salida cortada (p. ej. `| head`)
+        pass
     except Exception as e:
-        print(f"\nError: {e}")
+        print(f"\nError al acceder a la base de datos: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if salida is not sys.stdout:
+            salida.close()
+
 
 if __name__ == "__main__":
-    ver_base_datos()
+    main()